@@ -0,0 +1,76 @@
+"""
+One access log line per request, logged by `app.access` once the response is sent.
+
+Besides the message, the line carries the request and its timings as fields, for the JSON logs:
+`duration_ms` until the body was sent, without the background tasks run after it, and `first_byte_ms` until the response
+started.
+"""
+
+import logging
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+log = logging.getLogger('app.access')
+
+
+class AccessLogMiddleware:
+    """
+    Logs every HTTP request, see the module docstring
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500
+        first_byte: float | None = None
+        size = 0
+        logged = False
+
+        def log_access() -> None:
+            nonlocal logged
+            logged = True
+            duration_ms = (time.perf_counter() - started) * 1000
+            client = scope.get('client')
+            log.info(
+                '%s %s %s %.1fms',
+                scope['method'],
+                scope['path'],
+                status_code,
+                duration_ms,
+                extra={
+                    'method': scope['method'],
+                    'path': scope['path'],
+                    'query': scope.get('query_string', b'').decode('latin-1'),
+                    'status': status_code,
+                    'bytes': size,
+                    'duration_ms': round(duration_ms, 2),
+                    'first_byte_ms': round((first_byte - started) * 1000, 2) if first_byte else None,
+                    'client': client[0] if client else None,
+                },
+            )
+
+        async def send_timed(message: Message) -> None:
+            nonlocal status_code, first_byte, size
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                first_byte = time.perf_counter()
+            elif message['type'] == 'http.response.body':
+                size += len(message.get('body', b''))
+            await send(message)
+            # Background tasks run once the response is sent, they are not part of the request
+            if message['type'] == 'http.response.body' and not message.get('more_body', False) and not logged:
+                log_access()
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            # No response was sent, or it failed to be
+            if not logged:
+                log_access()
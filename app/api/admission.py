@@ -0,0 +1,123 @@
+"""
+Admission control: refuse low priority requests early while the worker is overloaded, instead of letting every
+request queue for database connections and ffmpeg slots until they all time out together.
+
+Load is measured per worker, as the highest of
+* requests in progress, relative to `SHED_MAX_IN_FLIGHT`
+* time spent waiting for a database connection, relative to `SHED_MAX_POOL_WAIT_SECONDS`
+* event loop lag from `app/api/loop_monitor.py`, relative to `SHED_MAX_LOOP_LAG_SECONDS`
+
+where 1 is overloaded. Uploads and thumbnails are shed from half of that, anonymous feed reads once overloaded.
+Everything else, like signed in reads and small writes, is always let through. Refused requests get a 503 with
+`Retry-After`, before their body is read.
+"""
+
+import logging
+from collections.abc import Awaitable, Callable
+from enum import Enum
+
+from fastapi import Request, Response, status
+from fastapi.responses import JSONResponse
+
+from app.api.loop_monitor import loop_monitor
+from app.api.metrics import Counter, DecayingAverage, Gauge
+from app.core.config import settings
+
+log = logging.getLogger(__name__)
+
+
+class Priority(str, Enum):
+    media = 'media'
+    anonymous_read = 'anonymous_read'
+    normal = 'normal'
+
+
+# Load from which a priority is refused, and how long clients should wait before retrying
+SHED_AT = {Priority.media: 0.5, Priority.anonymous_read: 1.0}
+RETRY_AFTER_SECONDS = {Priority.media: 30, Priority.anonymous_read: 5}
+
+# Requests starting ffmpeg, or receiving large bodies. Matched before routing, on the method and path.
+MEDIA_ROUTES = {
+    ('POST', f'{settings.API_V1_STR}/files'),
+    ('POST', f'{settings.API_V2_STR}/files'),
+    ('POST', f'{settings.API_V2_STR}/files/trim'),
+    ('PUT', f'{settings.API_V2_STR}/user'),
+}
+MEDIA_PREFIXES = (('POST', f'{settings.API_V2_STR}/uploads'), ('PATCH', f'{settings.API_V2_STR}/uploads/'))
+FEED_PATHS = {
+    '/',
+    f'{settings.API_V1_STR}/files',
+    f'{settings.API_V2_STR}/files',
+    f'{settings.API_V2_STR}/tags',
+    f'{settings.API_V2_STR}/users',
+}
+
+
+class LoadMonitor:
+    """
+    Per-worker load, see the module docstring
+    """
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self.pool_wait = DecayingAverage(half_life=2)
+        self.shedding = False
+
+    def load(self) -> float:
+        """
+        Current load, 1 is overloaded
+        """
+        return max(
+            self.in_flight / settings.SHED_MAX_IN_FLIGHT,
+            self.pool_wait.value() / settings.SHED_MAX_POOL_WAIT_SECONDS,
+            loop_monitor.lag.value() / settings.SHED_MAX_LOOP_LAG_SECONDS,
+        )
+
+
+load_monitor = LoadMonitor()
+
+SHED_REQUESTS = Counter('klepp_shed_requests_total', 'Requests refused by load shedding', labels=('priority',))
+Gauge('klepp_requests_in_flight', 'Requests in progress', lambda: load_monitor.in_flight)
+Gauge('klepp_db_pool_wait_average_seconds', 'Moving average of the wait for a connection', load_monitor.pool_wait.value)
+Gauge('klepp_load', 'Highest load signal relative to its limit, 1 is overloaded', load_monitor.load)
+
+
+def request_priority(request: Request) -> Priority:
+    """
+    Priority of a request, from what is known before routing
+    """
+    method, path = request.method, request.url.path
+    if (method, path) in MEDIA_ROUTES or any(
+        method == media_method and path.startswith(prefix) for media_method, prefix in MEDIA_PREFIXES
+    ):
+        return Priority.media
+    if method in ('GET', 'HEAD') and path in FEED_PATHS and 'authorization' not in request.headers:
+        return Priority.anonymous_read
+    return Priority.normal
+
+
+async def shed_load(request: Request, call_next: Callable[[Request], Awaitable[Response]]) -> Response:
+    """
+    Middleware refusing low priority requests while the worker is overloaded, and counting requests in progress
+    """
+    priority = request_priority(request)
+    load = load_monitor.load()
+    if priority in SHED_AT and load >= SHED_AT[priority]:
+        if not load_monitor.shedding:
+            log.warning('Worker overloaded (load %.2f), shedding low priority requests', load)
+            load_monitor.shedding = True
+        SHED_REQUESTS.inc(priority.value)
+        return JSONResponse(
+            {'detail': 'The server is busy, try again later.'},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={'Retry-After': str(RETRY_AFTER_SECONDS[priority])},
+        )
+    if load_monitor.shedding and load < min(SHED_AT.values()):
+        log.info('Worker recovered (load %.2f), no longer shedding requests', load)
+        load_monitor.shedding = False
+
+    load_monitor.in_flight += 1
+    try:
+        return await call_next(request)
+    finally:
+        load_monitor.in_flight -= 1
@@ -0,0 +1,45 @@
+from collections.abc import AsyncIterator
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+
+from app.api.events import event_hub
+from app.api.security import cognito_scheme_or_anonymous
+from app.schemas.schemas_v1.user import User as CognitoUser
+
+router = APIRouter()
+
+# Milliseconds EventSource waits before reconnecting
+RETRY_FRAME = b'retry: 5000\n\n'
+
+
+async def event_stream(username: str | None) -> AsyncIterator[bytes]:
+    """
+    Frames for a client until it disconnects or the worker stops
+    """
+    subscriber = event_hub.subscribe(username)
+    try:
+        yield RETRY_FRAME
+        while frames := await subscriber.receive():
+            yield frames
+    finally:
+        event_hub.unsubscribe(subscriber)
+
+
+@router.get(
+    '/events',
+    response_class=StreamingResponse,
+    responses={200: {'content': {'text/event-stream': {}}, 'description': 'Server-sent video events'}},
+)
+async def video_events(user: CognitoUser | None = Depends(cognito_scheme_or_anonymous)) -> StreamingResponse:
+    """
+    Follow new, changed, deleted and liked videos as server-sent events, instead of polling `GET /files`.
+    Events are `video.created`, `video.updated`, `video.deleted` and `video.liked`, with the path, owner and
+    visibility of the video, and its `like_count` for likes. On `reset`, fetch the feed again, events were missed.
+    Your own hidden videos are included when signed in. See `app/api/events.py`.
+    """
+    return StreamingResponse(
+        event_stream(user.username if user else None),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
@@ -1,76 +1,117 @@
+import random
 from typing import Any
 
 from fastapi import APIRouter, Depends, HTTPException, status
-from pydantic import BaseModel
-from sqlalchemy import and_
-from sqlalchemy.orm import selectinload
+from pydantic import BaseModel, Field
+from sqlalchemy import and_, delete, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.api.dependencies import yield_db_session
+from app.api.events import publish
+from app.api.rate_limit import LIKE_LIMIT, rate_limited
 from app.api.security import cognito_signed_in
-from app.api.services import fetch_one_or_none_video
-from app.models.klepp import User, Video, VideoRead
+from app.models.klepp import User, Video, VideoLikeCount, VideoLikeLink
 
 router = APIRouter()
 
+# Concurrent likes of one video spread over this many counter rows
+LIKE_COUNT_SHARDS = 16
+
 
 class VideoLikeUnlike(BaseModel):
     path: str
 
 
-@router.post('/like', response_model=VideoRead, status_code=status.HTTP_201_CREATED)
+class LikeRead(BaseModel):
+    path: str
+    like_count: int = Field(..., description='Number of likes on the video')
+    liked_by_me: bool = Field(..., description='Whether the signed in user likes the video')
+
+
+async def count_like(path: str, change: int, db_session: AsyncSession) -> None:
+    """
+    Add `change` to a random shard of the like counter
+    """
+    statement = insert(VideoLikeCount).values(video_path=path, shard=random.randrange(LIKE_COUNT_SHARDS), count=change)
+    statement = statement.on_conflict_do_update(
+        index_elements=[VideoLikeCount.video_path, VideoLikeCount.shard],
+        set_={'count': VideoLikeCount.count + statement.excluded.count, 'updated_at': func.clock_timestamp()},
+    )
+    await db_session.exec(statement)
+
+
+async def like_count(path: str, db_session: AsyncSession) -> int:
+    """
+    Sum of the like counter shards of a video
+    """
+    statement = select(func.coalesce(func.sum(VideoLikeCount.count), 0)).where(VideoLikeCount.video_path == path)
+    return (await db_session.exec(statement)).one()
+
+
+@router.post(
+    '/like',
+    response_model=LikeRead,
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(rate_limited(LIKE_LIMIT))],
+)
 async def add_like(
     path: VideoLikeUnlike,
     user: User = Depends(cognito_signed_in),
     db_session: AsyncSession = Depends(yield_db_session),
 ) -> Any:
     """
-    Add a like to a video
+    Add a like to a video. Liking a video you already like does nothing.
     """
-    video_statement = select(Video).where(Video.path == path.path).options(selectinload(Video.likes))  # noqa
-    result = await db_session.exec(video_statement)  # type: ignore
-    video: Video | None = result.one_or_none()
-    if not video:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail='Video not found.',
-        )
-    video.likes.append(user)
-    db_session.add(video)
+    statement = (
+        insert(VideoLikeLink)
+        .values(video_path=path.path, user_id=user.id)
+        .on_conflict_do_nothing()
+        .returning(VideoLikeLink.video_path)  # type: ignore
+    )
+    try:
+        liked = (await db_session.exec(statement)).first()
+    except IntegrityError:
+        # The foreign key, there is no video with this path
+        await db_session.rollback()
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Video not found.') from None
+    if liked:
+        await count_like(path=path.path, change=1, db_session=db_session)
+    count = await like_count(path=path.path, db_session=db_session)
+    if liked:
+        await publish(db_session, 'video.liked', path=path.path, like_count=count)
     await db_session.commit()
-    await db_session.refresh(video)
-    return await fetch_one_or_none_video(video_path=video.path, db_session=db_session)
+    return {'path': path.path, 'like_count': count, 'liked_by_me': True}
 
 
-@router.delete('/like', response_model=VideoRead, status_code=status.HTTP_200_OK)
+@router.delete(
+    '/like',
+    response_model=LikeRead,
+    status_code=status.HTTP_200_OK,
+    dependencies=[Depends(rate_limited(LIKE_LIMIT))],
+)
 async def delete_like(
     path: VideoLikeUnlike,
     user: User = Depends(cognito_signed_in),
     db_session: AsyncSession = Depends(yield_db_session),
 ) -> Any:
     """
-    Remove like to a video
+    Remove like to a video. Removing a like that isn't there does nothing.
     """
-    video_statement = (
-        select(Video)
-        .where(
-            and_(
-                Video.path == path.path,
-                Video.likes.any(name=user.name),  # type: ignore
-            )
-        )
-        .options(selectinload(Video.likes))
+    statement = (
+        delete(VideoLikeLink)
+        .where(and_(VideoLikeLink.video_path == path.path, VideoLikeLink.user_id == user.id))
+        .returning(VideoLikeLink.video_path)  # type: ignore
     )
-    result = await db_session.exec(video_statement)  # type: ignore
-    video = result.one_or_none()
-    if not video:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail='Video not found.',
-        )
-    video.likes.remove(user)
-    db_session.add(video)
+    unliked = (await db_session.exec(statement)).first()
+    if unliked:
+        await count_like(path=path.path, change=-1, db_session=db_session)
+    elif not await db_session.get(Video, path.path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Video not found.')
+    count = await like_count(path=path.path, db_session=db_session)
+    if unliked:
+        await publish(db_session, 'video.liked', path=path.path, like_count=count)
     await db_session.commit()
-    await db_session.refresh(video)
-    return await fetch_one_or_none_video(video_path=video.path, db_session=db_session)
+    return {'path': path.path, 'like_count': count, 'liked_by_me': False}
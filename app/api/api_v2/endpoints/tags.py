@@ -1,28 +1,47 @@
+from enum import Enum
+
 from fastapi import APIRouter, Depends, Query
+from pydantic import BaseModel
 from sqlalchemy import desc, func
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from app.api.dependencies import yield_db_session
+from app.api.dependencies import yield_read_db_session
 from app.api.security import cognito_scheme_or_anonymous
-from app.models.klepp import ListResponse, Tag, TagRead
+from app.api.tag_index import tag_index
+from app.models.klepp import ListResponse, Tag, TagRead, TagStats
 
 router = APIRouter()
 
 
+class TagSort(str, Enum):
+    name = 'name'
+    videos = 'videos'
+
+
+# Every sort order matches an index, read backwards
+SORT_ORDER = {
+    TagSort.name: (desc(Tag.name),),
+    TagSort.videos: (desc(TagStats.video_count), desc(TagStats.tag_id)),
+}
+
+
 @router.get('/tags', response_model=ListResponse[TagRead], dependencies=[Depends(cognito_scheme_or_anonymous)])
 async def get_all_tags(
-    session: AsyncSession = Depends(yield_db_session),
+    session: AsyncSession = Depends(yield_read_db_session),
     offset: int = 0,
     limit: int = Query(default=100, lte=100),
+    sort: TagSort = Query(default=TagSort.name, description='`videos` puts the most used tags first'),
 ) -> dict[str, int | list]:
     """
-    Gets possible tags to use
+    Gets possible tags to use, with the number of videos using them
     """
     # Video query
-    tag_statement = select(Tag).order_by(desc(Tag.name))
+    tag_statement = (
+        select(Tag, TagStats.video_count).join(TagStats, TagStats.tag_id == Tag.id).order_by(*SORT_ORDER[sort])
+    )
     # Total count query based on query params, without pagination
-    count_statement = select(func.count('*')).select_from(tag_statement)  # type: ignore
+    count_statement = select(func.count('*')).select_from(Tag)
 
     # Add pagination
     tag_statement = tag_statement.offset(offset=offset).limit(limit=limit)
@@ -31,4 +50,22 @@ async def get_all_tags(
     results = await session.exec(tag_statement)  # type: ignore
     count = await session.exec(count_statement)
     count_number = count.one_or_none()
-    return {'total_count': count_number, 'response': results.all()}
+    tags = [{'name': tag.name, 'video_count': video_count} for tag, video_count in results.all()]
+    return {'total_count': count_number, 'response': tags}
+
+
+class TagSuggestion(BaseModel):
+    name: str
+    video_count: int
+
+
+@router.get('/tags/suggest', response_model=list[TagSuggestion], dependencies=[Depends(cognito_scheme_or_anonymous)])
+async def suggest_tags(
+    q: str = Query(..., min_length=1, max_length=40, description='Start of the tag name, case insensitive'),
+    limit: int = Query(default=10, ge=1, le=50),
+) -> list[dict[str, str | int]]:
+    """
+    Autocomplete tags, the ones used by the most videos first.
+    Served from an in-memory index that is refreshed every minute, so new tags can take a moment to show up.
+    """
+    return [{'name': tag.name, 'video_count': tag.video_count} for tag in tag_index.suggest(q, limit=limit)]
@@ -1,24 +1,39 @@
-import asyncio
-import functools
 from typing import Any
 from uuid import uuid4
 
-import aiofiles
 from aiobotocore.client import AioBaseClient
-from aiofiles import os
 from fastapi import APIRouter, Depends, File, HTTPException, UploadFile, status
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.api.dependencies import get_boto, yield_db_session
 from app.api.security import cognito_signed_in
-from app.api.services import await_ffmpeg, generate_user_thumbnail
+from app.api.services import (
+    ImageTooLarge,
+    InvalidImage,
+    create_profile_picture,
+    delete_s3_objects,
+    s3_key_from_uri,
+)
 from app.core.config import settings
 from app.models.klepp import User, UserRead
 
 router = APIRouter()
 
 
-@router.put('/user', response_model=UserRead, status_code=status.HTTP_201_CREATED)
+def user_thumbnail_keys(user: User) -> list[str]:
+    """
+    Every S3 key of the current profile thumbnail and its variants
+    """
+    uris = [user.thumbnail_uri] if user.thumbnail_uri else []
+    uris.extend(variant['uri'] for variant in user.thumbnail_variants or [])
+    return list({s3_key_from_uri(uri) for uri in uris})
+
+
+@router.put(
+    '/user',
+    response_model=UserRead,
+    status_code=status.HTTP_201_CREATED,
+)
 async def user_thumbnail(
     file: UploadFile = File(..., description='File to upload'),
     user: User = Depends(cognito_signed_in),
@@ -26,7 +41,7 @@ async def user_thumbnail(
     boto_session: AioBaseClient = Depends(get_boto),
 ) -> Any:
     """
-    Upload a profile thumbnail.
+    Upload a profile thumbnail. It is scaled in memory, and stored as square WebP variants with a JPEG fallback.
     This is behind a CDN, so it might take a little while for it to update
     """
     if not file:
@@ -35,41 +50,31 @@ async def user_thumbnail(
     if file.content_type not in allowed_formats:
         raise HTTPException(status_code=400, detail=f'Currently only support for {",".join(allowed_formats)}')
 
-    # Save thumbnail
-    temp_name = uuid4().hex
-    output_name = f'{temp_name}.jpg'
-    async with aiofiles.open(temp_name, 'wb') as img:
-        while content := await file.read(1024):
-            await img.write(content)
-    # Scale it
-    await await_ffmpeg(functools.partial(generate_user_thumbnail, temp_name, output_name))
-
-    # Upload thumbnail, delete original, delete old thumbnail in s3
-    profile_pic_path = f'{user.name}/profile/{output_name}'
-    async with aiofiles.open(output_name, 'rb+') as thumbnail_img:
-        await boto_session.put_object(
-            Bucket=settings.S3_BUCKET_URL,
-            Key=profile_pic_path,
-            Body=await thumbnail_img.read(),
-            ACL='public-read',
+    # Read it into memory, a byte over the limit is enough to know it's too large
+    data = await file.read(settings.PROFILE_PICTURE_MAX_BYTES + 1)
+    if len(data) > settings.PROFILE_PICTURE_MAX_BYTES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f'Profile pictures can be at most {settings.PROFILE_PICTURE_MAX_BYTES // (1024 * 1024)} MB.',
         )
-
-    # Cleanup
-    tasks = [
-        asyncio.create_task(os.remove(temp_name)),
-        asyncio.create_task(os.remove(output_name)),
-    ]
-    if user.thumbnail_uri:
-        tasks.append(
-            asyncio.create_task(
-                boto_session.delete_object(
-                    Bucket=settings.S3_BUCKET_URL, Key=user.thumbnail_uri.split('https://gg.klepp.me/')[1]
-                )
-            )
+    # Scale it to every variant and upload them
+    try:
+        thumbnails = await create_profile_picture(
+            boto_session=boto_session, data=data, prefix=f'{user.name}/profile/{uuid4().hex}/'
         )
-    await asyncio.gather(*tasks)
+    except ImageTooLarge:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'Profile pictures can be at most {settings.PROFILE_PICTURE_MAX_PIXELS:,} pixels.',
+        ) from None
+    except InvalidImage:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Unable to read the image.') from None
+
+    # Delete old thumbnails in s3
+    await delete_s3_objects(boto_session, user_thumbnail_keys(user))
 
-    user.thumbnail_uri = f'https://gg.klepp.me/{profile_pic_path}'
+    for key, value in thumbnails.items():
+        setattr(user, key, value)
     db_session.add(user)
     await db_session.commit()
     await db_session.refresh(user)
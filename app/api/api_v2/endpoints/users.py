@@ -1,34 +1,59 @@
+from enum import Enum
+
 from fastapi import APIRouter, Depends, Query
 from sqlalchemy import desc, func
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from app.api.dependencies import yield_db_session
+from app.api.dependencies import yield_read_db_session
 from app.api.security import cognito_scheme_or_anonymous
-from app.models.klepp import ListResponse, User, UserRead
+from app.models.klepp import ListResponse, User, UserRead, UserStats
 
 router = APIRouter()
 
 
+class UserSort(str, Enum):
+    name = 'name'
+    videos = 'videos'
+    likes = 'likes'
+
+
+# Every sort order matches an index, read backwards
+SORT_ORDER = {
+    UserSort.name: (desc(User.name),),
+    UserSort.videos: (desc(UserStats.video_count), desc(UserStats.user_id)),
+    UserSort.likes: (desc(UserStats.likes_received), desc(UserStats.user_id)),
+}
+
+
 @router.get('/users', response_model=ListResponse[UserRead], dependencies=[Depends(cognito_scheme_or_anonymous)])
 async def get_users(
-    session: AsyncSession = Depends(yield_db_session),
+    session: AsyncSession = Depends(yield_read_db_session),
     offset: int = 0,
     limit: int = Query(default=100, lte=100),
+    sort: UserSort = Query(default=UserSort.name, description='`videos` and `likes` put the most active users first'),
 ) -> dict[str, int | list]:
     """
-    Get a list of users
+    Get a list of users, with their number of videos and likes received
     """
     # User query
-    tag_statement = select(User).order_by(desc(User.name))
+    user_statement = (
+        select(User, UserStats.video_count, UserStats.likes_received)
+        .join(UserStats, UserStats.user_id == User.id)
+        .order_by(*SORT_ORDER[sort])
+    )
     # Total count query based on query params, without pagination
-    count_statement = select(func.count('*')).select_from(tag_statement)  # type: ignore
+    count_statement = select(func.count('*')).select_from(User)
 
     # Add pagination
-    tag_statement = tag_statement.offset(offset=offset).limit(limit=limit)
+    user_statement = user_statement.offset(offset=offset).limit(limit=limit)
 
     # Execute queries sequentially (SQLAlchemy 2.0 AsyncSession doesn't support concurrent operations)
-    results = await session.exec(tag_statement)  # type: ignore
+    results = await session.exec(user_statement)
     count = await session.exec(count_statement)
     count_number = count.one_or_none()
-    return {'total_count': count_number, 'response': results.all()}
+    users = [
+        {**user.model_dump(exclude={'placeholder'}), 'video_count': video_count, 'likes_received': likes_received}
+        for user, video_count, likes_received in results.all()
+    ]
+    return {'total_count': count_number, 'response': users}
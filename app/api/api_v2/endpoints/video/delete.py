@@ -6,8 +6,9 @@ from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.api.dependencies import get_boto, yield_db_session
+from app.api.events import publish
 from app.api.security import cognito_signed_in
-from app.core.config import settings
+from app.api.services import delete_s3_objects, delete_videos
 from app.models.klepp import User, Video
 
 router = APIRouter()
@@ -35,11 +36,13 @@ async def delete_file(
             status_code=status.HTTP_404_NOT_FOUND,
             detail='File not found. Ensure you own the file, and that the file already exist.',
         )
-    await boto_session.delete_object(Bucket=settings.S3_BUCKET_URL, Key=video.path)
-    if video.thumbnail_uri:
-        await boto_session.delete_object(
-            Bucket=settings.S3_BUCKET_URL, Key=video.thumbnail_uri.split('https://gg.klepp.me/')[1]
+    await publish(db_session, 'video.deleted', path=video.path)
+    # Objects shared with other videos through a blob are only returned once the last reference is gone
+    unused = await delete_videos(videos=[video], db_session=db_session)
+    if await delete_s3_objects(boto_session, await unused.list_keys(boto_session)):
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail='Unable to delete the file from storage, please try again.',
         )
-    await db_session.delete(video)
     await db_session.commit()
     return {'path': path.path}
@@ -0,0 +1,203 @@
+"""
+Export of the whole video catalog as NDJSON, for analytics and moderation jobs.
+
+Videos are read with a server-side cursor, `EXPORT_BATCH_SIZE` at a time, and every batch gets its tags and like
+counts in two queries, so memory stays the same however large the catalog is.
+
+With `since`, only what changed since then is exported: first a `VideoRemovedExport` for every video deleted or
+hidden from you, then every new, edited, tagged, liked or unliked video. Removals are kept for
+`EXPORT_TOMBSTONE_RETENTION_DAYS`, so an older `since` is refused and everything has to be exported again.
+
+Rows are stamped by triggers with `clock_timestamp()` when they are written, but only become visible when their
+transaction commits. So an export ends `EXPORT_COMMIT_LAG` ago at the latest, for a replica that is behind, and before
+the oldest transaction still writing began. The response has the `since` of the next export in `X-Export-Until`.
+"""
+
+from collections.abc import AsyncIterator
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
+from pydantic import AwareDatetime
+from sqlalchemy import and_, func, literal_column, or_, table
+from sqlmodel import Field, SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.api.dependencies import yield_db_session
+from app.api.replica import read_engine
+from app.api.security import cognito_scheme
+from app.core.config import settings
+from app.models.klepp import (
+    Tag,
+    User,
+    Video,
+    VideoBase,
+    VideoLikeCount,
+    VideoMetadata,
+    VideoTagLink,
+    VideoTombstone,
+)
+from app.schemas.schemas_v1.user import User as CognitoUser
+
+router = APIRouter()
+
+EXPORT_BATCH_SIZE = 500
+# Covers a read replica that is behind, transactions still writing are waited for on the primary
+EXPORT_COMMIT_LAG = timedelta(minutes=1)
+
+
+class VideoExport(VideoBase, VideoMetadata):
+    username: str
+    updated_at: datetime
+    thumbnail_uri: str | None = None
+    hls_uri: str | None = None
+    tags: list[str] = Field(default_factory=list)
+    like_count: int = 0
+
+
+class VideoRemovedExport(SQLModel):
+    path: str
+    username: str
+    updated_at: datetime = Field(..., description='When the video was removed')
+    removed: bool = Field(default=True, description='Deleted, or hidden from you')
+
+
+async def export_until(db_session: AsyncSession) -> datetime:
+    """
+    Where an export may end: `EXPORT_COMMIT_LAG` ago, or earlier when a transaction that may still write older stamps
+    is open. Needs a session to the primary, a replica doesn't know its transactions.
+    """
+    # Transactions get an id with their first write
+    statement = (
+        select(func.min(literal_column('xact_start')))
+        .select_from(table('pg_stat_activity'))
+        .where(literal_column('backend_xid').is_not(None))
+    )
+    oldest_write: datetime | None = (await db_session.exec(statement)).one()
+    until = datetime.now(timezone.utc) - EXPORT_COMMIT_LAG
+    return min(until, oldest_write) if oldest_write else until
+
+
+def tombstone_statement(username: str | None, since: datetime, until: datetime) -> Any:
+    """
+    Videos removed from the export of `username`, or deleted from the whole catalog without a `username`
+    """
+    statement = (
+        select(VideoTombstone.path, User.name, VideoTombstone.removed_at)
+        .join(User, User.id == VideoTombstone.user_id)
+        .where(VideoTombstone.removed_at > since, VideoTombstone.removed_at <= until)
+        .order_by(VideoTombstone.removed_at, VideoTombstone.path)
+    )
+    if username is None:
+        # Hidden videos are still in the catalog
+        return statement.where(VideoTombstone.deleted == True)  # noqa: E712
+    return statement.where(
+        or_(
+            and_(VideoTombstone.deleted == True, VideoTombstone.hidden == False),  # noqa: E712
+            and_(VideoTombstone.deleted == True, User.name == username),  # noqa: E712
+            and_(VideoTombstone.deleted == False, User.name != username),  # noqa: E712
+        )
+    )
+
+
+async def export_lines(
+    db_session: AsyncSession, username: str | None, since: datetime | None, until: datetime
+) -> AsyncIterator[str]:
+    """
+    One JSON line per video visible to `username`, oldest change first, or for every video without a `username`.
+    With `since`, removed videos come first. Closes the session when done.
+    """
+    statement = (
+        select(Video, User.name)
+        .join(User, User.id == Video.user_id)
+        .order_by(Video.updated_at, Video.path)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    if username is not None:
+        statement = statement.where(or_(Video.hidden == False, User.name == username))  # noqa: E712
+    if since is not None:
+        # Likes and unlikes only stamp a shard of the like counter
+        liked = select(VideoLikeCount.video_path).where(
+            VideoLikeCount.updated_at > since,  # type: ignore
+            VideoLikeCount.updated_at <= until,  # type: ignore
+        )
+        statement = statement.where(
+            or_(
+                and_(Video.updated_at > since, Video.updated_at <= until),  # type: ignore
+                Video.path.in_(liked),  # type: ignore
+            )
+        )
+
+    try:
+        if since is not None:
+            removed = await db_session.stream(tombstone_statement(username=username, since=since, until=until))
+            async for batch in removed.partitions(EXPORT_BATCH_SIZE):
+                yield ''.join(
+                    VideoRemovedExport(path=path, username=name, updated_at=removed_at).model_dump_json() + '\n'
+                    for path, name, removed_at in batch
+                )
+
+        result = await db_session.stream(statement)
+        async for batch in result.partitions():
+            paths = [video.path for video, _ in batch]
+            tag_rows = await db_session.exec(
+                select(VideoTagLink.video_path, Tag.name)
+                .join(Tag, Tag.id == VideoTagLink.tag_id)
+                .where(VideoTagLink.video_path.in_(paths))  # type: ignore
+            )
+            tags: dict[str, list[str]] = {}
+            for path, tag in tag_rows:
+                tags.setdefault(path, []).append(tag)
+            like_rows = await db_session.exec(
+                select(VideoLikeCount.video_path, func.sum(VideoLikeCount.count))
+                .where(VideoLikeCount.video_path.in_(paths))  # type: ignore
+                .group_by(VideoLikeCount.video_path)
+            )
+            likes = dict(like_rows.all())
+
+            yield ''.join(
+                VideoExport.model_validate(
+                    {
+                        **video.model_dump(),
+                        'username': name,
+                        'tags': tags.get(video.path, []),
+                        'like_count': likes.get(video.path, 0),
+                    }
+                ).model_dump_json()
+                + '\n'
+                for video, name in batch
+            )
+    finally:
+        await db_session.close()
+
+
+@router.get(
+    '/files/export',
+    response_class=StreamingResponse,
+    responses={200: {'content': {'application/x-ndjson': {}}, 'description': 'One `VideoExport` per line'}},
+)
+async def export_files(
+    request: Request,
+    user: CognitoUser = Depends(cognito_scheme),
+    primary_session: AsyncSession = Depends(yield_db_session),
+    since: AwareDatetime | None = Query(default=None, description='`X-Export-Until` of the previous export'),
+) -> StreamingResponse:
+    """
+    Stream every video you can see, with tags and like counts, as NDJSON.
+    With `since`, only videos changed since then, after a line for every video removed since then.
+    See `app/api/api_v2/endpoints/video/export.py`.
+    """
+    oldest = datetime.now(timezone.utc) - timedelta(days=settings.EXPORT_TOMBSTONE_RETENTION_DAYS)
+    if since is not None and since < oldest:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='since is older than removed videos are kept, export everything again.',
+        )
+    until = await export_until(primary_session)
+    db_session = AsyncSession(read_engine(request), expire_on_commit=False)
+    return StreamingResponse(
+        export_lines(db_session, username=user.username, since=since, until=until),
+        media_type='application/x-ndjson',
+        headers={'X-Export-Until': until.isoformat()},
+    )
@@ -1,25 +1,69 @@
-from fastapi import APIRouter, Depends, Query
-from sqlalchemy import and_, desc, func, or_
+import base64
+import json
+from enum import Enum
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import and_, asc, desc, func, or_, tuple_
 from sqlalchemy.orm import selectinload
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from app.api.dependencies import yield_db_session
+from app.api.dependencies import yield_read_db_session
 from app.api.security import cognito_scheme_or_anonymous
-from app.models.klepp import ListResponse, Video, VideoRead
+from app.models.klepp import ListResponse, User, Video, VideoRead, VideoTrending
 from app.schemas.schemas_v1.user import User as CognitoUser
 
 router = APIRouter()
 
 
+class VideoSort(str, Enum):
+    newest = 'newest'
+    shortest = 'shortest'
+    longest = 'longest'
+    trending = 'trending'
+
+
+SORT_ORDER = {
+    VideoSort.newest: (desc(Video.uploaded_at),),
+    # In the order of `ix_video_duration` and `ix_video_duration_desc`
+    VideoSort.shortest: (asc(Video.duration).nulls_last(), desc(Video.uploaded_at)),
+    VideoSort.longest: (desc(Video.duration).nulls_last(), desc(Video.uploaded_at)),
+    # Precomputed by `app/jobs/trending.py`, read backwards through `ix_videotrending_score`
+    VideoSort.trending: (desc(VideoTrending.score), desc(VideoTrending.video_path)),
+}
+
+
+def encode_cursor(score: float, path: str) -> str:
+    """
+    Opaque keyset position of a trending video
+    """
+    return base64.urlsafe_b64encode(json.dumps([score, path]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[float, str]:
+    """
+    Keyset position from `encode_cursor`
+    """
+    try:
+        score, path = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), str(path)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor.') from None
+
+
 @router.get('/files', response_model=ListResponse[VideoRead])
 async def get_all_files(
-    session: AsyncSession = Depends(yield_db_session),
+    session: AsyncSession = Depends(yield_read_db_session),
     user: CognitoUser | None = Depends(cognito_scheme_or_anonymous),
     username: str | None = None,
     name: str | None = None,
     hidden: bool | None = None,
     tag: list[str] = Query(default=[]),
+    min_duration: float | None = Query(default=None, ge=0, description='Seconds'),
+    max_duration: float | None = Query(default=None, ge=0, description='Seconds'),
+    min_height: int | None = Query(default=None, ge=0, description='E.g. 2160 for 4K only'),
+    sort: VideoSort = VideoSort.newest,
+    cursor: str | None = Query(default=None, description='`next_cursor` of the previous page, for `sort=trending`'),
     offset: int = 0,
     limit: int = Query(default=100, lte=100),
 ) -> dict[str, int | list]:
@@ -27,15 +71,22 @@ async def get_all_files(
     Get a list of all non-hidden files, unless you're the owner of the file, then you can request
     hidden files.
     Works both as anonymous user and as a signed-in user.
+    `sort=trending` only has recently liked videos, and pages with `cursor` instead of `offset`.
     """
-    # Video query
+    # Video query. Two entities make a tuple select, so trending rows are `(video, score)` instead of only videos.
+    trending = sort == VideoSort.trending
     video_statement = (
-        select(Video)
+        (select(Video, VideoTrending.score) if trending else select(Video))
         .options(selectinload(Video.user))
         .options(selectinload(Video.tags))
-        .options(selectinload(Video.likes))
-        .order_by(desc(Video.uploaded_at))
+        .options(selectinload(Video.likes).load_only(User.name, User.thumbnail_uri))
+        .order_by(*SORT_ORDER[sort])
     )
+    if trending:
+        video_statement = video_statement.join(
+            VideoTrending,
+            VideoTrending.video_path == Video.path,
+        )
     if username:
         video_statement = video_statement.where(Video.user.has(name=username))  # type: ignore
     if name:
@@ -61,14 +112,36 @@ async def get_all_files(
     if tag:
         video_statement = video_statement.where(or_(Video.tags.any(name=t) for t in tag))  # type: ignore
 
+    # Metadata filters are served by `ix_video_duration` and `ix_video_height`
+    if min_duration is not None:
+        video_statement = video_statement.where(Video.duration >= min_duration)  # type: ignore
+    if max_duration is not None:
+        video_statement = video_statement.where(Video.duration <= max_duration)  # type: ignore
+    if min_height is not None:
+        video_statement = video_statement.where(Video.height >= min_height)  # type: ignore
+
     # Total count query based on query params, without pagination
     count_statement = select(func.count('*')).select_from(video_statement)  # type: ignore
 
     # Add pagination
-    video_statement = video_statement.offset(offset=offset).limit(limit=limit)
+    if trending and cursor:
+        video_statement = video_statement.where(
+            tuple_(VideoTrending.score, VideoTrending.video_path) < decode_cursor(cursor)
+        )
+    elif offset:
+        video_statement = video_statement.offset(offset=offset)
+    video_statement = video_statement.limit(limit=limit)
 
     # Execute queries sequentially (SQLAlchemy 2.0 AsyncSession doesn't support concurrent operations)
     results = await session.exec(video_statement)  # type: ignore
     count = await session.exec(count_statement)
     count_number = count.one_or_none()
-    return {'total_count': count_number, 'response': results.all()}
+    if not trending:
+        return {'total_count': count_number, 'response': results.all()}
+
+    rows: list[tuple[Video, float]] = [(video, score) for video, score in results.all()]
+    next_cursor = None
+    if len(rows) == limit:
+        last_video, last_score = rows[-1]
+        next_cursor = encode_cursor(last_score, last_video.path)
+    return {'total_count': count_number, 'response': [video for video, _ in rows], 'next_cursor': next_cursor}
@@ -8,8 +8,10 @@ from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.api.dependencies import yield_db_session
+from app.api.events import publish
 from app.api.security import cognito_signed_in
 from app.api.services import fetch_one_or_none_video
+from app.api.tag_index import tag_index
 from app.models.klepp import Tag, TagBase, User, Video, VideoRead
 
 router = APIRouter()
@@ -61,12 +63,16 @@ async def patch_video(
             )
         video.tags = tags
         excluded.pop('tags')
+        # Video counts per tag changed
+        tag_index.invalidate()
 
     # Patch remaining attributes
+    was_hidden = video.hidden
     for key, value in excluded.items():
         setattr(video, key, value)
 
     db_session.add(video)
+    await publish(db_session, 'video.updated', path=video.path, was_hidden=was_hidden)
     await db_session.commit()
 
     return await fetch_one_or_none_video(video_path=video_patch.path, db_session=db_session)
@@ -0,0 +1,366 @@
+"""
+Resumable uploads, modelled after tus.
+
+1. `POST /uploads` with the total length creates an upload, and an S3 multipart upload behind it.
+2. `PATCH /uploads/{id}` sends the next chunk at `Upload-Offset`. Every chunk is stored as one multipart part,
+   so all chunks but the last must be exactly `part_size` bytes.
+3. `HEAD /uploads/{id}` returns the current `Upload-Offset`, to resume after a dropped connection.
+4. `POST /uploads/{id}/complete` answers 202 right away, and assembles the parts and creates the video in the
+   background, like `POST /files` would. Downloading and hashing gigabytes takes longer than a request may.
+5. `GET /uploads/{id}` while `completing`. Once the video exists the upload is gone, and answers 404. When creating
+   the video failed, `error` says why, and completing again retries.
+
+All state lives in the database and S3, so every request can go to any worker. The upload row is locked while it is
+marked as completing, so a second `complete` gets a 409 instead of racing the first one.
+"""
+
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any
+from uuid import UUID, uuid4
+
+from aiobotocore.client import AioBaseClient
+from aiofiles import os
+from botocore.exceptions import ClientError
+from fastapi import APIRouter, BackgroundTasks, Depends, Header, HTTPException, Request, Response, status
+from pydantic import BaseModel, Field
+from sqlalchemy import and_, update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.api.api_v2.endpoints.video.upload import hash_file, store_video
+from app.api.dependencies import get_boto, s3_client, yield_db_session
+from app.api.events import publish
+from app.api.rate_limit import UPLOAD_LIMIT, rate_limited
+from app.api.security import cognito_signed_in
+from app.api.services import (
+    abort_staged_upload,
+    download_object,
+    process_media,
+    upload_staging_key,
+)
+from app.core.config import settings
+from app.core.db import ASYNC_ENGINE
+from app.models.klepp import Upload, User, Video
+
+log = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+class UploadCreate(BaseModel):
+    file_name: str = Field(..., examples=['my_file'], pattern=r'^[\s\w\d_-]*$', min_length=2, max_length=40)
+    length: int = Field(..., gt=0, le=settings.UPLOAD_MAX_BYTES, description='Total size of the file in bytes')
+
+
+class UploadRead(BaseModel):
+    id: UUID
+    offset: int = Field(..., description='Bytes received so far, send the next chunk from here')
+    length: int
+    part_size: int = Field(..., description='Size of every chunk, except the last one')
+    path: str = Field(..., description='Path of the video the upload creates')
+    completing: bool = Field(..., description='Whether the video is being created, poll until the upload is gone')
+    error: str | None = Field(default=None, description='Why creating the video failed, complete again to retry')
+
+
+def is_completing(upload: Upload) -> bool:
+    """
+    Whether the video is being created from the upload right now
+    """
+    # A completion running longer is assumed to have died with its worker, and may be started again
+    started_after = datetime.now(timezone.utc) - timedelta(hours=settings.UPLOAD_COMPLETE_TIMEOUT_HOURS)
+    return upload.completing_at is not None and upload.completing_at > started_after
+
+
+def upload_read(upload: Upload) -> UploadRead:
+    """
+    Public representation of an upload
+    """
+    return UploadRead(
+        id=upload.id,
+        offset=upload.offset,
+        length=upload.length,
+        part_size=settings.UPLOAD_PART_SIZE,
+        path=upload.path,
+        completing=is_completing(upload),
+        error=upload.error,
+    )
+
+
+def offset_headers(upload: Upload) -> dict[str, str]:
+    """
+    tus style headers describing the progress of an upload
+    """
+    return {'Upload-Offset': str(upload.offset), 'Upload-Length': str(upload.length), 'Cache-Control': 'no-store'}
+
+
+async def get_upload(upload_id: UUID, user: User, db_session: AsyncSession, for_update: bool = False) -> Upload:
+    """
+    Fetch an upload owned by the user, or 404. With `for_update`, the row stays locked until the transaction ends.
+    """
+    upload_statement = select(Upload).where(and_(Upload.id == upload_id, Upload.user_id == user.id))
+    if for_update:
+        upload_statement = upload_statement.with_for_update()
+    upload = (await db_session.exec(upload_statement)).one_or_none()
+    if not upload:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Upload not found. Ensure you started it, and that it has not expired.',
+        )
+    return upload
+
+
+@router.post(
+    '/uploads',
+    response_model=UploadRead,
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(rate_limited(UPLOAD_LIMIT))],
+)
+async def create_upload(
+    upload_create: UploadCreate,
+    response: Response,
+    boto_session: AioBaseClient = Depends(get_boto),
+    user: User = Depends(cognito_signed_in),
+    db_session: AsyncSession = Depends(yield_db_session),
+) -> Any:
+    """
+    Start a resumable upload of a video/mp4 file.
+    """
+    path = f'{user.name}/{upload_create.file_name}.mp4'
+    if await db_session.get(Video, path):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Video already exist.')
+
+    upload_id = uuid4()
+    multipart = await boto_session.create_multipart_upload(
+        Bucket=settings.S3_BUCKET_URL, Key=upload_staging_key(upload_id), ContentType='video/mp4'
+    )
+    upload = Upload(
+        id=upload_id,
+        user_id=user.id,
+        path=path,
+        display_name=upload_create.file_name,
+        length=upload_create.length,
+        s3_upload_id=multipart['UploadId'],
+    )
+    db_session.add(upload)
+    await db_session.commit()
+
+    response.headers['Location'] = f'{settings.API_V2_STR}/uploads/{upload_id}'
+    response.headers.update(offset_headers(upload))
+    return upload_read(upload)
+
+
+@router.head('/uploads/{upload_id}')
+async def upload_offset(
+    upload_id: UUID,
+    user: User = Depends(cognito_signed_in),
+    db_session: AsyncSession = Depends(yield_db_session),
+) -> Response:
+    """
+    Current offset of an upload, resume from here
+    """
+    upload = await get_upload(upload_id=upload_id, user=user, db_session=db_session)
+    return Response(status_code=status.HTTP_200_OK, headers=offset_headers(upload))
+
+
+@router.get('/uploads/{upload_id}', response_model=UploadRead)
+async def get_upload_status(
+    upload_id: UUID,
+    response: Response,
+    user: User = Depends(cognito_signed_in),
+    db_session: AsyncSession = Depends(yield_db_session),
+) -> Any:
+    """
+    Progress of an upload, and whether its video is still being created. Gone once the video exists.
+    """
+    upload = await get_upload(upload_id=upload_id, user=user, db_session=db_session)
+    response.headers.update(offset_headers(upload))
+    return upload_read(upload)
+
+
+@router.patch('/uploads/{upload_id}', status_code=status.HTTP_204_NO_CONTENT)
+async def upload_chunk(
+    upload_id: UUID,
+    request: Request,
+    offset: int = Header(..., alias='Upload-Offset', ge=0),
+    boto_session: AioBaseClient = Depends(get_boto),
+    user: User = Depends(cognito_signed_in),
+    db_session: AsyncSession = Depends(yield_db_session),
+) -> Response:
+    """
+    Upload the next chunk of a file, starting at `Upload-Offset`.
+    Every chunk but the last must be exactly `part_size` bytes.
+    """
+    upload = await get_upload(upload_id=upload_id, user=user, db_session=db_session)
+    if offset != upload.offset:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f'Upload-Offset must be {upload.offset}.',
+            headers=offset_headers(upload),
+        )
+    expected = min(settings.UPLOAD_PART_SIZE, upload.length - upload.offset)
+    if expected == 0:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Upload is already complete.')
+
+    chunk = bytearray()
+    async for content in request.stream():
+        chunk.extend(content)
+        if len(chunk) > expected:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f'Chunk must be {expected} bytes.'
+            )
+    if len(chunk) != expected:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'Chunk must be {expected} bytes.')
+
+    # Uploading a part number again replaces it, so a retried chunk is harmless
+    part_number = upload.offset // settings.UPLOAD_PART_SIZE + 1
+    part = await boto_session.upload_part(
+        Bucket=settings.S3_BUCKET_URL,
+        Key=upload_staging_key(upload.id),
+        UploadId=upload.s3_upload_id,
+        PartNumber=part_number,
+        Body=bytes(chunk),
+    )
+    # Only move forward from the offset we checked, a concurrent request for the same chunk loses
+    advanced = await db_session.exec(
+        update(Upload)  # type: ignore
+        .where(and_(Upload.id == upload.id, Upload.offset == upload.offset))
+        .values(
+            offset=upload.offset + len(chunk),
+            parts=[*upload.parts, {'PartNumber': part_number, 'ETag': part['ETag']}],
+        )
+        .returning(Upload.offset)
+    )
+    new_offset = advanced.scalar_one_or_none()
+    await db_session.commit()
+    if new_offset is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Chunk was uploaded concurrently.')
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers={'Upload-Offset': str(new_offset)})
+
+
+async def create_video_from_upload(boto_session: AioBaseClient, db_session: AsyncSession, upload: Upload) -> None:
+    """
+    Assemble the parts of an upload, create its video and delete the upload. Hands new bytes to the media pipeline.
+    """
+    if await db_session.get(Video, upload.path):
+        raise FileExistsError('Video already exist.')
+    staging_key = upload_staging_key(upload.id)
+    try:
+        await boto_session.complete_multipart_upload(
+            Bucket=settings.S3_BUCKET_URL,
+            Key=staging_key,
+            UploadId=upload.s3_upload_id,
+            MultipartUpload={'Parts': upload.parts},
+        )
+    except ClientError as error:
+        # Already assembled by a previous attempt that failed later on
+        if error.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+            raise
+
+    user = await db_session.get(User, upload.user_id)
+    temp_video_name = f'{uuid4().hex}.mp4'
+    handed_to_media_pipeline = False
+    try:
+        await download_object(boto_session, key=staging_key, name=temp_video_name)
+        sha256, size = await hash_file(temp_video_name)
+        db_video, probe = await store_video(
+            boto_session=boto_session,
+            db_session=db_session,
+            user=user,
+            path=upload.path,
+            display_name=upload.display_name,
+            temp_video_name=temp_video_name,
+            sha256=sha256,
+            size=size,
+        )
+        await db_session.delete(upload)
+        await publish(db_session, 'video.created', path=db_video.path)
+        await db_session.commit()
+        await boto_session.delete_object(Bucket=settings.S3_BUCKET_URL, Key=staging_key)
+        if probe is not None:
+            # The media pipeline owns the temp file from here on
+            handed_to_media_pipeline = True
+            await process_media(sha256=sha256, temp_video_name=temp_video_name, probe=probe)
+    finally:
+        if not handed_to_media_pipeline and await os.path.exists(temp_video_name):
+            await os.remove(temp_video_name)
+
+
+async def finish_upload(upload_id: UUID) -> None:
+    """
+    Background task creating the video of a completing upload. Failures are stored on the upload for the client.
+    """
+    async with s3_client() as boto_session, AsyncSession(ASYNC_ENGINE, expire_on_commit=False) as db_session:
+        upload = await db_session.get(Upload, upload_id)
+        if upload is None:
+            return
+        try:
+            await create_video_from_upload(boto_session, db_session, upload)
+            log.info('Created video %s from upload %s', upload.path, upload_id)
+        except Exception as error:
+            log.exception('Unable to create a video from upload %s. Error: %s', upload_id, error)
+            await db_session.rollback()
+            await db_session.exec(
+                update(Upload)
+                .where(Upload.id == upload_id)
+                .values(
+                    completing_at=None,
+                    error=str(error)
+                    if isinstance(error, FileExistsError)
+                    else 'Unable to create the video, please complete the upload again.',
+                )
+            )
+            await db_session.commit()
+
+
+@router.post('/uploads/{upload_id}/complete', response_model=UploadRead, status_code=status.HTTP_202_ACCEPTED)
+async def complete_upload(
+    upload_id: UUID,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    user: User = Depends(cognito_signed_in),
+    db_session: AsyncSession = Depends(yield_db_session),
+) -> Any:
+    """
+    Create the video from a fully received upload, exactly like `POST /files` would, in the background.
+    Poll `GET /uploads/{id}` until it is gone, then the video exists at `path`.
+    """
+    upload = await get_upload(upload_id=upload_id, user=user, db_session=db_session, for_update=True)
+    if upload.offset != upload.length:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f'Upload is incomplete, {upload.offset} of {upload.length} bytes received.',
+            headers=offset_headers(upload),
+        )
+    if is_completing(upload):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Upload is already being completed.')
+    if await db_session.get(Video, upload.path):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Video already exist.')
+
+    upload.completing_at = datetime.now(timezone.utc)
+    upload.error = None
+    db_session.add(upload)
+    await db_session.commit()
+    background_tasks.add_task(finish_upload, upload_id=upload.id)
+
+    response.headers['Location'] = f'{settings.API_V2_STR}/uploads/{upload.id}'
+    return upload_read(upload)
+
+
+@router.delete('/uploads/{upload_id}', status_code=status.HTTP_204_NO_CONTENT)
+async def abort_upload(
+    upload_id: UUID,
+    boto_session: AioBaseClient = Depends(get_boto),
+    user: User = Depends(cognito_signed_in),
+    db_session: AsyncSession = Depends(yield_db_session),
+) -> Response:
+    """
+    Abort an upload, and throw away the chunks received so far
+    """
+    upload = await get_upload(upload_id=upload_id, user=user, db_session=db_session, for_update=True)
+    if is_completing(upload):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Upload is being completed.')
+    await abort_staged_upload(boto_session, upload)
+    await db_session.delete(upload)
+    await db_session.commit()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
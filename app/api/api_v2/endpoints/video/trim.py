@@ -0,0 +1,110 @@
+import functools
+from typing import Any
+from uuid import uuid4
+
+from aiobotocore.client import AioBaseClient
+from aiofiles import os
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
+from pydantic import BaseModel, Field, model_validator
+from sqlalchemy import and_
+from sqlalchemy.orm import selectinload
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.api.api_v2.endpoints.video.upload import hash_file, store_video
+from app.api.dependencies import get_boto, yield_db_session
+from app.api.events import publish
+from app.api.security import cognito_signed_in
+from app.api.services import await_ffmpeg, fetch_one_or_none_video, generate_trim, process_media
+from app.api.tag_index import tag_index
+from app.models.klepp import User, Video, VideoRead
+
+router = APIRouter()
+
+
+class VideoTrim(BaseModel):
+    path: str = Field(..., description='Video to cut the clip from')
+    start: float = Field(..., ge=0, description='Start of the clip in seconds, snapped to the keyframe before it')
+    end: float = Field(..., gt=0, description='End of the clip in seconds')
+    file_name: str | None = Field(
+        default=None, examples=['my_clip'], pattern=r'^[\s\w\d_-]*$', min_length=2, max_length=40
+    )
+
+    @model_validator(mode='after')
+    def end_after_start(self) -> 'VideoTrim':
+        """
+        A clip needs a positive length
+        """
+        if self.end <= self.start:
+            raise ValueError('`end` must be after `start`')
+        return self
+
+
+@router.post(
+    '/files/trim',
+    response_model=VideoRead,
+    status_code=status.HTTP_201_CREATED,
+)
+async def trim_video(
+    video_trim: VideoTrim,
+    background_tasks: BackgroundTasks,
+    boto_session: AioBaseClient = Depends(get_boto),
+    user: User = Depends(cognito_signed_in),
+    db_session: AsyncSession = Depends(yield_db_session),
+) -> Any:
+    """
+    Create a new video from a part of one of your videos, keeping its tags.
+    The clip is cut at keyframes with stream copy, so it is never re-encoded and can start slightly before `start`.
+    """
+    query_video = (
+        select(Video)
+        .where(and_(Video.path == video_trim.path, Video.user_id == user.id))
+        .options(selectinload(Video.tags))
+    )
+    source = (await db_session.exec(query_video)).one_or_none()
+    if not source:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='File not found. Ensure you own the file, and that the file already exist.',
+        )
+    if source.duration is not None and video_trim.start >= source.duration:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='`start` is after the end of the video.')
+
+    display_name = video_trim.file_name or f'{source.display_name}_{int(video_trim.start)}-{int(video_trim.end)}'
+    s3_path = f'{user.name}/{display_name}.mp4'
+    if await db_session.get(Video, s3_path):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Video already exist.')
+
+    # Cut through the CDN, which only serves the byte ranges ffmpeg asks for
+    temp_video_name = f'{uuid4().hex}.mp4'
+    handed_to_media_pipeline = False
+    try:
+        await await_ffmpeg(
+            functools.partial(generate_trim, source.uri, temp_video_name, video_trim.start, video_trim.end)
+        )
+        sha256, size = await hash_file(temp_video_name)
+        db_video, probe = await store_video(
+            boto_session=boto_session,
+            db_session=db_session,
+            user=user,
+            path=s3_path,
+            display_name=display_name,
+            temp_video_name=temp_video_name,
+            sha256=sha256,
+            size=size,
+        )
+        db_video.hidden = source.hidden
+        db_video.tags = list(source.tags)
+        await publish(db_session, 'video.created', path=db_video.path)
+        await db_session.commit()
+        if source.tags:
+            tag_index.invalidate()
+        if probe is not None:
+            # The media pipeline owns the temp file from here on
+            background_tasks.add_task(process_media, sha256=sha256, temp_video_name=temp_video_name, probe=probe)
+            handed_to_media_pipeline = True
+    finally:
+        if not handed_to_media_pipeline and await os.path.exists(temp_video_name):
+            await os.remove(temp_video_name)
+
+    return await fetch_one_or_none_video(video_path=db_video.path, db_session=db_session)
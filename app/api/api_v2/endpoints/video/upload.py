@@ -1,38 +1,158 @@
 import asyncio
-import functools
+import hashlib
 from typing import Any
 from uuid import uuid4
 
 import aiofiles
 from aiobotocore.client import AioBaseClient
 from aiofiles import os
-from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile, status
+from fastapi import APIRouter, BackgroundTasks, Depends, File, Form, HTTPException, UploadFile, status
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.api.dependencies import get_boto, yield_db_session
+from app.api.events import publish
 from app.api.security import cognito_signed_in
-from app.api.services import await_ffmpeg, fetch_one_or_none_video, generate_video_thumbnail
+from app.api.services import (
+    VIDEO_THUMBNAIL_WIDTHS,
+    acquire_existing_blob,
+    acquire_new_blob,
+    blob_key,
+    blob_thumbnails_prefix,
+    create_thumbnails,
+    faststart_file,
+    fetch_one_or_none_video,
+    probe_video,
+    process_media,
+    shared_media_fields,
+    video_metadata,
+)
 from app.core.config import settings
+from app.core.tracing import span
 from app.models.klepp import User, Video, VideoRead
 
 router = APIRouter()
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+async def save_upload(file: UploadFile, temp_video_name: str) -> tuple[str, int]:
+    """
+    Write an upload to disk, hashing it while streaming. Returns the SHA-256 hex digest and the size in bytes.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    with span('file.write', file=temp_video_name) as write_span:
+        async with aiofiles.open(temp_video_name, 'wb') as video:
+            while content := await file.read(UPLOAD_CHUNK_SIZE):
+                sha256.update(content)
+                size += len(content)
+                await video.write(content)
+        if write_span is not None:
+            write_span.set(bytes=size)
+    return sha256.hexdigest(), size
+
+
+async def hash_file(temp_video_name: str) -> tuple[str, int]:
+    """
+    Hash a file on disk. Returns the SHA-256 hex digest and the size in bytes.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    with span('file.read', file=temp_video_name) as read_span:
+        async with aiofiles.open(temp_video_name, 'rb') as video:
+            while content := await video.read(UPLOAD_CHUNK_SIZE):
+                sha256.update(content)
+                size += len(content)
+        if read_span is not None:
+            read_span.set(bytes=size)
+    return sha256.hexdigest(), size
+
 
 async def upload_video(boto_session: AioBaseClient, path: str, temp_video_name: str) -> None:
     """
     Upload a stored file to s3
     """
     async with aiofiles.open(temp_video_name, 'rb+') as video_file:
+        with span('file.read', file=temp_video_name):
+            body = await video_file.read()
         await boto_session.put_object(
             Bucket=settings.S3_BUCKET_URL,
             Key=path,
-            Body=await video_file.read(),
+            Body=body,
             ACL='public-read',
         )
 
 
-@router.post('/files', response_model=VideoRead, status_code=status.HTTP_201_CREATED)
+async def upload_faststart_video(boto_session: AioBaseClient, path: str, temp_video_name: str) -> bool:
+    """
+    Upload a stored file to s3, remuxed with `moov` first if needed. Returns whether the object is faststart.
+    """
+    remuxed_name, faststart = await faststart_file(temp_video_name)
+    try:
+        await upload_video(boto_session=boto_session, path=path, temp_video_name=remuxed_name or temp_video_name)
+    finally:
+        if remuxed_name:
+            await os.remove(remuxed_name)
+    return faststart
+
+
+async def store_video(
+    boto_session: AioBaseClient,
+    db_session: AsyncSession,
+    user: User,
+    path: str,
+    display_name: str,
+    temp_video_name: str,
+    sha256: str,
+    size: int,
+) -> tuple[Video, dict[str, Any] | None]:
+    """
+    Create a video from a file on disk. If we already store the same bytes, the new video points to the existing
+    blob, thumbnails and media, otherwise the video and new thumbnails are uploaded content addressed.
+    Returns the video, and for new bytes the ffprobe result to hand to the media pipeline.
+    The caller is responsible for committing, and for removing `temp_video_name`.
+    """
+    media_fields: dict[str, Any] = {}
+    probe = None
+    if not await acquire_existing_blob(sha256=sha256, db_session=db_session):
+        # Upload video, generate thumbnails and probe the metadata
+        upload_task = asyncio.create_task(
+            upload_faststart_video(boto_session=boto_session, path=blob_key(sha256), temp_video_name=temp_video_name)
+        )
+        thumbnail_task = asyncio.create_task(
+            create_thumbnails(
+                boto_session=boto_session,
+                path=temp_video_name,
+                prefix=blob_thumbnails_prefix(sha256),
+                widths=VIDEO_THUMBNAIL_WIDTHS,
+            )
+        )
+        faststart, thumbnails, probe = await asyncio.gather(upload_task, thumbnail_task, probe_video(temp_video_name))
+        media_fields = {'faststart': faststart, **thumbnails, **video_metadata(probe)}
+        await acquire_new_blob(sha256=sha256, size=size, db_session=db_session)
+    else:
+        media_fields = await shared_media_fields(sha256=sha256, db_session=db_session)
+
+    db_video: Video = Video(
+        path=path,
+        display_name=display_name,
+        user=user,
+        user_id=user.id,
+        uri=f'https://gg.klepp.me/{blob_key(sha256)}',
+        blob_sha256=sha256,
+        **media_fields,
+    )
+    db_session.add(db_video)
+    return db_video, probe
+
+
+@router.post(
+    '/files',
+    response_model=VideoRead,
+    status_code=status.HTTP_201_CREATED,
+)
 async def upload_file(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(..., description='File to upload'),
     file_name: str | None = Form(
         default=None, example='my_file', pattern=r'^[\s\w\d_-]*$', min_length=2, max_length=40
@@ -43,6 +163,8 @@ async def upload_file(
 ) -> Any:
     """
     Upload a file.
+    Files are stored by their content, so uploading a file we already have only creates a new video for it.
+    HLS renditions of new files are generated in the background, and show up on the video when done.
     """
     if not file:
         raise HTTPException(status_code=400, detail='You must provide a file.')
@@ -52,57 +174,34 @@ async def upload_file(
 
     upload_file_name = f'{file_name}.mp4' if file_name else file.filename
     s3_path = f'{user.name}/{upload_file_name}'
-    video_uri = f'https://gg.klepp.me/{s3_path}'
-    thumbnail_uri = f'https://gg.klepp.me/{user.name}/{upload_file_name}'.replace('.mp4', '.png')
 
-    exist = await boto_session.list_objects_v2(Bucket=settings.S3_BUCKET_URL, Prefix=s3_path)
-    if exist.get('Contents'):
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Video already exist in s3.')
+    if await db_session.get(Video, s3_path):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Video already exist.')
 
     # Save video
-    temp_name = uuid4().hex
-    temp_vido_name = f'{temp_name}.mp4'
-    temp_thumbnail_name = f'{temp_name}.png'
-    async with aiofiles.open(temp_vido_name, 'wb') as video:
-        while content := await file.read(1024):
-            await video.write(content)  # type: ignore
-
-    # Upload video and generate thumbnail
-    upload_task = asyncio.create_task(
-        upload_video(boto_session=boto_session, path=s3_path, temp_video_name=temp_vido_name)
-    )
-    ffmpeg_task = asyncio.create_task(
-        # create task calling await_ffmpeg
-        await_ffmpeg(
-            # passing the `generate_video_thumbnail` function with the arguments temp_vido_name, temp_thumbnail_name
-            functools.partial(generate_video_thumbnail, temp_vido_name, temp_thumbnail_name)
+    temp_video_name = f'{uuid4().hex}.mp4'
+    handed_to_media_pipeline = False
+    try:
+        sha256, size = await save_upload(file=file, temp_video_name=temp_video_name)
+        db_video, probe = await store_video(
+            boto_session=boto_session,
+            db_session=db_session,
+            user=user,
+            path=s3_path,
+            display_name=upload_file_name.split('.mp4')[0],  # type: ignore
+            temp_video_name=temp_video_name,
+            sha256=sha256,
+            size=size,
         )
-    )
-    await asyncio.gather(upload_task, ffmpeg_task)
+        await publish(db_session, 'video.created', path=db_video.path)
+        # Add to DB, the media pipeline expects the video to exist
+        await db_session.commit()
+        if probe is not None:
+            # The media pipeline owns the temp file from here on
+            background_tasks.add_task(process_media, sha256=sha256, temp_video_name=temp_video_name, probe=probe)
+            handed_to_media_pipeline = True
+    finally:
+        if not handed_to_media_pipeline:
+            await os.remove(temp_video_name)
 
-    # Upload thumbnail and clean up
-    async with aiofiles.open(temp_thumbnail_name, 'rb+') as thumbnail_img:
-        await boto_session.put_object(
-            Bucket=settings.S3_BUCKET_URL,
-            Key=s3_path.replace('.mp4', '.png'),
-            Body=await thumbnail_img.read(),
-            ACL='public-read',
-        )
-
-    # Cleanup
-    remove_video = asyncio.create_task(os.remove(f'{temp_name}.mp4'))
-    remove_thumbnail = asyncio.create_task(os.remove(f'{temp_name}.png'))
-    await asyncio.gather(remove_video, remove_thumbnail)
-
-    # Add to DB and fetch it
-    db_video: Video = Video(
-        path=s3_path,
-        display_name=upload_file_name.split('.mp4')[0],
-        user=user,
-        user_id=user.id,
-        uri=video_uri,
-        thumbnail_uri=thumbnail_uri,
-    )
-    db_session.add(db_video)
-    await db_session.commit()
     return await fetch_one_or_none_video(video_path=db_video.path, db_session=db_session)
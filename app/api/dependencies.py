@@ -1,18 +1,25 @@
-from collections.abc import AsyncGenerator
+import time
+from collections.abc import AsyncGenerator, AsyncIterator
+from contextlib import asynccontextmanager
 
 from aiobotocore.client import AioBaseClient
 from aiobotocore.session import get_session
+from fastapi import Request
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from app.api.admission import load_monitor
+from app.api.replica import read_engine
 from app.core.config import settings
 from app.core.db import ASYNC_ENGINE
+from app.core.tracing import trace_s3
 
 session = get_session()
 
 
-async def get_boto() -> AioBaseClient:
+@asynccontextmanager
+async def s3_client() -> AsyncIterator[AioBaseClient]:
     """
-    Create a boto client which can be shared
+    Create a boto client outside of a request, e.g. in jobs and background tasks
     """
     async with session.create_client(
         's3',
@@ -20,6 +27,19 @@ async def get_boto() -> AioBaseClient:
         aws_secret_access_key=settings.AWS_S3_SECRET_ACCESS_KEY,
         aws_access_key_id=settings.AWS_S3_ACCESS_KEY_ID,
     ) as client:
+        trace_s3(client)
+        yield client
+
+
+async def get_boto(request: Request) -> AsyncIterator[AioBaseClient]:
+    """
+    The worker's boto client, opened once on startup and shared by every request.
+    Creates one for this request when the app runs without its lifespan.
+    """
+    if boto_session := getattr(request.app.state, 'boto_session', None):
+        yield boto_session
+        return
+    async with s3_client() as client:
         yield client
 
 
@@ -30,9 +50,28 @@ async def get_db_session() -> AsyncSession:
     return AsyncSession(ASYNC_ENGINE, expire_on_commit=False)
 
 
+async def connect(db_session: AsyncSession) -> None:
+    """
+    Check out the session's connection up front, recording how long the pool made us wait for load shedding
+    """
+    started = time.monotonic()
+    await db_session.connection()
+    load_monitor.pool_wait.add(time.monotonic() - started)
+
+
 async def yield_db_session() -> AsyncGenerator[AsyncSession, None]:
     """
     Yield a session to the database
     """
     async with AsyncSession(ASYNC_ENGINE, expire_on_commit=False) as db_session:
+        await connect(db_session)
+        yield db_session
+
+
+async def yield_read_db_session(request: Request) -> AsyncGenerator[AsyncSession, None]:
+    """
+    Yield a session for read-only endpoints, to the read replica when it is safe to read from it
+    """
+    async with AsyncSession(read_engine(request), expire_on_commit=False) as db_session:
+        await connect(db_session)
         yield db_session
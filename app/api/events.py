@@ -0,0 +1,320 @@
+"""
+Live video events, so clients can follow the feed over server-sent events instead of polling `GET /files`.
+
+Writes queue an event with `publish`, a `pg_notify` in their own transaction: Postgres sends it to every listener
+once the transaction commits, and drops it when it rolls back. The payload is compact JSON built from the video row,
+so it always carries the video's current visibility and owner.
+
+Every worker has one `EventHub`, with one dedicated connection listening on `EVENTS_CHANNEL`, opened with the first
+client. It fans every event out to the connected clients that may see the video: hidden videos only go to their
+owner, and everyone else gets a `video.deleted` when a video is hidden. An event is encoded once, and only appended
+to the frames of every client. Clients with frames are woken together every `FLUSH_SECONDS`, since waking thousands
+of tasks costs far more than the appends, so a burst of events costs one wakeup per client. Like counts change fast
+on popular videos, so like events are also coalesced per video, and only the latest count is sent.
+
+Clients that fall `SUBSCRIBER_BUFFER` frames behind, or are connected while the listening connection is lost, get a
+`reset` event instead of what they missed, and should fetch the feed again. A connection can be lost without asyncpg
+noticing, e.g. behind a NAT that dropped it or after a failover, so it is pinged with every heartbeat as well.
+
+The stream is exempt from the `BaseHTTPMiddleware` based middleware with `ExceptEventStream`. Those wrap every
+response in a task and memory streams for as long as it streams, which doubled what an idle client costs a worker,
+to about 70 KB. See `benchmarks/event_fanout.py --stack`.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Any
+
+import asyncpg
+from sqlalchemy import Text, cast, func, literal
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import Receive, Scope, Send
+
+from app.api.metrics import Counter, Gauge
+from app.core.config import settings
+from app.models.klepp import User, Video
+
+log = logging.getLogger(__name__)
+
+EVENTS_CHANNEL = 'klepp_events'
+EVENTS_PATH = f'{settings.API_V2_STR}/events'
+# Frames a client may fall behind before it gets a reset instead
+SUBSCRIBER_BUFFER = 64
+# Clients are woken at most this often, however many events arrive
+FLUSH_SECONDS = 0.5
+# Comment frames keeping idle connections open through proxies, and a ping of the listening connection as often
+HEARTBEAT_SECONDS = 15
+PING_TIMEOUT_SECONDS = 5
+RECONNECT_SECONDS = (1, 2, 5, 10, 30)
+
+RESET_FRAME = b'event: reset\ndata: {}\n\n'
+HEARTBEAT_FRAME = b': ping\n\n'
+
+EVENTS_RECEIVED = Counter('klepp_events_received_total', 'Video events received from Postgres', labels=('event',))
+EVENTS_DROPPED = Counter('klepp_events_dropped_total', 'Clients reset after falling behind or a lost connection')
+
+
+async def publish(db_session: AsyncSession, event: str, path: str, **fields: Any) -> None:
+    """
+    Queue an event about a video, sent when the transaction commits. The video must exist in the transaction, so
+    publish after creating or changing it, and before deleting it.
+    """
+    payload = func.jsonb_build_object(
+        'event', literal(event), 'path', Video.path, 'owner', User.name, 'hidden', Video.hidden
+    ).op('||')(cast(json.dumps(fields), JSONB))
+    statement = (
+        select(func.pg_notify(EVENTS_CHANNEL, cast(payload, Text)))
+        .join(User, User.id == Video.user_id)
+        .where(Video.path == path)
+    )
+    await db_session.exec(statement)
+
+
+def encode(event: str, data: dict[str, Any]) -> bytes:
+    """
+    One server-sent event
+    """
+    return f'event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'.encode()
+
+
+class Subscriber:
+    """
+    A connected client, and the frames waiting to be sent to it
+    """
+
+    __slots__ = ('username', 'frames', 'waiter', 'closed')
+
+    def __init__(self, username: str | None) -> None:
+        self.username = username
+        self.frames: list[bytes] = []
+        # Only while waiting, and lighter than an `asyncio.Event` per client
+        self.waiter: asyncio.Future | None = None
+        self.closed = False
+
+    def send(self, frame: bytes) -> None:
+        """
+        Queue a frame, or a reset in place of everything queued when the client has fallen too far behind
+        """
+        if len(self.frames) >= SUBSCRIBER_BUFFER:
+            self.reset()
+            return
+        self.frames.append(frame)
+
+    def reset(self) -> None:
+        """
+        Replace the queued frames with a reset
+        """
+        self.frames.clear()
+        self.frames.append(RESET_FRAME)
+        EVENTS_DROPPED.inc()
+
+    def wake(self) -> None:
+        """
+        Let the client send its frames, if it is waiting for them
+        """
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def close(self) -> None:
+        """
+        End the client's stream
+        """
+        self.closed = True
+        self.wake()
+
+    async def receive(self) -> bytes:
+        """
+        Wait to be woken with frames, and return them all at once. Empty once the stream is closed.
+        """
+        while not self.closed and not self.frames:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        if self.closed:
+            return b''
+        frames = b''.join(self.frames)
+        self.frames.clear()
+        return frames
+
+
+class EventHub:
+    """
+    The worker's listening connection and connected clients, see the module docstring
+    """
+
+    def __init__(self) -> None:
+        self.subscribers: set[Subscriber] = set()
+        self.pending_likes: dict[str, dict[str, Any]] = {}
+        self.task: asyncio.Task | None = None
+        self.connected = False
+
+    def subscribe(self, username: str | None) -> Subscriber:
+        """
+        Add a client, starting to listen if this is the first one
+        """
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(), name='event-hub')
+        subscriber = Subscriber(username)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        """
+        Remove a client that disconnected
+        """
+        self.subscribers.discard(subscriber)
+
+    def dispatch(self, payload: dict[str, Any]) -> None:
+        """
+        Send an event to every client that may see it
+        """
+        event = payload.pop('event')
+        was_hidden = payload.pop('was_hidden', payload['hidden'])
+        frame = encode(event, payload)
+        removed: bytes | None = None
+        for subscriber in self.subscribers:
+            if not payload['hidden'] or subscriber.username == payload['owner']:
+                subscriber.send(frame)
+            elif not was_hidden:
+                # Hidden just now, gone for everyone but the owner
+                removed = removed or encode('video.deleted', {'path': payload['path'], 'owner': payload['owner']})
+                subscriber.send(removed)
+
+    def receive(self, _connection: Any, _pid: int, _channel: str, raw: str) -> None:
+        """
+        asyncpg notification callback
+        """
+        try:
+            payload = json.loads(raw)
+        except ValueError:
+            log.warning('Malformed event received: %s', raw[:200])
+            return
+        EVENTS_RECEIVED.inc(payload.get('event', ''))
+        if payload.get('event') == 'video.liked':
+            self.pending_likes[payload['path']] = payload
+            return
+        if payload.get('event') == 'video.deleted':
+            self.pending_likes.pop(payload['path'], None)
+        self.dispatch(payload)
+
+    def flush_likes(self) -> None:
+        """
+        Send the latest like event of every video liked since the last flush
+        """
+        pending, self.pending_likes = self.pending_likes, {}
+        for payload in pending.values():
+            self.dispatch(payload)
+
+    def deliver(self) -> None:
+        """
+        Wake every client with frames to send
+        """
+        for subscriber in self.subscribers:
+            if subscriber.frames:
+                subscriber.wake()
+
+    def reset_all(self) -> None:
+        """
+        Reset every client right away, after events may have been missed
+        """
+        for subscriber in self.subscribers:
+            subscriber.reset()
+        self.deliver()
+
+    async def run(self) -> None:
+        """
+        Listen for events, reconnecting whenever the connection is lost
+        """
+        attempt = 0
+        while True:
+            try:
+                connection = await asyncpg.connect(settings.DATABASE_URL.replace('+asyncpg', ''))
+            except (OSError, asyncpg.PostgresError) as error:
+                delay = RECONNECT_SECONDS[min(attempt, len(RECONNECT_SECONDS) - 1)]
+                log.warning('Unable to listen for events, retrying in %ss. Error: %s', delay, error)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            try:
+                await connection.add_listener(EVENTS_CHANNEL, self.receive)
+                if attempt:
+                    log.info('Listening for events again')
+                    self.reset_all()
+                attempt = 0
+                self.connected = True
+                await self.tick(connection)
+            finally:
+                self.connected = False
+                try:
+                    await connection.close(timeout=5)
+                except Exception as error:
+                    # Aborted instead, a connection that stopped answering can't be closed cleanly
+                    log.debug('Unable to close the connection listening for events. Error: %s', error)
+            log.warning('Lost the connection listening for events, reconnecting')
+            self.reset_all()
+            attempt = 1
+
+    async def tick(self, connection: asyncpg.Connection) -> None:
+        """
+        Flush likes, send heartbeats and wake clients until the connection is lost
+        """
+        ticks = 0
+        while not connection.is_closed():
+            await asyncio.sleep(FLUSH_SECONDS)
+            self.flush_likes()
+            ticks += 1
+            heartbeat = ticks % round(HEARTBEAT_SECONDS / FLUSH_SECONDS) == 0
+            if heartbeat:
+                for subscriber in self.subscribers:
+                    subscriber.send(HEARTBEAT_FRAME)
+            self.deliver()
+            if heartbeat and not await self.ping(connection):
+                return
+
+    async def ping(self, connection: asyncpg.Connection) -> bool:
+        """
+        Whether the connection still answers. A half-open connection looks open, but never receives another event.
+        """
+        try:
+            await asyncio.wait_for(connection.execute('SELECT 1'), timeout=PING_TIMEOUT_SECONDS)
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as error:
+            log.warning('The connection listening for events stopped answering. Error: %r', error)
+            return False
+        return True
+
+    async def stop(self) -> None:
+        """
+        Stop listening, and end every client's stream
+        """
+        for subscriber in self.subscribers:
+            subscriber.close()
+        self.subscribers.clear()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+
+class ExceptEventStream(BaseHTTPMiddleware):
+    """
+    `app.middleware('http')`, except that the event stream is passed straight through, see the module docstring.
+    The middleware is not applied to it, so it must be of no use to a stream, like load shedding or cookies.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http' and scope['path'] == EVENTS_PATH:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+event_hub = EventHub()
+
+Gauge('klepp_event_subscribers', 'Clients connected to the event stream', lambda: len(event_hub.subscribers))
+Gauge('klepp_event_listener_connected', 'Whether the worker is listening for events', lambda: event_hub.connected)
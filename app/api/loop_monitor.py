@@ -0,0 +1,130 @@
+"""
+Event loop lag monitor and blocking call detector.
+
+A heartbeat task sleeps `LOOP_HEARTBEAT_SECONDS` in a loop. Anything past the sleep is lag: time the loop spent
+running other callbacks before it got back to the heartbeat. The lag is exported on `/metrics`, and used for load
+shedding.
+
+A watchdog thread checks the heartbeat. When the loop hasn't come back for `LOOP_BLOCKED_SECONDS`, some callback is
+blocking it, and the watchdog logs the stack of the loop thread right then, which is the blocking code, together
+with the correlation id of the request it runs for.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections.abc import Coroutine
+from typing import Any
+
+from asgi_correlation_id import correlation_id
+
+from app.api.metrics import Counter, DecayingAverage, Gauge, Histogram
+from app.core.config import settings
+
+log = logging.getLogger(__name__)
+
+LOOP_HEARTBEAT_SECONDS = 0.1
+
+LOOP_LAG = Histogram(
+    'klepp_event_loop_lag_seconds',
+    'How late the event loop heartbeat was',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+LOOP_BLOCKED = Counter('klepp_event_loop_blocked_total', 'Callbacks blocking the event loop for too long')
+
+
+class LoopMonitor:
+    def __init__(self) -> None:
+        self.lag = DecayingAverage(half_life=2)
+        self.heartbeat = time.monotonic()
+        self.reported_heartbeat: float | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.loop_thread_id: int | None = None
+        self.heartbeat_task: asyncio.Task | None = None
+        self.watchdog: threading.Thread | None = None
+        self.stopped = threading.Event()
+        # Python 3.10 has no way to read another task's context, so tasks remember the correlation id they were
+        # created with. Request handlers run in tasks created after the correlation id is set.
+        self.correlation_ids: weakref.WeakKeyDictionary[asyncio.Task, str] = weakref.WeakKeyDictionary()
+
+    def create_task(
+        self, loop: asyncio.AbstractEventLoop, coroutine: Coroutine[Any, Any, Any], **kwargs: Any
+    ) -> asyncio.Task:
+        """
+        Task factory remembering the correlation id of new tasks
+        """
+        task = asyncio.Task(coroutine, loop=loop, **kwargs)
+        if request_id := correlation_id.get():
+            self.correlation_ids[task] = request_id
+        return task
+
+    async def beat(self) -> None:
+        """
+        Measure the lag of every heartbeat
+        """
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(LOOP_HEARTBEAT_SECONDS)
+            self.heartbeat = time.monotonic()
+            lag = max(self.heartbeat - started - LOOP_HEARTBEAT_SECONDS, 0)
+            self.lag.add(lag)
+            LOOP_LAG.observe(lag)
+
+    def watch(self) -> None:
+        """
+        Watchdog thread, reporting every stall once
+        """
+        while not self.stopped.wait(settings.LOOP_BLOCKED_SECONDS / 2):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - LOOP_HEARTBEAT_SECONDS
+            if blocked > settings.LOOP_BLOCKED_SECONDS and heartbeat != self.reported_heartbeat:
+                self.reported_heartbeat = heartbeat
+                self.report_blocked(blocked)
+
+    def report_blocked(self, blocked: float) -> None:
+        """
+        Log what the loop thread is running right now, as the request that is running it
+        """
+        LOOP_BLOCKED.inc()
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = ''.join(traceback.format_stack(frame)) if frame else 'Stack unavailable\n'
+        # Reading the loop's current task from this thread is racy, but good enough for a log line
+        task = asyncio.tasks._current_tasks.get(self.loop)  # type: ignore
+        token = correlation_id.set(self.correlation_ids.get(task) if task else None)
+        try:
+            log.warning('Event loop blocked for %.3fs so far, by:\n%s', blocked, stack.rstrip())
+        finally:
+            correlation_id.reset(token)
+
+    def start(self) -> None:
+        """
+        Start the heartbeat and the watchdog, from the event loop
+        """
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.loop.set_task_factory(self.create_task)
+        self.heartbeat = time.monotonic()
+        self.heartbeat_task = asyncio.create_task(self.beat())
+        self.stopped.clear()
+        self.watchdog = threading.Thread(target=self.watch, name='loop-watchdog', daemon=True)
+        self.watchdog.start()
+
+    async def stop(self) -> None:
+        """
+        Stop the heartbeat and the watchdog
+        """
+        self.stopped.set()
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+            await asyncio.gather(self.heartbeat_task, return_exceptions=True)
+        if self.loop:
+            self.loop.set_task_factory(None)
+
+
+loop_monitor = LoopMonitor()
+
+Gauge('klepp_event_loop_lag_average_seconds', 'Moving average of the event loop lag', loop_monitor.lag.value)
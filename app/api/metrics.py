@@ -0,0 +1,170 @@
+"""
+Just enough of the Prometheus text format to export a handful of worker metrics on `/metrics`, without a client
+library.
+
+Metrics live in the worker's memory, so with several workers a scrape answers for whichever worker it hits.
+Every sample carries a `worker` label with the pid, so they can be told apart.
+
+Jobs have nothing to scrape, they write their metrics to a file with `write_textfile` instead, for the textfile
+collector of the node exporter.
+"""
+
+import os
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterator
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+Sample = tuple[str, dict[str, str], float]
+
+router = APIRouter(include_in_schema=False)
+
+
+class Metric(ABC):
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        REGISTRY.append(self)
+
+    @abstractmethod
+    def samples(self) -> Iterator[Sample]:
+        """
+        Every sample of the metric, as name, labels and value
+        """
+
+
+REGISTRY: list[Metric] = []
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation)
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        """
+        Increase the counter for the label values
+        """
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self) -> Iterator[Sample]:
+        """
+        One sample per combination of label values seen so far
+        """
+        for label_values, value in self.values.items():
+            yield self.name, dict(zip(self.labels, label_values, strict=True)), value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]) -> None:
+        super().__init__(name, documentation)
+        self.function = function
+
+    def samples(self) -> Iterator[Sample]:
+        """
+        The current value, read when scraped
+        """
+        yield self.name, {}, self.function()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...]) -> None:
+        super().__init__(name, documentation)
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        Record a value
+        """
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def samples(self) -> Iterator[Sample]:
+        """
+        Cumulative buckets, then the sum and count
+        """
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts, strict=True):
+            cumulative += count
+            yield f'{self.name}_bucket', {'le': f'{bound:g}'}, cumulative
+        yield f'{self.name}_bucket', {'le': '+Inf'}, self.count
+        yield f'{self.name}_sum', {}, self.sum
+        yield f'{self.name}_count', {}, self.count
+
+
+class DecayingAverage:
+    """
+    Moving average of samples, which also decays towards 0 with time, so it recovers when samples stop coming in
+    """
+
+    def __init__(self, half_life: float, weight: float = 0.2) -> None:
+        self.half_life = half_life
+        self.weight = weight
+        self.average = 0.0
+        self.updated_at = time.monotonic()
+
+    def value(self) -> float:
+        """
+        The average, decayed to now
+        """
+        return self.average * 0.5 ** ((time.monotonic() - self.updated_at) / self.half_life)
+
+    def add(self, sample: float) -> None:
+        """
+        Add a sample
+        """
+        current = self.value()
+        self.average = current + (sample - current) * self.weight
+        self.updated_at = time.monotonic()
+
+
+def render(metrics: list[Metric] | None = None, common_labels: dict[str, str] | None = None) -> str:
+    """
+    Metrics in the Prometheus text format, every registered one labelled with the worker by default
+    """
+    if common_labels is None:
+        common_labels = {'worker': str(os.getpid())}
+    lines = []
+    for metric in REGISTRY if metrics is None else metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, value in metric.samples():
+            label_text = ','.join(f'{key}="{value}"' for key, value in {**common_labels, **labels}.items())
+            lines.append(f'{name}{{{label_text}}} {value:.15g}' if label_text else f'{name} {value:.15g}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path: str, metrics: list[Metric]) -> None:
+    """
+    Write metrics of a job to a `.prom` file. Replaced at once, so the collector never reads half a file.
+    """
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as file:
+        file.write(render(metrics, common_labels={}))
+    os.replace(temporary, path)
+
+
+@router.get('/metrics', response_class=PlainTextResponse)
+async def metrics() -> str:
+    """
+    Prometheus metrics of this worker
+    """
+    return render()
@@ -0,0 +1,190 @@
+"""
+On-demand sampling profiler for single requests, writing collapsed stacks for flamegraph tools
+(`flamegraph.pl`, speedscope, ...).
+
+A request is profiled when
+* it has an `X-Profile` header matching `PROFILE_TOKEN`, the profile is always kept.
+* its path is in `PROFILE_ROUTES`, for `PROFILE_SAMPLE_RATE` of them. The profile is only kept when the request took
+  longer than `PROFILE_SLOW_SECONDS`.
+
+While a request is profiled, a thread samples it every `PROFILE_INTERVAL_SECONDS`. When the request is running on
+the event loop, the sample is the loop thread's stack. Otherwise it is the chain of coroutines the request is
+awaiting, ending in `[awaiting]`, so time spent waiting on the database or S3 shows up too.
+Nothing is sampled while no request is profiled. Sampling stops once the response is sent, background tasks of the
+request run after that in the same task, but the client isn't waiting for them.
+
+Profiles are written to `PROFILE_DIRECTORY`, named after the correlation id of the request.
+"""
+
+import asyncio
+import hmac
+import logging
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from types import FrameType
+from typing import Any
+from uuid import uuid4
+
+import aiofiles
+from aiofiles import os
+from asgi_correlation_id import correlation_id
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.api.loop_monitor import loop_monitor
+from app.core.config import settings
+
+log = logging.getLogger(__name__)
+
+PROFILE_INTERVAL_SECONDS = 0.005
+
+
+def frame_name(frame: FrameType) -> str:
+    """
+    A frame in collapsed stack format, like py-spy names them
+    """
+    return f'{frame.f_code.co_name} ({frame.f_code.co_filename}:{frame.f_lineno})'
+
+
+def thread_stack(frame: FrameType | None) -> list[str]:
+    """
+    Outermost first stack of a running thread
+    """
+    frames = []
+    while frame is not None:
+        frames.append(frame_name(frame))
+        frame = frame.f_back
+    return frames[::-1]
+
+
+def awaiting_stack(coroutine: Any) -> list[str]:
+    """
+    Outermost first chain of coroutines a suspended task is awaiting
+    """
+    frames = []
+    while coroutine is not None and (frame := getattr(coroutine, 'cr_frame', None)) is not None:
+        frames.append(frame_name(frame))
+        coroutine = getattr(coroutine, 'cr_await', None)
+    frames.append('[awaiting]')
+    return frames
+
+
+class Sampler:
+    """
+    Samples the tasks of profiled requests from a thread, which only runs while there are any
+    """
+
+    def __init__(self) -> None:
+        self.profiles: dict[asyncio.Task, Counter[str]] = {}
+        self.lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+
+    def start(self, task: asyncio.Task) -> Counter[str]:
+        """
+        Start sampling a task, returns the stacks collected so far
+        """
+        stacks: Counter[str] = Counter()
+        with self.lock:
+            self.profiles[task] = stacks
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+                self.thread.start()
+        return stacks
+
+    def stop(self, task: asyncio.Task) -> None:
+        """
+        Stop sampling a task
+        """
+        with self.lock:
+            self.profiles.pop(task, None)
+
+    def run(self) -> None:
+        """
+        Sampler thread, stops once no request is profiled
+        """
+        while True:
+            time.sleep(PROFILE_INTERVAL_SECONDS)
+            with self.lock:
+                if not self.profiles:
+                    self.thread = None
+                    return
+                profiles = list(self.profiles.items())
+            # Reading the loop's current task and stack from this thread is racy, an odd sample is fine
+            running = asyncio.tasks._current_tasks.get(loop_monitor.loop)  # type: ignore
+            loop_frame = sys._current_frames().get(loop_monitor.loop_thread_id)
+            for task, stacks in profiles:
+                stack = thread_stack(loop_frame) if task is running else awaiting_stack(task.get_coro())
+                stacks[';'.join(stack)] += 1
+
+
+sampler = Sampler()
+
+
+def profile_reason(scope: Scope) -> str | None:
+    """
+    Why a request should be profiled, if at all
+    """
+    header = Headers(scope=scope).get('x-profile')
+    if header and settings.PROFILE_TOKEN and hmac.compare_digest(header, settings.PROFILE_TOKEN):
+        return 'requested'
+    if scope['path'] in settings.PROFILE_ROUTES and random.random() < settings.PROFILE_SAMPLE_RATE:
+        return 'sampled'
+    return None
+
+
+async def write_profile(stacks: Counter[str], scope: Scope, duration: float) -> Path:
+    """
+    Write collapsed stacks, one `frame;frame;frame count` line per stack
+    """
+    request_id = correlation_id.get() or uuid4().hex
+    route = scope['path'].strip('/').replace('/', '.') or 'root'
+    timestamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+    path = Path(settings.PROFILE_DIRECTORY) / f'{timestamp}_{request_id}_{scope["method"]}_{route}.collapsed'
+    await os.makedirs(path.parent, exist_ok=True)
+    async with aiofiles.open(path, 'w') as profile:
+        await profile.write(''.join(f'{stack} {count}\n' for stack, count in stacks.most_common()))
+    log.info('Profiled %s %s, %.3fs and %s samples: %s', scope['method'], scope['path'], duration, stacks.total(), path)
+    return path
+
+
+class ProfilerMiddleware:
+    """
+    Profiles requests, see the module docstring.
+    A plain ASGI middleware, so the route runs in the same task as the middleware and its samples can be found.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or loop_monitor.loop is None or not (reason := profile_reason(scope)):
+            await self.app(scope, receive, send)
+            return
+
+        task = asyncio.current_task()
+        assert task is not None
+        stacks = sampler.start(task)
+        started = time.monotonic()
+        duration: float | None = None
+
+        async def send_sampled(message: Message) -> None:
+            nonlocal duration
+            await send(message)
+            # Background tasks run in the same task once the response is sent, they are not part of the request
+            if message['type'] == 'http.response.body' and not message.get('more_body', False) and duration is None:
+                sampler.stop(task)
+                duration = time.monotonic() - started
+
+        try:
+            await self.app(scope, receive, send_sampled)
+        finally:
+            sampler.stop(task)
+            if duration is None:
+                duration = time.monotonic() - started
+            if reason == 'requested' or duration >= settings.PROFILE_SLOW_SECONDS:
+                await write_profile(stacks, scope, duration)
@@ -0,0 +1,128 @@
+"""
+Per-user token buckets for expensive actions, so one client can't take all the media capacity.
+
+Every user has a bucket per action, holding up to `burst` tokens and refilled at `per_minute`. Each request takes a
+token, or gets a 429 with `Retry-After` when the bucket is empty. Buckets are rows in Postgres, updated in one
+statement, so every worker shares them without any locking in the app.
+
+FastAPI reads the whole body of a request before it resolves dependencies, so routes receiving media are limited by
+`RateLimitMiddleware` instead of the `rate_limited` dependency, and an upload over the limit is refused before it is
+received.
+"""
+
+import math
+from collections.abc import Awaitable, Callable
+from typing import NamedTuple
+
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.responses import JSONResponse
+from fastapi.security import SecurityScopes
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.api.security import cognito_scheme, cognito_scheme_or_anonymous
+from app.core.config import settings
+from app.core.db import ASYNC_ENGINE
+from app.models.klepp import RateLimitBucket
+from app.schemas.schemas_v1.user import User as CognitoUser
+
+
+class RateLimit(NamedTuple):
+    action: str
+    burst: int
+    per_minute: float
+
+
+UPLOAD_LIMIT = RateLimit(action='upload', burst=settings.UPLOAD_RATE_BURST, per_minute=settings.UPLOAD_RATE_PER_MINUTE)
+THUMBNAIL_LIMIT = RateLimit(
+    action='thumbnail', burst=settings.THUMBNAIL_RATE_BURST, per_minute=settings.THUMBNAIL_RATE_PER_MINUTE
+)
+LIKE_LIMIT = RateLimit(action='like', burst=settings.LIKE_RATE_BURST, per_minute=settings.LIKE_RATE_PER_MINUTE)
+
+# Routes receiving media, limited by `RateLimitMiddleware` before their body is read. Matched on the method and path.
+MEDIA_LIMITS = {
+    ('POST', f'{settings.API_V2_STR}/files'): UPLOAD_LIMIT,
+    ('POST', f'{settings.API_V2_STR}/files/trim'): UPLOAD_LIMIT,
+    ('PUT', f'{settings.API_V2_STR}/user'): THUMBNAIL_LIMIT,
+}
+
+
+async def take_token(limit: RateLimit, username: str) -> float | None:
+    """
+    Take a token from the user's bucket. Returns None if one was taken, otherwise the seconds until there is one.
+    Runs in its own transaction, so the bucket row isn't locked for the rest of the request.
+    """
+    key = f'{limit.action}:{username}'
+    per_second = limit.per_minute / 60
+    statement = insert(RateLimitBucket).values(key=key, tokens=limit.burst - 1, updated_at=func.clock_timestamp())
+    # Tokens in the bucket now, never more than the burst
+    refilled = func.least(
+        limit.burst,
+        RateLimitBucket.tokens
+        + func.extract('epoch', statement.excluded.updated_at - RateLimitBucket.updated_at) * per_second,
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[RateLimitBucket.key],
+        set_={'tokens': refilled - 1, 'updated_at': statement.excluded.updated_at},
+        where=refilled >= 1,
+    ).returning(RateLimitBucket.tokens)  # type: ignore
+
+    async with AsyncSession(ASYNC_ENGINE) as db_session:
+        taken = (await db_session.exec(statement)).first()
+        await db_session.commit()
+        if taken is not None:
+            return None
+        tokens_now = func.least(
+            limit.burst,
+            RateLimitBucket.tokens
+            + func.extract('epoch', func.clock_timestamp() - RateLimitBucket.updated_at) * per_second,
+        )
+        tokens = (await db_session.exec(select(tokens_now).where(RateLimitBucket.key == key))).one()
+    return max(1 - tokens, 0) / per_second
+
+
+def too_many_requests(limit: RateLimit, retry_after: float) -> tuple[str, dict[str, str]]:
+    """
+    Detail and headers of the 429 for an empty bucket
+    """
+    seconds = max(math.ceil(retry_after), 1)
+    return f'Too many {limit.action} requests, try again in {seconds} seconds.', {'Retry-After': str(seconds)}
+
+
+def rate_limited(limit: RateLimit) -> Callable[..., Awaitable[None]]:
+    """
+    Dependency taking a token from the signed in user's bucket for `limit`, or raising 429
+    """
+
+    async def take_or_raise(user: CognitoUser = Depends(cognito_scheme)) -> None:
+        retry_after = await take_token(limit, user.username)
+        if retry_after is not None:
+            detail, headers = too_many_requests(limit, retry_after)
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=detail, headers=headers)
+
+    return take_or_raise
+
+
+class RateLimitMiddleware:
+    """
+    Takes a token for the routes in `MEDIA_LIMITS` before their body is read, see the module docstring.
+    Anonymous requests are let through, the route refuses them.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http' and (limit := MEDIA_LIMITS.get((scope['method'], scope['path']))):
+            user = await cognito_scheme_or_anonymous(Request(scope), SecurityScopes())
+            if user is not None and (retry_after := await take_token(limit, user.username)) is not None:
+                detail, headers = too_many_requests(limit, retry_after)
+                response = JSONResponse(
+                    {'detail': detail}, status_code=status.HTTP_429_TOO_MANY_REQUESTS, headers=headers
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
@@ -0,0 +1,184 @@
+"""
+Routes read-only endpoints to the read replica, when one is configured with `REPLICA_DATABASE_URL`.
+
+Reads go to the primary instead when
+* the user wrote something less than `READ_YOUR_WRITES_SECONDS` ago, so they always see their own changes.
+  Every successful write sets a short-lived cookie, which works across workers without any shared state, and returns
+  the same timestamp in `X-Wrote-At`. Clients that don't keep cookies, like the SPA and API clients using a bearer
+  token, send it back in an `X-Wrote-At` header. Without either, the worker that handled the write still remembers
+  the token for the window.
+* the replica is more than `REPLICA_MAX_LAG_SECONDS` behind, or its lag is unknown.
+"""
+
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable, Callable
+
+from fastapi import Request, Response
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.core.config import settings
+from app.core.db import ASYNC_ENGINE, REPLICA_ENGINE
+
+log = logging.getLogger(__name__)
+
+WROTE_AT_COOKIE = 'klepp_wrote_at'
+WROTE_AT_HEADER = 'X-Wrote-At'
+READ_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS'})
+
+# Seconds since the last replayed transaction, 0 once everything received is replayed (an idle primary writes
+# nothing new to replay). Unknown when the replica isn't streaming, as it has replayed everything it received but
+# receives nothing new. The status of the WAL receiver needs `pg_read_all_stats`, without it a running one counts.
+# A database that isn't a replica has no lag, so two independent databases work in dev.
+LAG_STATEMENT = text(
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN NOT EXISTS (SELECT FROM pg_stat_wal_receiver WHERE coalesce(status, 'streaming') = 'streaming') THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp())::float8, 'Infinity'::float8)
+    END
+    """
+)
+
+
+class ReplicaMonitor:
+    """
+    Per-worker view of the replica lag. The lag is measured in the background at most every
+    `REPLICA_LAG_CHECK_SECONDS`, requests only read the last measurement.
+    """
+
+    def __init__(self, engine: AsyncEngine | None) -> None:
+        self.engine = engine
+        self.lag: float | None = None
+        self.checked_at: float | None = None
+        self.check_task: asyncio.Task | None = None
+
+    async def measure(self) -> float | None:
+        """
+        Seconds the replica is behind the primary, None when it isn't streaming from it
+        """
+        assert self.engine is not None
+        async with self.engine.connect() as connection:
+            lag = (await connection.execute(LAG_STATEMENT)).scalar_one()
+        return None if lag is None else float(lag)
+
+    async def check(self) -> None:
+        """
+        Measure the replica lag. Unknown if the replica can't be reached, or isn't streaming.
+        """
+        try:
+            lag = await asyncio.wait_for(self.measure(), timeout=settings.REPLICA_LAG_CHECK_SECONDS)
+        except Exception as error:
+            # Only log when the replica goes away, not on every check while it is away
+            if self.lag is not None or self.checked_at is None:
+                log.warning('Unable to check the replica lag, reading from the primary. Error: %s', error)
+            lag = None
+        else:
+            if lag is None and (self.lag is not None or self.checked_at is None):
+                log.warning('Replica is not streaming from the primary, reading from the primary')
+        self.lag = lag
+        self.checked_at = time.monotonic()
+        if self.lag is not None and self.lag > settings.REPLICA_MAX_LAG_SECONDS:
+            log.warning('Replica is %.1f seconds behind, reading from the primary', self.lag)
+
+    def check_if_stale(self) -> None:
+        """
+        Measure the lag in the background if the last measurement is outdated
+        """
+        if self.check_task and not self.check_task.done():
+            return
+        if self.checked_at is not None and time.monotonic() - self.checked_at < settings.REPLICA_LAG_CHECK_SECONDS:
+            return
+        self.check_task = asyncio.create_task(self.check())
+
+    def usable(self) -> bool:
+        """
+        Whether reads can go to the replica. Not until the first measurement is in.
+        """
+        if self.engine is None:
+            return False
+        self.check_if_stale()
+        return self.lag is not None and self.lag <= settings.REPLICA_MAX_LAG_SECONDS
+
+
+replica_monitor = ReplicaMonitor(REPLICA_ENGINE)
+
+
+class RecentWriters:
+    """
+    Bearer tokens that wrote within the read-your-writes window, in this worker. The token is only a hint where to
+    read from, so it doesn't need to be verified.
+    """
+
+    def __init__(self) -> None:
+        self.wrote_at: dict[str, float] = {}
+
+    def add(self, authorization: str) -> None:
+        """
+        Remember a write, and forget the writes that are out of the window
+        """
+        now = time.monotonic()
+        self.wrote_at.pop(authorization, None)
+        self.wrote_at[authorization] = now
+        # Oldest first, in insertion order
+        while next(iter(self.wrote_at.values())) < now - settings.READ_YOUR_WRITES_SECONDS:
+            self.wrote_at.pop(next(iter(self.wrote_at)))
+
+    def wrote_recently(self, authorization: str) -> bool:
+        """
+        Whether the token wrote within the read-your-writes window
+        """
+        wrote_at = self.wrote_at.get(authorization)
+        return wrote_at is not None and time.monotonic() - wrote_at < settings.READ_YOUR_WRITES_SECONDS
+
+
+recent_writers = RecentWriters()
+
+
+def wrote_recently(request: Request) -> bool:
+    """
+    Whether the user wrote something within the read-your-writes window
+    """
+    authorization = request.headers.get('authorization')
+    if authorization and recent_writers.wrote_recently(authorization):
+        return True
+    for value in (request.cookies.get(WROTE_AT_COOKIE), request.headers.get(WROTE_AT_HEADER)):
+        try:
+            wrote_at = float(value or '')
+        except ValueError:
+            continue
+        if 0 <= time.time() - wrote_at < settings.READ_YOUR_WRITES_SECONDS:
+            return True
+    return False
+
+
+def read_engine(request: Request) -> AsyncEngine:
+    """
+    Engine to serve a read-only request from
+    """
+    if REPLICA_ENGINE is None or wrote_recently(request) or not replica_monitor.usable():
+        return ASYNC_ENGINE
+    return REPLICA_ENGINE
+
+
+async def mark_writes(request: Request, call_next: Callable[[Request], Awaitable[Response]]) -> Response:
+    """
+    Middleware starting the read-your-writes window after every successful write
+    """
+    response = await call_next(request)
+    if REPLICA_ENGINE is not None and request.method not in READ_METHODS and response.status_code < 400:
+        wrote_at = str(time.time())
+        response.set_cookie(
+            WROTE_AT_COOKIE,
+            wrote_at,
+            max_age=int(settings.READ_YOUR_WRITES_SECONDS) + 1,
+            httponly=True,
+            secure=request.url.scheme == 'https',
+        )
+        response.headers[WROTE_AT_HEADER] = wrote_at
+        if authorization := request.headers.get('authorization'):
+            recent_writers.add(authorization)
+    return response
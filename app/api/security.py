@@ -6,24 +6,26 @@ security. If you're using this library as inspiration for anything, please keep
 
 import logging
 from datetime import datetime, timedelta
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2AuthorizationCodeBearer, SecurityScopes
 from fastapi.security.base import SecurityBase
 from httpx import AsyncClient
-from jose import ExpiredSignatureError, jwk, jwt
-from jose.backends.cryptography_backend import CryptographyRSAKey
-from jose.exceptions import JWTClaimsError, JWTError
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 from starlette.requests import Request
 
 from app.api.dependencies import yield_db_session
 from app.core.config import settings
+from app.core.tracing import span
 from app.models.klepp import User
 from app.schemas.schemas_v1.user import User as CognitoUser
 
+# jose and its cryptography backend are imported on first use, and by the warmup, keeping worker imports fast
+if TYPE_CHECKING:
+    from jose.backends.cryptography_backend import CryptographyRSAKey
+
 
 class InvalidAuth(HTTPException):
     """
@@ -57,7 +59,8 @@ class OpenIdConfig:
         if not self._config_timestamp or self._config_timestamp < refresh_time:
             try:
                 log.debug('Loading Cognito OpenID configuration.')
-                await self._load_openid_config()
+                with span('auth.jwks', url=self.openid_url):
+                    await self._load_openid_config()
                 self._config_timestamp = datetime.now()
             except Exception as error:
                 log.exception('Unable to fetch OpenID configuration from Cognito. Error: %s', error)
@@ -96,10 +99,12 @@ class OpenIdConfig:
         """
         Create certificates based on signing keys and store them
         """
+        from jose import jwk
+
         self.signing_keys: dict[str, CryptographyRSAKey] = {}
         for key in keys:
             if key.get('use') == 'sig':  # Only care about keys that are used for signatures, not encryption
-                log.debug('Loading public key from certificate: %s', key)
+                log.debug('Loading public key %s', key.get('kid'))
                 cert_obj = jwk.construct(key, 'RS256')
                 if kid := key.get('kid'):
                     self.signing_keys[kid] = cert_obj.public_key()
@@ -124,6 +129,19 @@ class CognitoAuthorizationCodeBearerBase(SecurityBase):
         """
         Extends call to also validate the token.
         """
+        with span('auth') as auth_span:
+            user = await self.validate(request, security_scopes)
+            if auth_span is not None:
+                auth_span.set(signed_in=user is not None)
+            return user
+
+    async def validate(self, request: Request, security_scopes: SecurityScopes) -> CognitoUser | None:
+        """
+        Validate the token, and return the user it belongs to
+        """
+        from jose import ExpiredSignatureError, jwt
+        from jose.exceptions import JWTClaimsError, JWTError
+
         try:
             access_token = await self.oauth(request=request)
             try:
@@ -131,7 +149,7 @@ class CognitoAuthorizationCodeBearerBase(SecurityBase):
                 header: dict[str, str] = jwt.get_unverified_header(token=access_token) or {}
                 claims: dict[str, Any] = jwt.get_unverified_claims(token=access_token) or {}
             except Exception as error:
-                log.warning('Malformed token received. %s. Error: %s', access_token, error, exc_info=True)
+                log.warning('Malformed token received. Error: %s', error)
                 raise InvalidAuth(detail='Invalid token format') from error
 
             for scope in security_scopes.scopes:
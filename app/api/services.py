@@ -1,37 +1,376 @@
-from collections.abc import Callable
+import asyncio
+import base64
+import functools
+import json
+import logging
+import shutil
+import struct
+from collections import defaultdict
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from io import BytesIO
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, NamedTuple
+from uuid import UUID, uuid4
 
-import ffmpeg
-from asynccpu import ProcessTaskPoolExecutor
-from asyncffmpeg import FFmpegCoroutineFactory, StreamSpec
+import aiofiles
+from aiobotocore.client import AioBaseClient
+from aiofiles import os
+from botocore.exceptions import ClientError
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import selectinload
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from app.models.klepp import Video, VideoRead
+from app.api.dependencies import s3_client
+from app.core.config import settings
+from app.core.db import ASYNC_ENGINE
+from app.core.tracing import span
+from app.models.klepp import (
+    Blob,
+    Upload,
+    User,
+    Video,
+    VideoLikeCount,
+    VideoLikeLink,
+    VideoMetadata,
+    VideoRead,
+    VideoTagLink,
+    VideoTrending,
+)
 
+# ffmpeg, asyncffmpeg, asynccpu and Pillow are imported where they're used. Most requests never touch media, and
+# importing them up front slowed down every worker start.
+if TYPE_CHECKING:
+    from asyncffmpeg import StreamSpec
+    from PIL import Image
 
-async def generate_user_thumbnail(path: str, name: str) -> StreamSpec:
+log = logging.getLogger(__name__)
+
+# S3 accepts at most 1000 keys per `delete_objects` call
+S3_DELETE_BATCH_SIZE = 1000
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Bounds the number of ffmpeg processes in this worker, shared by requests and background media tasks
+media_slots = asyncio.Semaphore(settings.MEDIA_WORKERS)
+
+# Pillow releases the GIL while decoding, scaling and encoding, so profile pictures are processed in threads
+image_executor = ThreadPoolExecutor(max_workers=settings.IMAGE_WORKERS, thread_name_prefix='image')
+
+
+class Rendition(NamedTuple):
+    name: str
+    height: int
+    video_bitrate: str
+
+
+# HLS renditions below the source resolution, the source itself is always added as a stream copy
+HLS_RENDITIONS = (
+    Rendition(name='360p', height=360, video_bitrate='800k'),
+    Rendition(name='720p', height=720, video_bitrate='2800k'),
+)
+
+VIDEO_THUMBNAIL_WIDTHS = (160, 320, 640, 840)
+USER_THUMBNAIL_WIDTHS = (64, 128, 256, 420)
+
+# Inlined placeholders are shown while the thumbnail loads, and must stay tiny since every list response has them
+PLACEHOLDER_WIDTH = 16
+PLACEHOLDER_QUALITY = 30
+PLACEHOLDER_MAX_LENGTH = 1024
+
+# Hover-scrub previews, at most one tile per `SPRITE_MIN_INTERVAL` seconds, laid out `SPRITE_COLUMNS` wide
+SPRITE_MAX_FRAMES = 25
+SPRITE_MIN_INTERVAL = 2
+SPRITE_COLUMNS = 5
+SPRITE_TILE_WIDTH = 160
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.vtt': 'text/vtt',
+    '.ts': 'video/mp2t',
+    '.webp': 'image/webp',
+    '.jpg': 'image/jpeg',
+}
+
+# Columns generated by the media pipeline from the blob bytes, shared by every video pointing to the blob
+MEDIA_FIELDS = (
+    'thumbnail_uri',
+    'thumbnail_variants',
+    'placeholder',
+    'hls_uri',
+    'sprite_vtt_uri',
+    'faststart',
+    *VideoMetadata.model_fields,
+)
+
+
+async def generate_placeholder(path: str, name: str) -> 'StreamSpec':
     """
-    Scales and compresses user profile thumbnail
+    Tiny, low quality WebP of the first frame, small enough to inline as a data URI
     """
-    return ffmpeg.input(path).filter('scale', 420, 420, force_original_aspect_ratio='decrease').output(name, qscale=3)
+    import ffmpeg
 
+    return (
+        ffmpeg.input(path)
+        .filter('scale', PLACEHOLDER_WIDTH, -2)
+        .output(name, vframes=1, vcodec='libwebp', quality=PLACEHOLDER_QUALITY)
+    )
+
+
+async def generate_thumbnail_variants(
+    path: str, directory: str, widths: tuple[int, ...], fallback_width: int, square: bool, placeholder_name: str
+) -> 'StreamSpec':
+    """
+    Decode the first frame once, and write a WebP per width plus a JPEG fallback to `directory`,
+    and a tiny WebP placeholder to `placeholder_name`.
+    Videos are scaled by width, never upscaled. Square variants fit the image inside a width x width box.
+    """
+    import ffmpeg
+
+    outputs = [(width, f'{directory}/{width}.webp', {'vcodec': 'libwebp', 'quality': 75}) for width in widths]
+    outputs.append((fallback_width, f'{directory}/{fallback_width}.jpg', {'qscale': 3}))
+    outputs.append((PLACEHOLDER_WIDTH, placeholder_name, {'vcodec': 'libwebp', 'quality': PLACEHOLDER_QUALITY}))
+
+    split = ffmpeg.input(path).video.filter_multi_output('split', len(outputs))
+    streams = []
+    for index, (width, name, codec) in enumerate(outputs):
+        if square:
+            scaled = split[index].filter('scale', width, width, force_original_aspect_ratio='decrease')
+        else:
+            scaled = split[index].filter('scale', f'min(iw,{width})', -2)
+        streams.append(scaled.output(name, vframes=1, **codec))
+    return ffmpeg.merge_outputs(*streams)
 
-async def generate_video_thumbnail(path: str, name: str) -> StreamSpec:
+
+class InvalidImage(ValueError):
+    pass
+
+
+class ImageTooLarge(InvalidImage):
+    pass
+
+
+def render_profile_picture(data: bytes, widths: tuple[int, ...], fallback_width: int) -> dict[str, bytes]:
     """
-    Cuts first frame and generates a new file
+    Decode an image in memory, and encode square variants fitting inside a width x width box.
+    Returns the encoded files by name: a WebP per width, a JPEG fallback and the WebP placeholder.
+    Only the header is read before checking the dimensions, so decompression bombs are never decoded.
+    Raises `InvalidImage` for anything Pillow can't read.
     """
-    return ffmpeg.input(path).filter('scale', 840, -1).output(name, vframes=1)
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(BytesIO(data)) as image:
+            if image.width * image.height > settings.PROFILE_PICTURE_MAX_PIXELS:
+                raise ImageTooLarge(f'Image is {image.width}x{image.height} pixels')
+            # Let JPEG decode at a fraction of the size when the image is much larger than the largest variant
+            image.draft('RGB', (max(widths), max(widths)))
+            source = ImageOps.exif_transpose(image).convert('RGB')
+    except (Image.DecompressionBombError, OSError) as error:
+        # `UnidentifiedImageError` and truncated files are `OSError`s
+        raise InvalidImage(str(error)) from error
+
+    files = {}
+    for width in widths:
+        scaled = ImageOps.contain(source, (width, width), Image.Resampling.LANCZOS)
+        files[f'{width}.webp'] = encode_image(scaled, 'WEBP', quality=75)
+    fallback = ImageOps.contain(source, (fallback_width, fallback_width), Image.Resampling.LANCZOS)
+    files[f'{fallback_width}.jpg'] = encode_image(fallback, 'JPEG', quality=85)
+    placeholder = ImageOps.contain(source, (PLACEHOLDER_WIDTH, PLACEHOLDER_WIDTH), Image.Resampling.BILINEAR)
+    files['placeholder.webp'] = encode_image(placeholder, 'WEBP', quality=PLACEHOLDER_QUALITY)
+    return files
+
+
+def encode_image(image: 'Image.Image', image_format: str, **options: Any) -> bytes:
+    """
+    Encode an image to bytes in memory
+    """
+    output = BytesIO()
+    image.save(output, format=image_format, **options)
+    return output.getvalue()
 
 
 async def await_ffmpeg(function: Callable) -> None:
     """
     Make ffmpeg awaitable
     """
+    from asynccpu import ProcessTaskPoolExecutor
+    from asyncffmpeg import FFmpegCoroutineFactory
+
     ffmpeg_coroutine = FFmpegCoroutineFactory.create()
+    name = getattr(function, 'func', function).__name__  # type: ignore
+
+    with span('ffmpeg.wait', function=name):
+        await media_slots.acquire()
+    try:
+        with (
+            span('ffmpeg.run', function=name),
+            ProcessTaskPoolExecutor(max_workers=1, cancel_tasks_when_shutdown=True) as executor,
+        ):
+            await executor.create_process_task(ffmpeg_coroutine.execute, function)
+    finally:
+        media_slots.release()
+
+
+async def generate_faststart(path: str, name: str) -> 'StreamSpec':
+    """
+    Remux with stream copy, moving the `moov` atom in front of `mdat`
+    """
+    import ffmpeg
+
+    return ffmpeg.input(path).output(name, codec='copy', map=0, movflags='+faststart')
+
+
+async def generate_trim(path: str, name: str, start: float, end: float) -> 'StreamSpec':
+    """
+    Cut `start` to `end` with stream copy. Input seeking snaps the start to the keyframe before it, so nothing is
+    re-encoded, and only the needed part of the source is read.
+    """
+    import ffmpeg
+
+    return ffmpeg.input(path, ss=start, to=end).output(
+        name, codec='copy', map=0, movflags='+faststart', avoid_negative_ts='make_zero'
+    )
+
+
+async def generate_hls(path: str, directory: str, renditions: list[Rendition], has_audio: bool) -> 'StreamSpec':
+    """
+    Encode HLS renditions in a single ffmpeg run, decoding the source once.
+    Writes `master.m3u8` and a playlist with segments per rendition to `directory`.
+    The last variant is the source video, stream copied.
+    """
+    import ffmpeg
 
-    with ProcessTaskPoolExecutor(max_workers=3, cancel_tasks_when_shutdown=True) as executor:
-        await executor.create_process_task(ffmpeg_coroutine.execute, function)
+    source = ffmpeg.input(path)
+    split = source.video.filter_multi_output('split', len(renditions)) if renditions else None
+    streams = []
+    codecs: dict[str, str] = {}
+    for index, rendition in enumerate(renditions):
+        streams.append(split[index].filter('scale', -2, rendition.height))  # type: ignore
+        codecs[f'c:v:{index}'] = 'libx264'
+        codecs[f'b:v:{index}'] = rendition.video_bitrate
+        if has_audio:
+            streams.append(source.audio)
+    streams.append(source.video)
+    codecs[f'c:v:{len(renditions)}'] = 'copy'
+    if has_audio:
+        streams.append(source.audio)
+
+    variants = range(len(renditions) + 1)
+    return ffmpeg.output(
+        *streams,
+        f'{directory}/%v/index.m3u8',
+        format='hls',
+        acodec='aac',
+        preset='veryfast',
+        hls_time=settings.HLS_SEGMENT_SECONDS,
+        hls_playlist_type='vod',
+        hls_segment_filename=f'{directory}/%v/segment_%03d.ts',
+        master_pl_name='master.m3u8',
+        var_stream_map=' '.join(f'v:{i},a:{i}' if has_audio else f'v:{i}' for i in variants),
+        **codecs,
+    )
+
+
+async def generate_sprite(
+    path: str, name: str, timestamps: list[float], tile_width: int, tile_height: int
+) -> 'StreamSpec':
+    """
+    Tile one frame per timestamp into a single sprite image.
+    Every frame gets its own input seeking to the keyframe before the timestamp, and only keyframes are decoded,
+    so the rest of the video is never decoded.
+    """
+    import ffmpeg
+
+    frames = [
+        ffmpeg.input(path, ss=timestamp, skip_frame='nokey', noaccurate_seek=None)
+        .video.filter('trim', end_frame=1)
+        .filter('setpts', 'PTS-STARTPTS')
+        .filter('scale', tile_width, tile_height)
+        .filter('setsar', 1)
+        for timestamp in timestamps
+    ]
+    rows = -(-len(frames) // SPRITE_COLUMNS)
+    return (
+        ffmpeg.concat(*frames, n=len(frames), v=1, a=0)
+        .filter('tile', f'{SPRITE_COLUMNS}x{rows}')
+        .output(name, vframes=1, vcodec='libwebp', quality=60)
+    )
+
+
+def vtt_timestamp(seconds: float) -> str:
+    """
+    Format seconds as a WebVTT timestamp, `hh:mm:ss.ttt`
+    """
+    milliseconds = round(seconds * 1000)
+    hours, milliseconds = divmod(milliseconds, 3_600_000)
+    minutes, milliseconds = divmod(milliseconds, 60_000)
+    return f'{hours:02}:{minutes:02}:{milliseconds // 1000:02}.{milliseconds % 1000:03}'
+
+
+def sprite_vtt(sprite_name: str, duration: float, frames: int, tile_width: int, tile_height: int) -> str:
+    """
+    WebVTT thumbnail track mapping every interval of the video to its tile in the sprite, using media fragments
+    """
+    interval = duration / frames
+    cues = ['WEBVTT', '']
+    for index in range(frames):
+        row, column = divmod(index, SPRITE_COLUMNS)
+        cues.append(f'{vtt_timestamp(index * interval)} --> {vtt_timestamp((index + 1) * interval)}')
+        cues.append(f'{sprite_name}#xywh={column * tile_width},{row * tile_height},{tile_width},{tile_height}')
+        cues.append('')
+    return '\n'.join(cues)
+
+
+async def probe_video(path: str) -> dict[str, Any]:
+    """
+    Read streams and format of a video with ffprobe
+    """
+    process = await asyncio.create_subprocess_exec(
+        'ffprobe',
+        '-v',
+        'error',
+        '-print_format',
+        'json',
+        '-show_format',
+        '-show_streams',
+        path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode:
+        raise RuntimeError(f'ffprobe failed for {path}: {stderr.decode()}')
+    return json.loads(stdout)
+
+
+def video_stream(probe: dict[str, Any]) -> dict[str, Any]:
+    """
+    The first video stream of a probe, empty if there is none
+    """
+    return next((stream for stream in probe.get('streams', []) if stream.get('codec_type') == 'video'), {})
+
+
+def video_metadata(probe: dict[str, Any]) -> dict[str, Any]:
+    """
+    Turn an ffprobe result into `VideoMetadata` fields, leaving out whatever ffprobe couldn't tell
+    """
+    stream = video_stream(probe)
+    probe_format = probe.get('format', {})
+    duration = probe_format.get('duration') or stream.get('duration')
+    metadata = {
+        'duration': float(duration) if duration else None,
+        'width': stream.get('width'),
+        'height': stream.get('height'),
+        'codec': stream.get('codec_name'),
+        'bitrate': int(probe_format['bit_rate']) if probe_format.get('bit_rate') else None,
+        'file_size': int(probe_format['size']) if probe_format.get('size') else None,
+    }
+    return {key: value for key, value in metadata.items() if value is not None}
 
 
 async def fetch_one_or_none_video(video_path: str, db_session: AsyncSession) -> VideoRead | None:
@@ -43,7 +382,498 @@ async def fetch_one_or_none_video(video_path: str, db_session: AsyncSession) ->
         .where(Video.path == video_path)
         .options(selectinload(Video.user))  # type: ignore[arg-type]
         .options(selectinload(Video.tags))  # type: ignore[arg-type]
-        .options(selectinload(Video.likes))  # type: ignore[arg-type]
+        .options(selectinload(Video.likes).load_only(User.name, User.thumbnail_uri))
     )
     result = await db_session.exec(query_video)
     return result.one_or_none()  # type: ignore[return-value]
+
+
+async def moov_before_mdat(read_at: Callable[[int, int], Awaitable[bytes]], size: int) -> bool | None:
+    """
+    Walk the top level MP4 atoms using `read_at(offset, length)`, reading only the atom headers.
+    True if `moov` comes before `mdat`, so playback can start before the whole file is downloaded.
+    None if the file doesn't look like an MP4.
+    """
+    offset = 0
+    while offset + 8 <= size:
+        header = await read_at(offset, 16)
+        if len(header) < 8:
+            return None
+        atom_size, atom_type = struct.unpack('>I4s', header[:8])
+        if atom_size == 1 and len(header) == 16:
+            atom_size = struct.unpack('>Q', header[8:])[0]  # 64-bit size
+        elif atom_size == 0:
+            atom_size = size - offset  # Atom runs to the end of the file
+        if atom_type == b'moov':
+            return True
+        if atom_type == b'mdat':
+            return False
+        if atom_size < 8:
+            return None
+        offset += atom_size
+    return None
+
+
+async def faststart_file(path: str) -> tuple[str | None, bool]:
+    """
+    Remux a local MP4 with `moov` first, if it isn't already.
+    Returns the name of the remuxed file (removed by the caller), or None if no remux was needed,
+    and whether the resulting file is faststart.
+    """
+    async with aiofiles.open(path, 'rb') as video:
+
+        async def read_at(offset: int, length: int) -> bytes:
+            await video.seek(offset)
+            return await video.read(length)
+
+        is_faststart = await moov_before_mdat(read_at, size=await os.path.getsize(path))
+    if is_faststart is None:
+        return None, False
+    if is_faststart:
+        return None, True
+
+    remuxed_name = f'{uuid4().hex}.mp4'
+    await await_ffmpeg(functools.partial(generate_faststart, path, remuxed_name))
+    return remuxed_name, True
+
+
+def s3_key_from_uri(uri: str) -> str:
+    """
+    Turn a public CDN link back into the S3 key it points to
+    """
+    return uri.split('https://gg.klepp.me/')[1]
+
+
+async def delete_s3_objects(boto_session: AioBaseClient, keys: list[str], concurrency: int = 4) -> list[str]:
+    """
+    Delete keys using batched `delete_objects` calls, with at most `concurrency` calls in flight.
+    Returns the keys S3 was unable to delete.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def delete_batch(batch: list[str]) -> list[str]:
+        async with semaphore:
+            response = await boto_session.delete_objects(
+                Bucket=settings.S3_BUCKET_URL,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True},
+            )
+        return [error['Key'] for error in response.get('Errors', [])]
+
+    batches = [keys[i : i + S3_DELETE_BATCH_SIZE] for i in range(0, len(keys), S3_DELETE_BATCH_SIZE)]
+    failed = await asyncio.gather(*(delete_batch(batch) for batch in batches))
+    return [key for batch in failed for key in batch]
+
+
+async def list_s3_keys(boto_session: AioBaseClient, prefix: str) -> list[str]:
+    """
+    List every key below a prefix
+    """
+    paginator = boto_session.get_paginator('list_objects_v2')
+    keys: list[str] = []
+    async for page in paginator.paginate(Bucket=settings.S3_BUCKET_URL, Prefix=prefix):
+        keys.extend(item['Key'] for item in page.get('Contents', []))
+    return keys
+
+
+async def download_object(boto_session: AioBaseClient, key: str, name: str) -> None:
+    """
+    Stream an S3 object to disk
+    """
+    response = await boto_session.get_object(Bucket=settings.S3_BUCKET_URL, Key=key)
+    with span('file.download', key=key, bytes=response.get('ContentLength', 0)):
+        async with response['Body'] as body, aiofiles.open(name, 'wb') as file:
+            while chunk := await body.read(DOWNLOAD_CHUNK_SIZE):
+                await file.write(chunk)
+
+
+async def upload_objects(boto_session: AioBaseClient, objects: dict[str, bytes], concurrency: int = 4) -> None:
+    """
+    Upload objects from memory, by key
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upload(key: str, body: bytes) -> None:
+        async with semaphore:
+            await boto_session.put_object(
+                Bucket=settings.S3_BUCKET_URL,
+                Key=key,
+                Body=body,
+                ACL='public-read',
+                ContentType=CONTENT_TYPES.get(Path(key).suffix, 'application/octet-stream'),
+            )
+
+    await asyncio.gather(*(upload(key, body) for key, body in objects.items()))
+
+
+async def upload_directory(boto_session: AioBaseClient, directory: str, prefix: str, concurrency: int = 4) -> None:
+    """
+    Upload every file in a directory below `prefix`, keeping the relative paths
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upload(file: Path) -> None:
+        async with semaphore, aiofiles.open(file, 'rb') as content:
+            await boto_session.put_object(
+                Bucket=settings.S3_BUCKET_URL,
+                Key=f'{prefix}{file.relative_to(directory).as_posix()}',
+                Body=await content.read(),
+                ACL='public-read',
+                ContentType=CONTENT_TYPES.get(file.suffix, 'application/octet-stream'),
+            )
+
+    await asyncio.gather(*(upload(file) for file in Path(directory).rglob('*') if file.is_file()))
+
+
+@dataclass
+class UnusedObjects:
+    """
+    S3 objects no video references anymore. Everything below a prefix is unused as well.
+    """
+
+    keys: list[str] = field(default_factory=list)
+    prefixes: list[str] = field(default_factory=list)
+    # Paths of the deleted videos every key and prefix belonged to
+    owners: dict[str, list[str]] = field(default_factory=dict)
+
+    def add(self, paths: list[str], keys: tuple[str, ...] = (), prefix: str | None = None) -> None:
+        """
+        Mark keys and a prefix of the videos at `paths` as unused
+        """
+        self.keys.extend(keys)
+        for key in keys:
+            self.owners[key] = paths
+        if prefix is not None:
+            self.prefixes.append(prefix)
+            self.owners[prefix] = paths
+
+    def videos_of(self, keys: list[str]) -> set[str]:
+        """
+        Paths of the videos the keys belonged to
+        """
+        paths: set[str] = set()
+        for key in keys:
+            for owned in (key, *(prefix for prefix in self.prefixes if key.startswith(prefix))):
+                paths.update(self.owners.get(owned, ()))
+        return paths
+
+    async def list_keys(self, boto_session: AioBaseClient) -> list[str]:
+        """
+        Every unused key, including the ones below the prefixes
+        """
+        listed = await asyncio.gather(*(list_s3_keys(boto_session, prefix) for prefix in self.prefixes))
+        return self.keys + [key for keys in listed for key in keys]
+
+
+def blob_key(sha256: str) -> str:
+    """
+    S3 key of a content addressed video
+    """
+    return f'blobs/{sha256}.mp4'
+
+
+def blob_prefix(sha256: str) -> str:
+    """
+    S3 prefix of everything generated from a content addressed video
+    """
+    return f'blobs/{sha256}/'
+
+
+def video_asset_prefix(video: Video) -> str:
+    """
+    S3 prefix of everything generated from a video. Blob videos share theirs, legacy videos get one of their own.
+    """
+    return blob_prefix(video.blob_sha256) if video.blob_sha256 else f'{video.path}/'
+
+
+def blob_thumbnails_prefix(sha256: str) -> str:
+    """
+    S3 prefix of the thumbnail variants belonging to a content addressed video
+    """
+    return f'{blob_prefix(sha256)}thumbnails/'
+
+
+def upload_staging_key(upload_id: UUID) -> str:
+    """
+    S3 key a resumable upload is assembled at, before it is stored content addressed
+    """
+    return f'uploads/{upload_id}'
+
+
+async def abort_staged_upload(boto_session: AioBaseClient, upload: Upload) -> None:
+    """
+    Abort the S3 multipart upload behind a resumable upload, and delete what was assembled.
+    Already completed or aborted multipart uploads are fine.
+    """
+    try:
+        await boto_session.abort_multipart_upload(
+            Bucket=settings.S3_BUCKET_URL, Key=upload_staging_key(upload.id), UploadId=upload.s3_upload_id
+        )
+    except ClientError as error:
+        if error.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+            raise
+    await boto_session.delete_object(Bucket=settings.S3_BUCKET_URL, Key=upload_staging_key(upload.id))
+
+
+def blob_sprites_prefix(sha256: str) -> str:
+    """
+    S3 prefix of the hover-scrub sprite and its WebVTT track belonging to a content addressed video
+    """
+    return f'{blob_prefix(sha256)}sprites/'
+
+
+def blob_hls_prefix(sha256: str) -> str:
+    """
+    S3 prefix of the HLS playlists and segments belonging to a content addressed video
+    """
+    return f'{blob_prefix(sha256)}hls/'
+
+
+async def acquire_existing_blob(sha256: str, db_session: AsyncSession) -> bool:
+    """
+    Add a reference to a blob if we already have it stored.
+    The blob row stays locked until the transaction is committed.
+    """
+    result = await db_session.exec(
+        update(Blob).where(Blob.sha256 == sha256).values(refcount=Blob.refcount + 1).returning(Blob.key)  # type: ignore
+    )
+    return result.one_or_none() is not None
+
+
+async def acquire_new_blob(sha256: str, size: int, db_session: AsyncSession) -> None:
+    """
+    Register a blob that has been uploaded to S3. Someone else might have uploaded the same bytes in the meantime,
+    in which case we add a reference to theirs instead, since the object is the same.
+    """
+    statement = (
+        insert(Blob)
+        .values(sha256=sha256, key=blob_key(sha256), size=size, refcount=1, created_at=datetime.now(timezone.utc))
+        .on_conflict_do_update(index_elements=['sha256'], set_={'refcount': Blob.refcount + 1})
+    )
+    await db_session.exec(statement)
+
+
+async def read_placeholder(name: str) -> str | None:
+    """
+    Read a generated placeholder as a data URI, and remove the file. None if it turned out too large to inline.
+    """
+    async with aiofiles.open(name, 'rb') as placeholder:
+        data = await placeholder.read()
+    await os.remove(name)
+    return placeholder_data_uri(data)
+
+
+def placeholder_data_uri(data: bytes) -> str | None:
+    """
+    Encode a WebP placeholder as a data URI. None if it is too large to inline.
+    """
+    data_uri = f'data:image/webp;base64,{base64.b64encode(data).decode()}'
+    return data_uri if len(data_uri) <= PLACEHOLDER_MAX_LENGTH else None
+
+
+async def create_placeholder(path: str) -> str | None:
+    """
+    Generate a placeholder data URI of a local file or URL
+    """
+    placeholder_name = f'{uuid4().hex}.webp'
+    await await_ffmpeg(functools.partial(generate_placeholder, path, placeholder_name))
+    return await read_placeholder(placeholder_name)
+
+
+async def create_thumbnails(
+    boto_session: AioBaseClient,
+    path: str,
+    prefix: str,
+    widths: tuple[int, ...],
+    square: bool = False,
+) -> dict[str, Any]:
+    """
+    Generate thumbnail variants of a local file or URL, and upload them below `prefix`.
+    Returns `thumbnail_uri` (the JPEG fallback), `thumbnail_variants` for `srcset` and the inline `placeholder`.
+    """
+    fallback_width = max(widths)
+    directory = uuid4().hex
+    placeholder_name = f'{directory}.webp'
+    await os.makedirs(directory)
+    try:
+        await await_ffmpeg(
+            functools.partial(
+                generate_thumbnail_variants, path, directory, widths, fallback_width, square, placeholder_name
+            )
+        )
+        await upload_directory(boto_session, directory=directory, prefix=prefix)
+        placeholder = await read_placeholder(placeholder_name)
+    finally:
+        await asyncio.to_thread(shutil.rmtree, directory, ignore_errors=True)
+
+    return thumbnail_fields(prefix=prefix, widths=widths, fallback_width=fallback_width, placeholder=placeholder)
+
+
+def thumbnail_fields(
+    prefix: str, widths: tuple[int, ...], fallback_width: int, placeholder: str | None
+) -> dict[str, Any]:
+    """
+    Thumbnail columns for variants uploaded below `prefix`
+    """
+    fallback_uri = f'https://gg.klepp.me/{prefix}{fallback_width}.jpg'
+    variants = [
+        {'width': width, 'format': 'webp', 'uri': f'https://gg.klepp.me/{prefix}{width}.webp'} for width in widths
+    ]
+    variants.append({'width': fallback_width, 'format': 'jpeg', 'uri': fallback_uri})
+    return {'thumbnail_uri': fallback_uri, 'thumbnail_variants': variants, 'placeholder': placeholder}
+
+
+async def create_profile_picture(boto_session: AioBaseClient, data: bytes, prefix: str) -> dict[str, Any]:
+    """
+    Scale a profile picture in memory on the image threads, and upload the variants below `prefix`.
+    Returns the same fields as `create_thumbnails`. Raises `ImageTooLarge` or `InvalidImage`.
+    """
+    fallback_width = max(USER_THUMBNAIL_WIDTHS)
+    files = await asyncio.get_running_loop().run_in_executor(
+        image_executor, render_profile_picture, data, USER_THUMBNAIL_WIDTHS, fallback_width
+    )
+    placeholder = placeholder_data_uri(files.pop('placeholder.webp'))
+    await upload_objects(boto_session, {f'{prefix}{name}': body for name, body in files.items()})
+    return thumbnail_fields(
+        prefix=prefix, widths=USER_THUMBNAIL_WIDTHS, fallback_width=fallback_width, placeholder=placeholder
+    )
+
+
+async def delete_videos(videos: list[Video], db_session: AsyncSession) -> UnusedObjects:
+    """
+    Delete videos and their link table rows, drop their references to blobs, and return the S3 objects that are
+    no longer used by any video.
+    Delete the returned objects before committing, so a concurrent upload of the same bytes waits for the blob lock
+    and uploads a fresh copy instead of pointing to an object we are about to delete.
+    """
+    unused = UnusedObjects()
+    blob_references: defaultdict[str, list[str]] = defaultdict(list)
+    for video in videos:
+        if video.blob_sha256:
+            blob_references[video.blob_sha256].append(video.path)
+        else:
+            # Legacy videos own their objects
+            keys = (video.path, s3_key_from_uri(video.thumbnail_uri)) if video.thumbnail_uri else (video.path,)
+            unused.add([video.path], keys=keys, prefix=video_asset_prefix(video))
+
+    paths = [video.path for video in videos]
+    await db_session.exec(delete(VideoTagLink).where(VideoTagLink.video_path.in_(paths)))  # type: ignore
+    await db_session.exec(delete(VideoLikeLink).where(VideoLikeLink.video_path.in_(paths)))  # type: ignore
+    await db_session.exec(delete(VideoLikeCount).where(VideoLikeCount.video_path.in_(paths)))  # type: ignore
+    await db_session.exec(delete(VideoTrending).where(VideoTrending.video_path.in_(paths)))  # type: ignore
+    await db_session.exec(delete(Video).where(Video.path.in_(paths)))  # type: ignore
+
+    for sha256, references in blob_references.items():
+        result = await db_session.exec(
+            update(Blob)  # type: ignore
+            .where(Blob.sha256 == sha256)
+            .values(refcount=Blob.refcount - len(references))
+            .returning(Blob.refcount, Blob.key)
+        )
+        row = result.one_or_none()
+        if row is None or row.refcount > 0:
+            continue
+        await db_session.exec(delete(Blob).where(Blob.sha256 == sha256))
+        unused.add(references, keys=(row.key,), prefix=blob_prefix(sha256))
+    return unused
+
+
+async def shared_media_fields(sha256: str, db_session: AsyncSession) -> dict[str, Any]:
+    """
+    Media fields of another video pointing to the same blob, so a duplicate upload doesn't have to generate them
+    """
+    result = await db_session.exec(select(Video).where(Video.blob_sha256 == sha256).limit(1))
+    if sibling := result.first():
+        return {name: getattr(sibling, name) for name in MEDIA_FIELDS}
+    return {}
+
+
+async def transcode_hls(
+    sha256: str, temp_video_name: str, probe: dict[str, Any], boto_session: AioBaseClient, db_session: AsyncSession
+) -> None:
+    """
+    Generate HLS renditions next to a blob, and point every video using the blob to the master playlist
+    """
+    has_audio = any(stream.get('codec_type') == 'audio' for stream in probe.get('streams', []))
+    source_height = video_stream(probe).get('height', 0)
+    renditions = [rendition for rendition in HLS_RENDITIONS if rendition.height < source_height]
+
+    directory = uuid4().hex
+    await os.makedirs(directory)
+    try:
+        await await_ffmpeg(functools.partial(generate_hls, temp_video_name, directory, renditions, has_audio))
+        await upload_directory(boto_session, directory=directory, prefix=blob_hls_prefix(sha256))
+    finally:
+        await asyncio.to_thread(shutil.rmtree, directory, ignore_errors=True)
+
+    hls_uri = f'https://gg.klepp.me/{blob_hls_prefix(sha256)}master.m3u8'
+    await db_session.exec(update(Video).where(Video.blob_sha256 == sha256).values(hls_uri=hls_uri))
+    await db_session.commit()
+    log.info('Generated %s HLS renditions for blob %s', len(renditions) + 1, sha256)
+
+
+async def create_sprite(
+    sha256: str, temp_video_name: str, probe: dict[str, Any], boto_session: AioBaseClient, db_session: AsyncSession
+) -> None:
+    """
+    Generate a hover-scrub sprite and WebVTT track next to a blob, and point every video using the blob to the track
+    """
+    stream = video_stream(probe)
+    duration = video_metadata(probe).get('duration')
+    if not duration or not stream.get('width') or not stream.get('height'):
+        log.info('Not generating a sprite for blob %s, unknown duration or resolution', sha256)
+        return
+
+    frames = max(1, min(SPRITE_MAX_FRAMES, int(duration // SPRITE_MIN_INTERVAL)))
+    # Frames in the middle of their interval, never past the end of the video
+    timestamps = [duration * (index + 0.5) / frames for index in range(frames)]
+    # An explicit, even tile height, so the track coordinates match the sprite exactly
+    tile_height = max(2, round(SPRITE_TILE_WIDTH * stream['height'] / stream['width'] / 2) * 2)
+
+    directory = uuid4().hex
+    await os.makedirs(directory)
+    try:
+        await await_ffmpeg(
+            functools.partial(
+                generate_sprite, temp_video_name, f'{directory}/sprite.webp', timestamps, SPRITE_TILE_WIDTH, tile_height
+            )
+        )
+        async with aiofiles.open(f'{directory}/sprite.vtt', 'w') as track:
+            await track.write(sprite_vtt('sprite.webp', duration, frames, SPRITE_TILE_WIDTH, tile_height))
+        await upload_directory(boto_session, directory=directory, prefix=blob_sprites_prefix(sha256))
+    finally:
+        await asyncio.to_thread(shutil.rmtree, directory, ignore_errors=True)
+
+    sprite_vtt_uri = f'https://gg.klepp.me/{blob_sprites_prefix(sha256)}sprite.vtt'
+    await db_session.exec(update(Video).where(Video.blob_sha256 == sha256).values(sprite_vtt_uri=sprite_vtt_uri))
+    await db_session.commit()
+    log.info('Generated a sprite with %s frames for blob %s', frames, sha256)
+
+
+# Background stages run after an upload. A failing stage is logged, and doesn't stop the ones after it.
+MEDIA_STAGES = (create_sprite, transcode_hls)
+
+
+async def process_media(sha256: str, temp_video_name: str, probe: dict[str, Any]) -> None:
+    """
+    Background media pipeline for newly stored blobs, run after the upload has been committed.
+    `probe` is the ffprobe result from the upload, so the file is only probed once.
+    Takes ownership of `temp_video_name`, and removes it when done.
+    """
+    try:
+        async with s3_client() as boto_session, AsyncSession(ASYNC_ENGINE, expire_on_commit=False) as db_session:
+            for stage in MEDIA_STAGES:
+                try:
+                    await stage(
+                        sha256=sha256,
+                        temp_video_name=temp_video_name,
+                        probe=probe,
+                        boto_session=boto_session,
+                        db_session=db_session,
+                    )
+                except Exception as error:
+                    log.exception('Media stage %s failed for blob %s. Error: %s', stage.__name__, sha256, error)
+                    await db_session.rollback()
+    except Exception as error:
+        log.exception('Media pipeline failed for blob %s. Error: %s', sha256, error)
+    finally:
+        await os.remove(temp_video_name)
@@ -0,0 +1,91 @@
+import asyncio
+import bisect
+import heapq
+import logging
+import time
+from typing import NamedTuple
+
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.config import settings
+from app.core.db import ASYNC_ENGINE
+from app.models.klepp import Tag, TagStats
+
+log = logging.getLogger(__name__)
+
+
+class TagEntry(NamedTuple):
+    key: str
+    name: str
+    video_count: int
+
+
+class TagIndex:
+    """
+    Per-worker prefix index of every tag, for autocomplete without a database round trip per keystroke.
+    Tags are kept sorted on their lower case name, so the tags starting with a prefix are one contiguous slice.
+    The index is reloaded in the background once it is older than `TAG_INDEX_REFRESH_SECONDS`, or invalidated.
+    """
+
+    def __init__(self) -> None:
+        self.entries: list[TagEntry] = []
+        self.keys: list[str] = []
+        self.loaded_at: float | None = None
+        self.refresh_task: asyncio.Task | None = None
+
+    async def load(self) -> None:
+        """
+        Load every tag with the number of videos using it
+        """
+        statement = select(Tag.name, TagStats.video_count).join(
+            TagStats,
+            TagStats.tag_id == Tag.id,
+        )
+        async with AsyncSession(ASYNC_ENGINE) as db_session:
+            rows = (await db_session.exec(statement)).all()
+        entries = sorted(TagEntry(key=name.lower(), name=name, video_count=count) for name, count in rows)
+        # Swap both lists at once, readers never see a half built index
+        self.entries, self.keys = entries, [entry.key for entry in entries]
+        self.loaded_at = time.monotonic()
+        log.info('Loaded %s tags into the tag index', len(entries))
+
+    async def load_or_log(self) -> None:
+        """
+        Load the index, logging instead of raising, so a database hiccup doesn't take the worker down
+        """
+        try:
+            await self.load()
+        except Exception as error:
+            log.exception('Unable to load the tag index. Error: %s', error)
+
+    def invalidate(self) -> None:
+        """
+        Mark the index as outdated, it is reloaded on the next lookup
+        """
+        self.loaded_at = None
+
+    def refresh_if_stale(self) -> None:
+        """
+        Reload the index in the background if it is outdated. Lookups keep using the current index meanwhile.
+        """
+        if self.refresh_task and not self.refresh_task.done():
+            return
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < settings.TAG_INDEX_REFRESH_SECONDS:
+            return
+        self.refresh_task = asyncio.create_task(self.load_or_log())
+
+    def suggest(self, prefix: str, limit: int) -> list[TagEntry]:
+        """
+        Tags starting with `prefix`, case insensitive, the ones used by the most videos first
+        """
+        self.refresh_if_stale()
+        prefix = prefix.lower()
+        entries, keys = self.entries, self.keys
+        start = bisect.bisect_left(keys, prefix)
+        # Every key starting with `prefix` sorts before `prefix` followed by the highest code point
+        end = bisect.bisect_right(keys, prefix + '\U0010ffff', lo=start)
+        return heapq.nsmallest(limit, entries[start:end], key=lambda entry: (-entry.video_count, entry.key))
+
+
+tag_index = TagIndex()
@@ -0,0 +1,133 @@
+"""
+Worker warmup, and the probes telling the load balancer when to route to a worker.
+
+* `/healthz` answers as soon as the worker serves requests, restart it if this fails.
+* `/readyz` answers 503 until the primary database pool is open, so the first requests don't pay for connecting.
+
+Cognito, the tag index and the replica are warmed up too, but don't hold readiness back, since requests load them
+on demand if they're slow or down.
+"""
+
+import asyncio
+import importlib
+import logging
+import time
+
+from fastapi import APIRouter, status
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.api.replica import replica_monitor
+from app.api.security import cognito_scheme, cognito_scheme_or_anonymous
+from app.api.tag_index import tag_index
+from app.core.db import ASYNC_ENGINE, REPLICA_ENGINE
+
+log = logging.getLogger(__name__)
+
+# Imported lazily by the modules using them, but needed by nearly every signed in request
+WARM_IMPORTS = ('jose.jwt', 'jose.backends.cryptography_backend')
+DATABASE_RETRY_SECONDS = 2
+
+router = APIRouter(include_in_schema=False)
+
+
+async def open_pool(engine: AsyncEngine) -> None:
+    """
+    Open every connection the pool keeps, at the same time so none of them is reused
+    """
+
+    async def connect() -> None:
+        async with engine.connect() as connection:
+            await connection.execute(text('SELECT 1'))
+
+    await asyncio.gather(*(connect() for _ in range(engine.pool.size())))  # type: ignore
+
+
+async def load_openid_configs() -> None:
+    """
+    Fetch the Cognito signing keys, logging instead of raising since every request retries
+    """
+    for scheme in (cognito_scheme, cognito_scheme_or_anonymous):
+        try:
+            await scheme.openid_config.load_config()
+        except Exception as error:
+            log.warning('Cognito is not available yet, retrying on the first signed in request. Error: %s', error)
+            return
+
+
+async def warm_replica() -> None:
+    """
+    Measure the replica lag, and open its pool if reads can go there
+    """
+    await replica_monitor.check()
+    if REPLICA_ENGINE is not None and replica_monitor.usable():
+        await open_pool(REPLICA_ENGINE)
+
+
+class Warmup:
+    def __init__(self) -> None:
+        self.ready = False
+        self.tasks: set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        """
+        Warm up in the background, the worker answers `/healthz` meanwhile
+        """
+        started = time.monotonic()
+        for module in WARM_IMPORTS:
+            importlib.import_module(module)
+        optional = [load_openid_configs(), tag_index.load_or_log()]
+        if REPLICA_ENGINE is not None:
+            optional.append(warm_replica())
+        for coroutine in (*optional, self.open_primary(started)):
+            task = asyncio.create_task(coroutine)
+            # The event loop only keeps weak references to tasks
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def open_primary(self, started: float) -> None:
+        """
+        Open the primary pool, retrying until the database is reachable, then report ready
+        """
+        while True:
+            try:
+                await open_pool(ASYNC_ENGINE)
+                break
+            except Exception as error:
+                log.warning(
+                    'Unable to connect to the database, retrying in %ss. Error: %s', DATABASE_RETRY_SECONDS, error
+                )
+                await asyncio.sleep(DATABASE_RETRY_SECONDS)
+        self.ready = True
+        log.info('Worker ready in %.2fs', time.monotonic() - started)
+
+    async def stop(self) -> None:
+        """
+        Report not ready, and cancel warmup still in progress
+        """
+        self.ready = False
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+warmup = Warmup()
+
+
+@router.get('/healthz')
+async def healthz() -> dict[str, str]:
+    """
+    The worker is alive
+    """
+    return {'status': 'ok'}
+
+
+@router.get('/readyz')
+async def readyz() -> JSONResponse:
+    """
+    The worker is warm, and can take traffic
+    """
+    if not warmup.ready:
+        return JSONResponse({'status': 'warming up'}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return JSONResponse({'status': 'ready'})
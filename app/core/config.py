@@ -25,14 +25,83 @@ class Settings(AWS):
     TESTING: bool = Field(default=False)
     SECRET_KEY: str = Field(...)
     DATABASE_URL: str = Field(..., alias='AZURE_DATABASE_URL')
+    REPLICA_DATABASE_URL: str | None = Field(default=None)  # Read replica for read-only endpoints, if any
 
-    @field_validator('DATABASE_URL', mode='before')
+    @field_validator('DATABASE_URL', 'REPLICA_DATABASE_URL', mode='before')
     @classmethod
-    def fix_postgres_url(cls, value: str) -> str:
+    def fix_postgres_url(cls, value: str | None) -> str | None:
         """
         Replace Heroku postgres connection string to an async one, and change the prefix
         """
-        return value.replace('postgres://', 'postgresql+asyncpg://')
+        return value.replace('postgres://', 'postgresql+asyncpg://') if value else value
+
+    # Read replica, see `app/api/replica.py`
+    REPLICA_MAX_LAG_SECONDS: float = Field(default=5)  # Reads go to the primary while the replica is further behind
+    REPLICA_LAG_CHECK_SECONDS: float = Field(default=2)
+    READ_YOUR_WRITES_SECONDS: float = Field(default=10)  # Reads go to the primary this long after a user writes
+
+    # Media pipeline
+    MEDIA_WORKERS: int = Field(default=2)  # Concurrent ffmpeg processes per worker
+    HLS_SEGMENT_SECONDS: int = Field(default=4)
+    IMAGE_WORKERS: int = Field(default=2)  # Threads scaling profile pictures in process
+    PROFILE_PICTURE_MAX_BYTES: int = Field(default=10 * 1024 * 1024)
+    PROFILE_PICTURE_MAX_PIXELS: int = Field(default=40_000_000)  # Rejects decompression bombs before decoding
+
+    # Resumable uploads, every chunk but the last must be exactly `UPLOAD_PART_SIZE` bytes (S3 needs >= 5 MiB)
+    UPLOAD_PART_SIZE: int = Field(default=8 * 1024 * 1024)
+    UPLOAD_MAX_BYTES: int = Field(default=10 * 1024 * 1024 * 1024)
+    UPLOAD_EXPIRE_HOURS: int = Field(default=24)  # Unfinished uploads are aborted by the reaper
+
+    # Load shedding, see `app/api/admission.py`. Past these, low priority requests are refused with 503
+    SHED_MAX_IN_FLIGHT: int = Field(default=100)  # Requests in progress per worker
+    SHED_MAX_POOL_WAIT_SECONDS: float = Field(default=0.5)
+    SHED_MAX_LOOP_LAG_SECONDS: float = Field(default=0.25)
+
+    # Event loop monitor, see `app/api/loop_monitor.py`. Logs the stack of callbacks blocking the loop this long
+    LOOP_BLOCKED_SECONDS: float = Field(default=0.1)
+
+    # Logging, see `app/core/logging_config.py`
+    LOG_LEVEL: str = Field(default='INFO')
+    LOG_JSON: bool = Field(default=True)  # One JSON object per line, otherwise readable lines
+    # Share of the lines below WARNING kept per logger, and its children
+    LOG_SAMPLE_RATES: dict[str, float] = Field(default={'sqlalchemy.engine': 0.01, 'botocore': 0.01, 'httpx': 0.1})
+
+    # Request tracing, see `app/core/tracing.py`. Off unless spans have somewhere to go
+    TRACE_FILE: str | None = Field(default=None)  # Spans as JSON lines
+    TRACE_COLLECTOR_URL: str | None = Field(
+        default=None
+    )  # OTLP/HTTP JSON endpoint, e.g. http://collector:4318/v1/traces
+
+    # Request profiler, see `app/api/profiler.py`. Collapsed stacks are written to `PROFILE_DIRECTORY`
+    PROFILE_TOKEN: str | None = Field(default=None)  # Requests with this `X-Profile` header are always profiled
+    PROFILE_ROUTES: list[str] = Field(default=[])  # Paths sampled at `PROFILE_SAMPLE_RATE`
+    PROFILE_SAMPLE_RATE: float = Field(default=0.01)
+    PROFILE_SLOW_SECONDS: float = Field(default=1)  # Sampled profiles are kept when the request took this long
+    PROFILE_DIRECTORY: str = Field(default='profiles')
+
+    # Per-user rate limits, see `app/api/rate_limit.py`. Bursts of `*_BURST`, refilled at `*_PER_MINUTE`
+    UPLOAD_RATE_BURST: int = Field(default=10)
+    UPLOAD_RATE_PER_MINUTE: float = Field(default=2)
+    THUMBNAIL_RATE_BURST: int = Field(default=5)
+    THUMBNAIL_RATE_PER_MINUTE: float = Field(default=1)
+    LIKE_RATE_BURST: int = Field(default=60)
+    LIKE_RATE_PER_MINUTE: float = Field(default=30)
+
+    # Tag autocomplete, see `app/api/tag_index.py`
+    TAG_INDEX_REFRESH_SECONDS: int = Field(default=60)
+
+    # Trending feed, see `app/jobs/trending.py`
+    TRENDING_HALF_LIFE_HOURS: float = Field(default=24)
+
+    # Expiry reaper, see `app/jobs/reaper.py`
+    REAPER_BATCH_SIZE: int = Field(default=500)
+    REAPER_S3_CONCURRENCY: int = Field(default=4)
+
+    # Resumable uploads, see `app/api/api_v2/endpoints/video/resumable.py`. A completion running longer has failed
+    UPLOAD_COMPLETE_TIMEOUT_HOURS: float = Field(default=1)
+
+    # Catalog export, see `app/api/api_v2/endpoints/video/export.py`. Removed videos are reported this long
+    EXPORT_TOMBSTONE_RETENTION_DAYS: int = Field(default=30)
 
     # BACKEND_CORS_ORIGINS is a JSON-formatted list of origins
     BACKEND_CORS_ORIGINS: list[AnyHttpUrl] = ['http://localhost:3000', 'http://localhost:5555']  # type: ignore
@@ -1,12 +1,30 @@
+import functools
+
+from sqlalchemy import Engine
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import create_engine
 from sqlmodel.sql.expression import Select, SelectOfScalar
 
 from app.core.config import settings
+from app.core.tracing import trace_engine
 
 ASYNC_ENGINE = create_async_engine(settings.DATABASE_URL, echo=False)  # echo can be True/False or 'debug'
+REPLICA_ENGINE = (
+    create_async_engine(settings.REPLICA_DATABASE_URL, echo=False) if settings.REPLICA_DATABASE_URL else None
+)
+for engine in (ASYNC_ENGINE, REPLICA_ENGINE):
+    if engine is not None:
+        trace_engine(engine)
+
+
+@functools.cache
+def get_sync_engine() -> Engine:
+    """
+    Synchronous engine, for the shell and scripts. Created on first use, since it imports psycopg2 and the app
+    itself only uses `ASYNC_ENGINE`.
+    """
+    return create_engine(settings.DATABASE_URL.replace('+asyncpg', ''), echo='debug')
 
-SYNC_ENGINE = create_engine(settings.DATABASE_URL.replace('+asyncpg', ''), echo='debug')
 
 SelectOfScalar.inherit_cache = True  # type: ignore
 Select.inherit_cache = True  # type: ignore
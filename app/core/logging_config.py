@@ -1,39 +1,157 @@
+"""
+Logging for the app and the jobs.
+
+Records are put on a queue by a `QueueHandler`, and a listener thread formats and writes them, so logging never does
+I/O on the event loop. Lines below WARNING from noisy loggers are sampled with `LOG_SAMPLE_RATES`.
+Output is one JSON object per line, or readable lines with `LOG_JSON=false`.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+from datetime import datetime, timezone
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any
 
 from asgi_correlation_id import CorrelationIdFilter
 
 from app.core.config import settings
 
+# Attributes every record has, anything else was passed in `extra` and goes into the JSON object
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'correlation_id'}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record, with any `extra` fields next to the message
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, Any] = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'line': record.lineno,
+            'correlation_id': getattr(record, 'correlation_id', None),
+            'message': record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keep a share of the records below WARNING from the loggers in `rates`, or their children
+    """
+
+    def __init__(self, rates: dict[str, float]) -> None:
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        while name:
+            if name in self.rates:
+                return random.random() < self.rates[name]
+            name = name.rpartition('.')[0]
+        return True
+
+
+class PreparedQueueHandler(QueueHandler):
+    """
+    Queue handler that keeps the record's `extra` fields and exception for the formatter in the listener thread.
+    The message and traceback are rendered here, so the listener never touches objects the caller may change.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
 LOGGING: dict = {
     'version': 1,
     'disable_existing_loggers': False,
     'filters': {
         'correlation_id': {'()': CorrelationIdFilter, 'uuid_length': 8 if settings.ENVIRONMENT == 'dev' else 32},
+        'sample': {'()': SampleFilter, 'rates': settings.LOG_SAMPLE_RATES},
     },
     'formatters': {
         'console': {
             'format': '%(levelname)-8s  [%(correlation_id)s] %(name)s:%(lineno)d    %(message)s',
         },
+        'json': {'()': JsonFormatter},
     },
     'handlers': {
         'console': {
             'class': 'logging.StreamHandler',
-            'filters': ['correlation_id'],
-            'formatter': 'console',
+            'formatter': 'json' if settings.LOG_JSON else 'console',
         },
     },
     'loggers': {
         # third-party packages
-        'httpx': {'level': 'DEBUG'},
+        'httpx': {'level': 'WARNING'},
         'asgi_correlation_id': {'level': 'WARNING'},
         'arq': {'level': 'INFO', 'propagate': True},
     },
-    'root': {'handlers': ['console'], 'level': 'DEBUG'},
+    'root': {'handlers': ['console'], 'level': settings.LOG_LEVEL},
 }
 
+listener: QueueListener | None = None
+
+
+def build_filter(name: str) -> logging.Filter:
+    """
+    Build a filter from its `LOGGING` configuration
+    """
+    config = dict(LOGGING['filters'][name])
+    factory = config.pop('()')
+    return factory(**config)
+
+
+def stop_logging() -> None:
+    """
+    Write out queued records and stop the listener thread
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
 
 def setup_logging() -> None:
     """
     Call this function to setup logging for the app.
+    The handlers from `LOGGING` are moved behind a queue, see the module docstring.
     """
+    global listener
+    stop_logging()
     dictConfig(LOGGING)
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    # Filters run on the caller's thread, where the correlation id is set, and before the record is queued
+    queue_handler = PreparedQueueHandler(queue.SimpleQueue())
+    for name in ('sample', 'correlation_id'):
+        queue_handler.addFilter(build_filter(name))
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,352 @@
+"""
+Request tracing, to break a slow request down into the work it waited on.
+
+Every request gets a root span from `TracingMiddleware`, with the correlation id from `asgi_correlation_id` as the
+trace id. Below it, spans are recorded for auth, every SQL statement, every S3 call, the wait for and run of ffmpeg,
+and temp-file I/O. Spans are only recorded within a trace, so jobs and startup don't produce any.
+The root span ends once the response is sent. Background tasks run after it, like `process_media`, are recorded in a
+trace of their own instead, below a root span linked to the request's.
+
+Finished spans are queued, and a thread exports them in batches, to `TRACE_FILE` as JSON lines and/or to
+`TRACE_COLLECTOR_URL` as OTLP/HTTP JSON (e.g. `http://collector:4318/v1/traces`). With neither set, tracing is off.
+"""
+
+import atexit
+import json
+import logging
+import queue
+import secrets
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any
+from uuid import uuid4
+
+import httpx
+from asgi_correlation_id import correlation_id
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.config import settings
+
+log = logging.getLogger(__name__)
+
+TRACE_BATCH_SIZE = 512
+TRACE_FLUSH_SECONDS = 2
+TRACE_STATEMENT_LENGTH = 1000
+
+ENABLED = bool(settings.TRACE_FILE or settings.TRACE_COLLECTOR_URL)
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    parent_id: str | None
+    span_id: str = field(default_factory=lambda: secrets.token_hex(8))
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: int | None = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: str | None = None
+    links: list[dict[str, str]] = field(default_factory=list)
+
+    def set(self, **attributes: Any) -> None:
+        """
+        Add attributes to the span
+        """
+        self.attributes.update(attributes)
+
+
+current_span: ContextVar[Span | None] = ContextVar('current_span', default=None)
+# Root spans of the background tasks of requests whose response was sent, by the span id of the request
+background_spans: dict[str, Span] = {}
+
+
+def start_span(name: str, /, root: bool = False, **attributes: Any) -> Span | None:
+    """
+    Start a span below the current one, without making it current. None when there's no trace to record it in.
+    """
+    if not ENABLED:
+        return None
+    parent = current_span.get()
+    if parent is not None and parent.parent_id is None and parent.end_ns is not None:
+        parent = background_span(parent)
+    if parent is not None:
+        return Span(name=name, trace_id=parent.trace_id, parent_id=parent.span_id, attributes=attributes)
+    if root:
+        trace_id = (correlation_id.get() or uuid4().hex).replace('-', '')
+        return Span(name=name, trace_id=trace_id, parent_id=None, attributes=attributes)
+    return None
+
+
+def background_span(request_span: Span) -> Span:
+    """
+    The root span of a finished request's background tasks, started with the first span below it
+    """
+    if (background := background_spans.get(request_span.span_id)) is None:
+        background = background_spans[request_span.span_id] = Span(
+            name=f'{request_span.name} background',
+            trace_id=uuid4().hex,
+            parent_id=None,
+            links=[{'trace_id': request_span.trace_id, 'span_id': request_span.span_id}],
+        )
+    return background
+
+
+def finish_span(span: Span | None, error: BaseException | None = None) -> None:
+    """
+    End a span and queue it for export
+    """
+    if span is None:
+        return
+    span.end_ns = time.time_ns()
+    if error is not None:
+        span.error = f'{type(error).__name__}: {error}'
+    exporter.export(span)
+
+
+@contextmanager
+def span(name: str, /, root: bool = False, **attributes: Any) -> Iterator[Span | None]:
+    """
+    Record the block as a span, current for everything it awaits or calls
+    """
+    new_span = start_span(name, root=root, **attributes)
+    if new_span is None:
+        yield None
+        return
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as error:
+        finish_span(new_span, error)
+        raise
+    else:
+        finish_span(new_span)
+    finally:
+        current_span.reset(token)
+
+
+def otlp_value(value: Any) -> dict[str, Any]:
+    """
+    An attribute value in OTLP JSON
+    """
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_span(span: Span) -> dict[str, Any]:
+    """
+    A span in OTLP JSON
+    """
+    otlp: dict[str, Any] = {
+        'traceId': span.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': 2 if span.parent_id is None else 1,  # Server for the request, internal below it
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(span.end_ns),
+        'attributes': [{'key': key, 'value': otlp_value(value)} for key, value in span.attributes.items()],
+        'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+    }
+    if span.parent_id:
+        otlp['parentSpanId'] = span.parent_id
+    if span.links:
+        otlp['links'] = [{'traceId': link['trace_id'], 'spanId': link['span_id']} for link in span.links]
+    return otlp
+
+
+class Exporter:
+    """
+    Queue of finished spans, exported in batches from a thread started on the first span
+    """
+
+    def __init__(self) -> None:
+        self.spans: queue.SimpleQueue[Span | None] = queue.SimpleQueue()
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        """
+        Queue a finished span
+        """
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='trace-exporter', daemon=True)
+                    self.thread.start()
+        self.spans.put(span)
+
+    def run(self) -> None:
+        """
+        Exporter thread, writes a batch when it is full or every `TRACE_FLUSH_SECONDS`
+        """
+        with httpx.Client(timeout=10) as client:
+            while True:
+                batch: list[Span] = []
+                deadline = time.monotonic() + TRACE_FLUSH_SECONDS
+                stopping = False
+                while len(batch) < TRACE_BATCH_SIZE and (remaining := deadline - time.monotonic()) > 0:
+                    try:
+                        span = self.spans.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if span is None:
+                        stopping = True
+                        break
+                    batch.append(span)
+                if batch:
+                    self.write(client, batch)
+                if stopping:
+                    return
+
+    def write(self, client: httpx.Client, batch: list[Span]) -> None:
+        """
+        Write a batch to the file and the collector. Failures are logged and the batch dropped.
+        """
+        try:
+            if settings.TRACE_FILE:
+                with open(settings.TRACE_FILE, 'a') as file:
+                    file.writelines(json.dumps(asdict(span)) + '\n' for span in batch)
+            if settings.TRACE_COLLECTOR_URL:
+                response = client.post(
+                    settings.TRACE_COLLECTOR_URL,
+                    json={
+                        'resourceSpans': [
+                            {
+                                'resource': {
+                                    'attributes': [
+                                        {'key': 'service.name', 'value': otlp_value(settings.PROJECT_NAME)},
+                                        {'key': 'deployment.environment', 'value': otlp_value(settings.ENVIRONMENT)},
+                                    ]
+                                },
+                                'scopeSpans': [{'scope': {'name': 'klepp'}, 'spans': [otlp_span(s) for s in batch]}],
+                            }
+                        ]
+                    },
+                )
+                response.raise_for_status()
+        except Exception as error:
+            log.warning('Unable to export %s spans. Error: %s', len(batch), error)
+
+    def stop(self) -> None:
+        """
+        Export what is queued and stop the thread
+        """
+        if self.thread is not None:
+            self.spans.put(None)
+            self.thread.join(timeout=TRACE_FLUSH_SECONDS * 2)
+            self.thread = None
+
+
+exporter = Exporter()
+atexit.register(exporter.stop)
+
+
+def trace_engine(engine: AsyncEngine) -> None:
+    """
+    Record a span for every SQL statement run by the engine
+    """
+    if not ENABLED:
+        return
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute', named=True)
+    def before_execute(statement: str, context: Any, **_: Any) -> None:
+        context.trace_span = start_span(
+            'db.' + statement.lstrip().split(None, 1)[0].lower(),
+            statement=statement[:TRACE_STATEMENT_LENGTH],
+            database=engine.url.database or '',
+            host=engine.url.host or '',
+        )
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute', named=True)
+    def after_execute(cursor: Any, context: Any, **_: Any) -> None:
+        if context.trace_span is not None:
+            context.trace_span.set(rows=cursor.rowcount)
+        finish_span(context.trace_span)
+
+    @event.listens_for(engine.sync_engine, 'handle_error')
+    def failed_execute(exception_context: Any) -> None:
+        if execution_context := exception_context.execution_context:
+            finish_span(getattr(execution_context, 'trace_span', None), exception_context.original_exception)
+
+
+def start_s3_span(params: dict[str, Any], model: Any, context: dict[str, Any], **_: Any) -> None:
+    """
+    botocore `before-parameter-build` handler, starting a span for the call
+    """
+    context['trace_span'] = start_span(
+        f's3.{model.name}', bucket=params.get('Bucket', ''), key=params.get('Key', params.get('Prefix', ''))
+    )
+
+
+def finish_s3_span(context: dict[str, Any], http_response: Any = None, exception: Any = None, **_: Any) -> None:
+    """
+    botocore `after-call` and `after-call-error` handler, ending the call's span
+    """
+    span = context.pop('trace_span', None)
+    if span is not None and http_response is not None:
+        span.set(status=http_response.status_code)
+    finish_span(span, exception)
+
+
+def trace_s3(client: Any) -> None:
+    """
+    Record a span for every call made by a boto client
+    """
+    if not ENABLED:
+        return
+    client.meta.events.register('before-parameter-build.s3', start_s3_span)
+    client.meta.events.register('after-call.s3', finish_s3_span)
+    client.meta.events.register('after-call-error.s3', finish_s3_span)
+
+
+class TracingMiddleware:
+    """
+    Record every HTTP request as the root span of a trace, until its response is sent, see the module docstring.
+    Needs to run inside `CorrelationIdMiddleware`.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or not ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        root = start_span(f'{scope["method"]} {scope["path"]}', root=True, method=scope['method'], path=scope['path'])
+        assert root is not None
+
+        def finish_request(error: BaseException | None = None) -> None:
+            if route := scope.get('route'):
+                root.set(route=getattr(route, 'path', ''))
+            finish_span(root, error)
+
+        async def send_traced(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                root.set(status=message['status'])
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False) and not root.end_ns:
+                finish_request()
+
+        token = current_span.set(root)
+        error: BaseException | None = None
+        try:
+            await self.app(scope, receive, send_traced)
+        except BaseException as exception:
+            error = exception
+            raise
+        finally:
+            if root.end_ns is None:
+                finish_request(error)
+            finish_span(background_spans.pop(root.span_id, None), error)
+            current_span.reset(token)
@@ -0,0 +1,119 @@
+"""
+Export the whole video catalog as NDJSON, the same lines `GET /files/export` streams, but for every video including
+hidden ones, read straight from the database instead of through the API.
+
+With `--since`, only videos changed since then, after a line for every video deleted since then. With `--incremental`,
+`since` is the end of the previous incremental export, stored in a checkpoint once the export is written. A `since`
+older than `EXPORT_TOMBSTONE_RETENTION_DAYS` exports everything instead, deleted videos that old are no longer known.
+
+    python -m app.jobs.export --output catalog.ndjson
+    python -m app.jobs.export --incremental --output changes.ndjson
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import TextIO
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.api.api_v2.endpoints.video.export import export_lines, export_until
+from app.core.config import settings
+from app.core.db import ASYNC_ENGINE, REPLICA_ENGINE
+from app.core.logging_config import setup_logging
+from app.models.klepp import JobCheckpoint
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT = 'export'
+
+
+@dataclass
+class ExportStats:
+    lines: int = 0
+    bytes: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def report(self, since: datetime | None, until: datetime) -> None:
+        """
+        Log a summary of the run
+        """
+        elapsed = time.monotonic() - self.started
+        log.info(
+            'Export finished%s up to %s: lines=%s size=%.1fMB duration=%.2fs (%.0f lines/s)',
+            f' from {since.isoformat()}' if since else '',
+            until.isoformat(),
+            self.lines,
+            self.bytes / 1024**2,
+            elapsed,
+            self.lines / elapsed if elapsed else 0,
+        )
+
+
+async def export_catalog(output: TextIO, since: datetime | None, incremental: bool) -> ExportStats:
+    """
+    Write every video changed since `since`, or since the checkpoint when `incremental`, to `output`
+    """
+    stats = ExportStats()
+    async with AsyncSession(ASYNC_ENGINE) as db_session:
+        if incremental and (checkpoint := await db_session.get(JobCheckpoint, CHECKPOINT)):
+            since = datetime.fromisoformat(checkpoint.position)
+        until = await export_until(db_session)
+    oldest = datetime.now(timezone.utc) - timedelta(days=settings.EXPORT_TOMBSTONE_RETENTION_DAYS)
+    if since is not None and since < oldest:
+        log.warning('%s is older than deleted videos are kept, exporting everything', since.isoformat())
+        since = None
+
+    async for lines in export_lines(
+        AsyncSession(REPLICA_ENGINE or ASYNC_ENGINE), username=None, since=since, until=until
+    ):
+        output.write(lines)
+        stats.lines += lines.count('\n')
+        stats.bytes += len(lines)
+    output.flush()
+
+    if incremental:
+        async with AsyncSession(ASYNC_ENGINE) as db_session:
+            checkpoint = await db_session.get(JobCheckpoint, CHECKPOINT) or JobCheckpoint(name=CHECKPOINT, position='')
+            checkpoint.position = until.isoformat()
+            checkpoint.updated_at = datetime.now(timezone.utc)
+            db_session.add(checkpoint)
+            await db_session.commit()
+    stats.report(since=since, until=until)
+    return stats
+
+
+def aware_datetime(value: str) -> datetime:
+    """
+    An ISO 8601 time, in UTC unless it has a timezone
+    """
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Export the video catalog as NDJSON.')
+    parser.add_argument('--output', default='-', help='File to write to, - for stdout')
+    parser.add_argument('--since', type=aware_datetime, help='Only videos changed after this time, UTC by default')
+    parser.add_argument('--incremental', action='store_true', help='Continue from the previous incremental export')
+    args = parser.parse_args()
+    if args.since and args.incremental:
+        parser.error('--since and --incremental are mutually exclusive')
+
+    setup_logging()
+    if args.output == '-':
+        asyncio.run(export_catalog(sys.stdout, since=args.since, incremental=args.incremental))
+        return
+    with open(args.output, 'w') as output:
+        asyncio.run(export_catalog(output, since=args.since, incremental=args.incremental))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Backfill for videos stored before uploads were remuxed with `moov` first.
+
+Each object is checked with a few ranged reads of its atom headers. Objects that are already faststart are only
+marked in the database, the others are downloaded, remuxed with stream copy and uploaded to the same key.
+Blob videos share their object, so every object is only processed once.
+
+    python -m app.jobs.faststart --concurrency 4 --dry-run
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from uuid import uuid4
+
+from aiobotocore.client import AioBaseClient
+from aiofiles import os
+from sqlalchemy import update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.api.api_v2.endpoints.video.upload import upload_video
+from app.api.dependencies import s3_client
+from app.api.services import download_object, faststart_file, moov_before_mdat, s3_key_from_uri
+from app.core.config import settings
+from app.core.db import ASYNC_ENGINE
+from app.core.logging_config import setup_logging
+from app.models.klepp import Video
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class FaststartStats:
+    objects: int = 0
+    already_faststart: int = 0
+    remuxed: int = 0
+    skipped: int = 0
+    failed: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def report(self, dry_run: bool) -> None:
+        """
+        Log a summary of the run
+        """
+        log.info(
+            'Faststart backfill finished%s: objects=%s already_faststart=%s remuxed=%s skipped=%s failed=%s '
+            'duration=%.2fs',
+            ' (dry run)' if dry_run else '',
+            self.objects,
+            self.already_faststart,
+            self.remuxed,
+            self.skipped,
+            self.failed,
+            time.monotonic() - self.started,
+        )
+
+
+async def object_is_faststart(boto_session: AioBaseClient, key: str) -> bool | None:
+    """
+    Check an S3 object with ranged reads of the atom headers, without downloading it
+    """
+    head = await boto_session.head_object(Bucket=settings.S3_BUCKET_URL, Key=key)
+
+    async def read_at(offset: int, length: int) -> bytes:
+        response = await boto_session.get_object(
+            Bucket=settings.S3_BUCKET_URL, Key=key, Range=f'bytes={offset}-{offset + length - 1}'
+        )
+        async with response['Body'] as body:
+            return await body.read()
+
+    return await moov_before_mdat(read_at, size=head['ContentLength'])
+
+
+async def optimize_object(
+    boto_session: AioBaseClient, uri: str, semaphore: asyncio.Semaphore, stats: FaststartStats, dry_run: bool
+) -> bool:
+    """
+    Make sure the object behind `uri` is faststart. Returns whether it now is.
+    """
+    key = s3_key_from_uri(uri)
+    async with semaphore:
+        try:
+            is_faststart = await object_is_faststart(boto_session, key)
+            if is_faststart is None:
+                log.warning('%s does not look like an MP4, skipping', key)
+                stats.skipped += 1
+                return False
+            if is_faststart:
+                stats.already_faststart += 1
+                return True
+            if dry_run:
+                log.info('Would remux %s', key)
+                stats.remuxed += 1
+                return False
+
+            temp_video_name = f'{uuid4().hex}.mp4'
+            try:
+                await download_object(boto_session, key=key, name=temp_video_name)
+                remuxed_name, faststart = await faststart_file(temp_video_name)
+                if remuxed_name:
+                    await upload_video(boto_session=boto_session, path=key, temp_video_name=remuxed_name)
+                    await os.remove(remuxed_name)
+            finally:
+                await os.remove(temp_video_name)
+            stats.remuxed += 1
+            return faststart
+        except Exception as error:
+            log.exception('Unable to remux %s. Error: %s', key, error)
+            stats.failed += 1
+            return False
+
+
+async def backfill(batch_size: int, concurrency: int, dry_run: bool) -> FaststartStats:
+    """
+    Remux every object that isn't marked as faststart yet, one batch of objects at a time
+    """
+    stats = FaststartStats()
+    semaphore = asyncio.Semaphore(concurrency)
+    after = ''
+    async with s3_client() as boto_session, AsyncSession(ASYNC_ENGINE, expire_on_commit=False) as db_session:
+        while True:
+            statement = (
+                select(Video.uri)
+                .where(Video.faststart == False, Video.uri > after)  # noqa: E712
+                .distinct()
+                .order_by(Video.uri)
+                .limit(batch_size)
+            )
+            uris = (await db_session.exec(statement)).all()
+            if not uris:
+                break
+            after = uris[-1]
+            stats.objects += len(uris)
+
+            results = await asyncio.gather(
+                *(optimize_object(boto_session, uri, semaphore=semaphore, stats=stats, dry_run=dry_run) for uri in uris)
+            )
+            if not dry_run and (
+                optimized := [uri for uri, is_faststart in zip(uris, results, strict=True) if is_faststart]
+            ):
+                await db_session.exec(update(Video).where(Video.uri.in_(optimized)).values(faststart=True))  # type: ignore
+                await db_session.commit()
+            log.info('Processed %s objects, last %s', stats.objects, after)
+    stats.report(dry_run=dry_run)
+    return stats
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Remux stored videos so `moov` comes before `mdat`.')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=settings.MEDIA_WORKERS * 2)
+    parser.add_argument('--dry-run', action='store_true', help='Check the objects without changing anything')
+    args = parser.parse_args()
+
+    setup_logging()
+    asyncio.run(backfill(batch_size=args.batch_size, concurrency=args.concurrency, dry_run=args.dry_run))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+"""
+Import videos the v1 API stored directly in the bucket, as `<username>/<file>.mp4` or `<username>/hidden/<file>.mp4`,
+into `Video` rows the v2 API can list.
+
+The bucket is split into the top level user prefixes, which are imported in batches: the prefixes of a batch are
+listed concurrently, missing users and videos are created with bulk inserts, and thumbnails are generated for
+imported videos without them, from the first frame read through the CDN with range requests.
+After every batch its last prefix is stored in a checkpoint, and the next run continues after it.
+
+Existing rows are left alone, so the import can be repeated. Imported videos don't expire, like they didn't in v1.
+Metadata and faststart are filled in by `app.jobs.metadata` and `app.jobs.faststart`, failed thumbnails by
+`app.jobs.thumbnails`.
+
+    python -m app.jobs.legacy_import --concurrency 4 --list-concurrency 16
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any
+from uuid import UUID, uuid4
+
+from aiobotocore.client import AioBaseClient
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.api.dependencies import s3_client
+from app.api.services import VIDEO_THUMBNAIL_WIDTHS, create_thumbnails, video_asset_prefix
+from app.core.config import settings
+from app.core.db import ASYNC_ENGINE
+from app.core.logging_config import setup_logging
+from app.models.klepp import JobCheckpoint, User, Video
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT = 'legacy_import'
+# Top level prefixes the v2 API writes to, never user folders
+RESERVED_PREFIXES = {'blobs/', 'uploads/'}
+
+
+@dataclass
+class ImportStats:
+    prefixes: int = 0
+    objects: int = 0
+    bytes: int = 0
+    users: int = 0
+    videos: int = 0
+    thumbnails: int = 0
+    failed: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def progress(self, total_prefixes: int, position: str) -> None:
+        """
+        Log how far the import has come, and its throughput so far
+        """
+        elapsed = time.monotonic() - self.started
+        log.info(
+            'Imported %s/%s prefixes up to %s: objects=%s users=%s videos=%s thumbnails=%s failed=%s '
+            '(%.1f objects/s, %.1f videos/s, %.2f thumbnails/s)',
+            self.prefixes,
+            total_prefixes,
+            position,
+            self.objects,
+            self.users,
+            self.videos,
+            self.thumbnails,
+            self.failed,
+            self.objects / elapsed,
+            self.videos / elapsed,
+            self.thumbnails / elapsed,
+        )
+
+    def report(self) -> None:
+        """
+        Log a summary of the run
+        """
+        log.info(
+            'Legacy import finished: prefixes=%s objects=%s size=%.1fGB users=%s videos=%s thumbnails=%s failed=%s '
+            'duration=%.2fs',
+            self.prefixes,
+            self.objects,
+            self.bytes / 1024**3,
+            self.users,
+            self.videos,
+            self.thumbnails,
+            self.failed,
+            time.monotonic() - self.started,
+        )
+
+
+def legacy_video(key: str) -> tuple[str, bool] | None:
+    """
+    Username and whether the video is hidden, for keys the v1 API created. None for any other key.
+    """
+    parts = key.split('/')
+    if not key.endswith('.mp4') or f'{parts[0]}/' in RESERVED_PREFIXES:
+        return None
+    if len(parts) == 2:
+        return parts[0], False
+    if len(parts) == 3 and parts[1] == 'hidden':
+        return parts[0], True
+    return None
+
+
+async def list_user_prefixes(boto_session: AioBaseClient) -> list[str]:
+    """
+    Every top level prefix of the bucket, in order
+    """
+    paginator = boto_session.get_paginator('list_objects_v2')
+    prefixes: list[str] = []
+    async for page in paginator.paginate(Bucket=settings.S3_BUCKET_URL, Delimiter='/'):
+        prefixes.extend(prefix['Prefix'] for prefix in page.get('CommonPrefixes', []))
+    return sorted(prefix for prefix in prefixes if prefix not in RESERVED_PREFIXES)
+
+
+async def list_legacy_videos(
+    boto_session: AioBaseClient, prefix: str, semaphore: asyncio.Semaphore
+) -> list[dict[str, Any]]:
+    """
+    The objects below a user prefix that are legacy videos
+    """
+    paginator = boto_session.get_paginator('list_objects_v2')
+    objects: list[dict[str, Any]] = []
+    async with semaphore:
+        async for page in paginator.paginate(Bucket=settings.S3_BUCKET_URL, Prefix=prefix):
+            objects.extend(item for item in page.get('Contents', []) if legacy_video(item['Key']))
+    return objects
+
+
+async def ensure_users(db_session: AsyncSession, names: set[str], stats: ImportStats) -> dict[str, UUID]:
+    """
+    Ids of the users by name, inserting the missing ones in one statement
+    """
+    statement = select(User.name, User.id).where(User.name.in_(names))  # type: ignore
+    user_ids: dict[str, UUID] = dict((await db_session.exec(statement)).all())
+    missing = sorted(names - user_ids.keys())
+    if missing:
+        rows = [{'id': uuid4(), 'name': name} for name in missing]
+        created = await db_session.exec(insert(User).values(rows).returning(User.name, User.id))  # type: ignore
+        user_ids.update(created.all())
+        stats.users += len(missing)
+    return user_ids
+
+
+async def insert_videos(
+    db_session: AsyncSession, objects: list[dict[str, Any]], user_ids: dict[str, UUID], batch_size: int
+) -> int:
+    """
+    Insert a video per object, skipping keys that already have one. Returns the number of videos inserted.
+    """
+    inserted = 0
+    for offset in range(0, len(objects), batch_size):
+        rows = []
+        for item in objects[offset : offset + batch_size]:
+            key = item['Key']
+            username, hidden = legacy_video(key)  # type: ignore
+            rows.append(
+                {
+                    'path': key,
+                    'display_name': key.rsplit('/', 1)[1].removesuffix('.mp4'),
+                    'hidden': hidden,
+                    'uploaded_at': item['LastModified'],
+                    'uri': f'https://gg.klepp.me/{key}',
+                    'expire_at': None,
+                    'file_size': item['Size'],
+                    'user_id': user_ids[username],
+                }
+            )
+        statement = insert(Video).values(rows).on_conflict_do_nothing(index_elements=[Video.path]).returning(Video.path)  # type: ignore
+        inserted += len((await db_session.exec(statement)).all())
+    return inserted
+
+
+async def import_thumbnails(
+    boto_session: AioBaseClient, video: Video, semaphore: asyncio.Semaphore, stats: ImportStats
+) -> None:
+    """
+    Generate and upload thumbnails for one imported video, and store them on it
+    """
+    async with semaphore:
+        try:
+            thumbnails = await create_thumbnails(
+                boto_session=boto_session,
+                path=video.uri,
+                prefix=f'{video_asset_prefix(video)}thumbnails/',
+                widths=VIDEO_THUMBNAIL_WIDTHS,
+            )
+        except Exception as error:
+            log.warning('Unable to generate thumbnails for %s. Error: %s', video.path, error)
+            stats.failed += 1
+            return
+    async with AsyncSession(ASYNC_ENGINE) as db_session:
+        await db_session.exec(update(Video).where(Video.path == video.path).values(**thumbnails))
+        await db_session.commit()
+    stats.thumbnails += 1
+
+
+async def import_prefixes(
+    boto_session: AioBaseClient,
+    prefixes: list[str],
+    batch_size: int,
+    list_semaphore: asyncio.Semaphore,
+    thumbnail_semaphore: asyncio.Semaphore,
+    stats: ImportStats,
+) -> None:
+    """
+    Import the videos of a batch of user prefixes, and store the last prefix as the checkpoint
+    """
+    listed = await asyncio.gather(
+        *(list_legacy_videos(boto_session, prefix=prefix, semaphore=list_semaphore) for prefix in prefixes)
+    )
+    objects = [item for items in listed for item in items]
+    stats.objects += len(objects)
+    stats.bytes += sum(item['Size'] for item in objects)
+
+    videos_without_thumbnails: list[Video] = []
+    if objects:
+        async with AsyncSession(ASYNC_ENGINE, expire_on_commit=False) as db_session:
+            names = {legacy_video(item['Key'])[0] for item in objects}  # type: ignore
+            user_ids = await ensure_users(db_session, names, stats=stats)
+            stats.videos += await insert_videos(db_session, objects, user_ids=user_ids, batch_size=batch_size)
+            await db_session.commit()
+            statement = select(Video).where(
+                Video.user_id.in_(user_ids.values()),  # type: ignore
+                Video.blob_sha256 == None,  # noqa: E711
+                Video.thumbnail_variants == None,  # noqa: E711
+            )
+            videos_without_thumbnails = list((await db_session.exec(statement)).all())
+
+    # Outside the transaction, generating thumbnails takes a while
+    await asyncio.gather(
+        *(
+            import_thumbnails(boto_session, video, semaphore=thumbnail_semaphore, stats=stats)
+            for video in videos_without_thumbnails
+        )
+    )
+
+    async with AsyncSession(ASYNC_ENGINE) as db_session:
+        checkpoint = await db_session.get(JobCheckpoint, CHECKPOINT) or JobCheckpoint(name=CHECKPOINT, position='')
+        checkpoint.position = prefixes[-1]
+        checkpoint.updated_at = datetime.now(timezone.utc)
+        db_session.add(checkpoint)
+        await db_session.commit()
+    stats.prefixes += len(prefixes)
+
+
+async def import_bucket(
+    restart: bool, prefixes_per_batch: int, batch_size: int, list_concurrency: int, concurrency: int
+) -> ImportStats:
+    """
+    Import every user prefix after the checkpoint, or all of them when `restart`
+    """
+    stats = ImportStats()
+    list_semaphore = asyncio.Semaphore(list_concurrency)
+    thumbnail_semaphore = asyncio.Semaphore(concurrency)
+    async with s3_client() as boto_session:
+        after = ''
+        if not restart:
+            async with AsyncSession(ASYNC_ENGINE) as db_session:
+                if checkpoint := await db_session.get(JobCheckpoint, CHECKPOINT):
+                    after = checkpoint.position
+        prefixes = [prefix for prefix in await list_user_prefixes(boto_session) if prefix > after]
+        log.info('Importing %s user prefixes%s', len(prefixes), f' after {after}' if after else '')
+
+        for offset in range(0, len(prefixes), prefixes_per_batch):
+            batch = prefixes[offset : offset + prefixes_per_batch]
+            await import_prefixes(
+                boto_session,
+                batch,
+                batch_size=batch_size,
+                list_semaphore=list_semaphore,
+                thumbnail_semaphore=thumbnail_semaphore,
+                stats=stats,
+            )
+            stats.progress(total_prefixes=len(prefixes), position=batch[-1])
+    stats.report()
+    return stats
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Import videos stored by the v1 API into the database.')
+    parser.add_argument('--restart', action='store_true', help='Start from the beginning instead of the checkpoint')
+    parser.add_argument('--prefixes-per-batch', type=int, default=50, help='User prefixes per checkpoint')
+    parser.add_argument('--batch-size', type=int, default=500, help='Rows per insert')
+    parser.add_argument('--list-concurrency', type=int, default=16, help='User prefixes listed at once')
+    parser.add_argument('--concurrency', type=int, default=settings.MEDIA_WORKERS * 2, help='Thumbnails at once')
+    args = parser.parse_args()
+
+    setup_logging()
+    asyncio.run(
+        import_bucket(
+            restart=args.restart,
+            prefixes_per_batch=args.prefixes_per_batch,
+            batch_size=args.batch_size,
+            list_concurrency=args.list_concurrency,
+            concurrency=args.concurrency,
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
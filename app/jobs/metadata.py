@@ -0,0 +1,110 @@
+"""
+Backfill media metadata (duration, resolution, codec, bitrate and size) for videos uploaded before it was probed.
+
+ffprobe reads the objects through the CDN, which uses HTTP range requests to only fetch the parts of the file it
+needs, instead of downloading whole objects. Blob videos share their object, so every object is probed once.
+
+    python -m app.jobs.metadata --concurrency 8
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+from sqlalchemy import update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.api.services import probe_video, video_metadata
+from app.core.db import ASYNC_ENGINE
+from app.core.logging_config import setup_logging
+from app.models.klepp import Video
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class MetadataStats:
+    objects: int = 0
+    probed: int = 0
+    failed: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def report(self) -> None:
+        """
+        Log a summary of the run
+        """
+        log.info(
+            'Metadata backfill finished: objects=%s probed=%s failed=%s duration=%.2fs',
+            self.objects,
+            self.probed,
+            self.failed,
+            time.monotonic() - self.started,
+        )
+
+
+async def probe_uri(uri: str, semaphore: asyncio.Semaphore, stats: MetadataStats) -> dict[str, Any]:
+    """
+    Probe an object through the CDN. Returns the metadata, empty if probing failed.
+    """
+    async with semaphore:
+        try:
+            metadata = video_metadata(await probe_video(uri))
+        except Exception as error:
+            log.warning('Unable to probe %s. Error: %s', uri, error)
+            stats.failed += 1
+            return {}
+    stats.probed += 1
+    return metadata
+
+
+async def backfill(batch_size: int, concurrency: int) -> MetadataStats:
+    """
+    Probe every object without metadata, one batch of objects at a time
+    """
+    stats = MetadataStats()
+    semaphore = asyncio.Semaphore(concurrency)
+    after = ''
+    async with AsyncSession(ASYNC_ENGINE, expire_on_commit=False) as db_session:
+        while True:
+            statement = (
+                select(Video.uri)
+                .where(Video.duration == None, Video.uri > after)  # noqa: E711
+                .distinct()
+                .order_by(Video.uri)
+                .limit(batch_size)
+            )
+            uris = (await db_session.exec(statement)).all()
+            if not uris:
+                break
+            after = uris[-1]
+            stats.objects += len(uris)
+
+            results = await asyncio.gather(*(probe_uri(uri, semaphore=semaphore, stats=stats) for uri in uris))
+            for uri, metadata in zip(uris, results, strict=True):
+                if metadata:
+                    await db_session.exec(update(Video).where(Video.uri == uri).values(**metadata))
+            await db_session.commit()
+            log.info('Processed %s objects, last %s', stats.objects, after)
+    stats.report()
+    return stats
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Probe stored videos and store their media metadata.')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    setup_logging()
+    asyncio.run(backfill(batch_size=args.batch_size, concurrency=args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
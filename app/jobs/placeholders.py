@@ -0,0 +1,156 @@
+"""
+Backfill inline placeholders for videos and profile pictures stored before placeholders were generated.
+
+Placeholders are generated from the existing `thumbnail_uri`, read through the CDN. Blob videos share their
+thumbnail, so every thumbnail is only processed once.
+
+    python -m app.jobs.placeholders --only users --concurrency 8
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+
+from sqlalchemy import update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.api.services import create_placeholder
+from app.core.config import settings
+from app.core.db import ASYNC_ENGINE
+from app.core.logging_config import setup_logging
+from app.models.klepp import User, Video
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class PlaceholderStats:
+    videos: int = 0
+    users: int = 0
+    failed: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def report(self) -> None:
+        """
+        Log a summary of the run
+        """
+        log.info(
+            'Placeholder backfill finished: videos=%s users=%s failed=%s duration=%.2fs',
+            self.videos,
+            self.users,
+            self.failed,
+            time.monotonic() - self.started,
+        )
+
+
+async def placeholder_from_uri(uri: str, semaphore: asyncio.Semaphore, stats: PlaceholderStats) -> str | None:
+    """
+    Generate a placeholder from a thumbnail. Returns None if it failed.
+    """
+    async with semaphore:
+        try:
+            placeholder = await create_placeholder(uri)
+        except Exception as error:
+            log.warning('Unable to generate a placeholder for %s. Error: %s', uri, error)
+            stats.failed += 1
+            return None
+    if placeholder is None:
+        log.warning('Placeholder for %s is too large to inline, skipping', uri)
+        stats.failed += 1
+    return placeholder
+
+
+async def backfill_videos(
+    db_session: AsyncSession, batch_size: int, semaphore: asyncio.Semaphore, stats: PlaceholderStats
+) -> None:
+    """
+    Generate placeholders for videos without them, one batch of thumbnails at a time
+    """
+    after = ''
+    while True:
+        statement = (
+            select(Video.thumbnail_uri)
+            .where(Video.placeholder == None, Video.thumbnail_uri != None, Video.thumbnail_uri > after)  # type: ignore  # noqa: E711
+            .distinct()
+            .order_by(Video.thumbnail_uri)
+            .limit(batch_size)
+        )
+        uris = (await db_session.exec(statement)).all()
+        if not uris:
+            return
+        after = uris[-1]
+
+        results = await asyncio.gather(*(placeholder_from_uri(uri, semaphore=semaphore, stats=stats) for uri in uris))
+        for uri, placeholder in zip(uris, results, strict=True):
+            if placeholder is not None:
+                await db_session.exec(update(Video).where(Video.thumbnail_uri == uri).values(placeholder=placeholder))
+                stats.videos += 1
+        await db_session.commit()
+        log.info('Processed video thumbnails up to %s', after)
+
+
+async def backfill_users(
+    db_session: AsyncSession, batch_size: int, semaphore: asyncio.Semaphore, stats: PlaceholderStats
+) -> None:
+    """
+    Generate placeholders for profile pictures without them
+    """
+    after = ''
+    while True:
+        statement = (
+            select(User)
+            .where(User.placeholder == None, User.thumbnail_uri != None, User.name > after)  # noqa: E711
+            .order_by(User.name)
+            .limit(batch_size)
+        )
+        users = (await db_session.exec(statement)).all()
+        if not users:
+            return
+        after = users[-1].name
+
+        results = await asyncio.gather(
+            *(placeholder_from_uri(user.thumbnail_uri, semaphore=semaphore, stats=stats) for user in users)
+        )
+        for user, placeholder in zip(users, results, strict=True):
+            if placeholder is not None:
+                user.placeholder = placeholder
+                db_session.add(user)
+                stats.users += 1
+        await db_session.commit()
+        log.info('Processed users up to %s', after)
+
+
+async def backfill(only: str | None, batch_size: int, concurrency: int) -> PlaceholderStats:
+    """
+    Backfill placeholders for videos, users or both
+    """
+    stats = PlaceholderStats()
+    semaphore = asyncio.Semaphore(concurrency)
+    async with AsyncSession(ASYNC_ENGINE, expire_on_commit=False) as db_session:
+        if only in (None, 'videos'):
+            await backfill_videos(db_session, batch_size=batch_size, semaphore=semaphore, stats=stats)
+        if only in (None, 'users'):
+            await backfill_users(db_session, batch_size=batch_size, semaphore=semaphore, stats=stats)
+    stats.report()
+    return stats
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Generate inline placeholders for existing videos and users.')
+    parser.add_argument('--only', choices=['videos', 'users'], default=None)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=settings.MEDIA_WORKERS * 2)
+    args = parser.parse_args()
+
+    setup_logging()
+    asyncio.run(backfill(only=args.only, batch_size=args.batch_size, concurrency=args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+Deletes videos that have passed their `expire_at`, together with their link table rows, and S3 objects no
+other video references. Resumable uploads left unfinished for `UPLOAD_EXPIRE_HOURS` are aborted as well, rate
+limit buckets nobody used for a day are dropped, they're full by then, and so are tombstones of removed videos that
+incremental exports no longer report.
+
+Expired rows are found through `ix_video_expire_at` in batches, and locked with `FOR UPDATE SKIP LOCKED`,
+so several reapers can run at the same time without deleting the same video twice.
+
+With `--metrics-file`, what every run deleted is also written there in the Prometheus text format after every run,
+for the textfile collector of the node exporter, e.g. to alert when the reaper stops succeeding.
+
+    python -m app.jobs.reaper --dry-run
+    python -m app.jobs.reaper --interval 3600
+    python -m app.jobs.reaper --interval 3600 --metrics-file /var/lib/node_exporter/textfile/klepp_reaper.prom
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+from aiobotocore.client import AioBaseClient
+from sqlalchemy import delete, func, or_, tuple_
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.api.dependencies import s3_client
+from app.api.metrics import Counter, Gauge, Metric, write_textfile
+from app.api.services import abort_staged_upload, delete_s3_objects, delete_videos
+from app.core.config import settings
+from app.core.db import ASYNC_ENGINE
+from app.core.logging_config import setup_logging
+from app.models.klepp import RateLimitBucket, Upload, Video, VideoTombstone
+
+log = logging.getLogger(__name__)
+
+# Longer than any bucket takes to refill, a missing bucket is the same as a full one
+RATE_LIMIT_BUCKET_EXPIRE = timedelta(days=1)
+
+REAPED = Counter('klepp_reaper_deleted_total', 'Rows and S3 objects deleted by the reaper', labels=('kind',))
+FAILED_OBJECTS = Counter('klepp_reaper_failed_objects_total', 'S3 objects the reaper was unable to delete')
+RUNS = Counter('klepp_reaper_runs_total', 'Reaper runs, by whether they finished', labels=('result',))
+last_run = {'finished_at': 0.0, 'duration': 0.0}
+REAPER_METRICS: list[Metric] = [
+    REAPED,
+    FAILED_OBJECTS,
+    RUNS,
+    Gauge(
+        'klepp_reaper_last_success_timestamp_seconds',
+        'When a reaper run last finished',
+        lambda: last_run['finished_at'],
+    ),
+    Gauge(
+        'klepp_reaper_last_run_duration_seconds', 'How long the last finished run took', lambda: last_run['duration']
+    ),
+]
+
+
+@dataclass
+class ReaperStats:
+    batches: int = 0
+    videos: int = 0
+    objects: int = 0
+    failed_objects: int = 0
+    uploads: int = 0
+    buckets: int = 0
+    tombstones: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def report(self, dry_run: bool) -> None:
+        """
+        Log a summary of the run
+        """
+        log.info(
+            'Reaper finished%s: batches=%s videos=%s objects=%s failed_objects=%s uploads=%s buckets=%s '
+            'tombstones=%s duration=%.2fs',
+            ' (dry run)' if dry_run else '',
+            self.batches,
+            self.videos,
+            self.objects,
+            self.failed_objects,
+            self.uploads,
+            self.buckets,
+            self.tombstones,
+            time.monotonic() - self.started,
+        )
+
+    def count(self) -> None:
+        """
+        Add a finished run to the metrics
+        """
+        for kind in ('videos', 'objects', 'uploads', 'buckets', 'tombstones'):
+            REAPED.inc(kind, amount=getattr(self, kind))
+        FAILED_OBJECTS.inc(amount=self.failed_objects)
+        RUNS.inc('success')
+        last_run['finished_at'] = time.time()
+        last_run['duration'] = time.monotonic() - self.started
+
+
+async def reap_batch(
+    db_session: AsyncSession,
+    boto_session: AioBaseClient,
+    stats: ReaperStats,
+    now: datetime,
+    after: tuple[datetime, str] | None,
+    batch_size: int,
+    concurrency: int,
+    dry_run: bool,
+) -> tuple[datetime, str] | None:
+    """
+    Reap one batch of expired videos. Returns the keyset position of the last row, or `None` when done.
+    """
+    statement = (
+        select(Video)
+        .where(Video.expire_at < now)  # type: ignore
+        .order_by(Video.expire_at, Video.path)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    if after:
+        # Batches we failed to delete stay behind, so keep moving forward instead of retrying them in this run
+        statement = statement.where(tuple_(Video.expire_at, Video.path) > after)
+    videos = (await db_session.exec(statement)).all()
+    if not videos:
+        return None
+    stats.batches += 1
+    position = videos[-1].expire_at, videos[-1].path
+
+    deleted_keys: set[str] = set()
+    while videos:
+        # Shared blobs are only released (and their objects returned) once their last video is gone
+        unused = await delete_videos(videos=videos, db_session=db_session)
+        keys = await unused.list_keys(boto_session)
+
+        if dry_run:
+            for video in videos:
+                log.info('Would delete %s', video.path)
+            stats.videos += len(videos)
+            stats.objects += len(keys)
+            await db_session.rollback()
+            return position
+
+        failed_keys = await delete_s3_objects(
+            boto_session, [key for key in keys if key not in deleted_keys], concurrency=concurrency
+        )
+        if not failed_keys:
+            await db_session.commit()
+            stats.videos += len(videos)
+            stats.objects += len(set(keys) | deleted_keys)
+            return position
+
+        # Keep the rows and blob references of the videos whose objects are left, deleting objects is idempotent so
+        # the next run retries them. The rest of the batch is gone from S3, and is deleted again without them.
+        kept = unused.videos_of(failed_keys) or {video.path for video in videos}
+        log.warning('Unable to delete %s objects from S3, keeping %s: %s', len(failed_keys), sorted(kept), failed_keys)
+        stats.failed_objects += len(failed_keys)
+        deleted_keys.update(set(keys) - set(failed_keys))
+        await db_session.rollback()
+        # The rollback released the locks, take them again
+        paths = [video.path for video in videos if video.path not in kept]
+        videos = (
+            await db_session.exec(
+                select(Video).where(Video.path.in_(paths)).with_for_update(skip_locked=True)  # type: ignore
+            )
+        ).all()
+    return position
+
+
+async def reap_uploads(
+    db_session: AsyncSession, boto_session: AioBaseClient, stats: ReaperStats, now: datetime, dry_run: bool
+) -> None:
+    """
+    Abort resumable uploads that were started too long ago, and their S3 multipart uploads
+    """
+    completing_since = now - timedelta(hours=settings.UPLOAD_COMPLETE_TIMEOUT_HOURS)
+    statement = (
+        select(Upload)
+        .where(Upload.created_at < now - timedelta(hours=settings.UPLOAD_EXPIRE_HOURS))
+        # Leave uploads alone while their video is being created
+        .where(or_(Upload.completing_at.is_(None), Upload.completing_at < completing_since))  # type: ignore
+        .with_for_update(skip_locked=True)
+    )
+    for upload in (await db_session.exec(statement)).all():
+        if dry_run:
+            log.info('Would abort upload %s of %s', upload.id, upload.path)
+        else:
+            try:
+                await abort_staged_upload(boto_session, upload)
+            except Exception as error:
+                log.warning('Unable to abort upload %s, keeping it. Error: %s', upload.id, error)
+                continue
+            await db_session.delete(upload)
+        stats.uploads += 1
+    if dry_run:
+        await db_session.rollback()
+    else:
+        await db_session.commit()
+
+
+async def reap_rate_limits(db_session: AsyncSession, stats: ReaperStats, now: datetime, dry_run: bool) -> None:
+    """
+    Drop rate limit buckets that haven't been used for a long time
+    """
+    expired = RateLimitBucket.updated_at < now - RATE_LIMIT_BUCKET_EXPIRE
+    if dry_run:
+        stats.buckets += (await db_session.exec(select(func.count()).where(expired))).one()
+        return
+    result = await db_session.exec(delete(RateLimitBucket).where(expired))
+    await db_session.commit()
+    stats.buckets += result.rowcount
+
+
+async def reap_tombstones(db_session: AsyncSession, stats: ReaperStats, now: datetime, dry_run: bool) -> None:
+    """
+    Drop tombstones of removed videos that incremental exports no longer report
+    """
+    expired = VideoTombstone.removed_at < now - timedelta(days=settings.EXPORT_TOMBSTONE_RETENTION_DAYS)
+    if dry_run:
+        stats.tombstones += (await db_session.exec(select(func.count()).where(expired))).one()
+        return
+    result = await db_session.exec(delete(VideoTombstone).where(expired))
+    await db_session.commit()
+    stats.tombstones += result.rowcount
+
+
+async def reap(batch_size: int, concurrency: int, dry_run: bool) -> ReaperStats:
+    """
+    Delete every video that has expired, one batch (and one transaction) at a time
+    """
+    stats = ReaperStats()
+    now = datetime.now(timezone.utc)
+    after: tuple[datetime, str] | None = None
+    async with s3_client() as boto_session, AsyncSession(ASYNC_ENGINE, expire_on_commit=False) as db_session:
+        while after := await reap_batch(
+            db_session=db_session,
+            boto_session=boto_session,
+            stats=stats,
+            now=now,
+            after=after,
+            batch_size=batch_size,
+            concurrency=concurrency,
+            dry_run=dry_run,
+        ):
+            log.debug('Reaped batch %s, continuing after %s', stats.batches, after)
+        await reap_uploads(db_session=db_session, boto_session=boto_session, stats=stats, now=now, dry_run=dry_run)
+        await reap_rate_limits(db_session=db_session, stats=stats, now=now, dry_run=dry_run)
+        await reap_tombstones(db_session=db_session, stats=stats, now=now, dry_run=dry_run)
+    stats.report(dry_run=dry_run)
+    return stats
+
+
+async def run(batch_size: int, concurrency: int, dry_run: bool, interval: int, metrics_file: str | None) -> None:
+    """
+    Run the reaper once, or forever every `interval` seconds
+    """
+    while True:
+        try:
+            stats = await reap(batch_size=batch_size, concurrency=concurrency, dry_run=dry_run)
+            if not dry_run:
+                stats.count()
+        except Exception as error:
+            RUNS.inc('failure')
+            if not interval:
+                raise
+            log.exception('Reaper run failed, retrying in %s seconds. Error: %s', interval, error)
+        finally:
+            if metrics_file and not dry_run:
+                write_textfile(metrics_file, REAPER_METRICS)
+        if not interval:
+            return
+        await asyncio.sleep(interval)
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Delete expired videos and their S3 objects.')
+    parser.add_argument('--batch-size', type=int, default=settings.REAPER_BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=settings.REAPER_S3_CONCURRENCY)
+    parser.add_argument('--dry-run', action='store_true', help='Log what would be deleted without deleting it')
+    parser.add_argument('--interval', type=int, default=0, help='Seconds between runs. 0 runs once and exits')
+    parser.add_argument('--metrics-file', help='Write metrics to this .prom file after every run')
+    args = parser.parse_args()
+
+    setup_logging()
+    asyncio.run(
+        run(
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+            dry_run=args.dry_run,
+            interval=args.interval,
+            metrics_file=args.metrics_file,
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Recompute the user and tag stats from scratch, and fix the rows that drifted.
+
+Video and tag counts are maintained by database triggers, so this should find nothing for them. It is meant for after
+restoring a backup, manual data fixes, or changes to the triggers. Writes to videos and tags wait while it runs.
+
+`likes_received` has no trigger, since every like would wait for the lock on the owner's row. With `--likes`, only
+it is refreshed from the sharded like counters, which is cheap enough to run every few minutes and locks nothing but
+the stats rows that changed.
+
+    python -m app.jobs.stats --dry-run
+    python -m app.jobs.stats --likes --interval 300
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+
+from sqlalchemy import func, literal, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.db import ASYNC_ENGINE
+from app.core.logging_config import setup_logging
+from app.models.klepp import Tag, TagStats, User, UserStats, Video, VideoLikeCount, VideoTagLink
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class StatsRepairStats:
+    users: int = 0
+    likes: int = 0
+    tags: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def report(self, dry_run: bool) -> None:
+        """
+        Log a summary of the run
+        """
+        log.info(
+            'Stats repair finished%s: users=%s likes=%s tags=%s duration=%.2fs',
+            ' (dry run)' if dry_run else '',
+            self.users,
+            self.likes,
+            self.tags,
+            time.monotonic() - self.started,
+        )
+
+
+async def repair_users(db_session: AsyncSession) -> int:
+    """
+    Upsert the recomputed video counts of every user, returns how many rows changed
+    """
+    video_count = select(func.count()).select_from(Video).where(Video.user_id == User.id).scalar_subquery()
+    statement = insert(UserStats).from_select(
+        ['user_id', 'video_count', 'likes_received'], select(User.id, video_count, literal(0))
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[UserStats.user_id],
+        set_={'video_count': statement.excluded.video_count},
+        where=UserStats.video_count != statement.excluded.video_count,
+    ).returning(UserStats.user_id)  # type: ignore
+    return len((await db_session.exec(statement)).all())
+
+
+async def refresh_likes_received(db_session: AsyncSession) -> int:
+    """
+    Set the likes received of every user to the sum of their videos' like counters, returns how many rows changed
+    """
+    received = (
+        select(UserStats.user_id, func.coalesce(func.sum(VideoLikeCount.count), 0).label('likes'))
+        .outerjoin(Video, Video.user_id == UserStats.user_id)
+        .outerjoin(VideoLikeCount, VideoLikeCount.video_path == Video.path)
+        .group_by(UserStats.user_id)
+        .subquery()
+    )
+    statement = (
+        update(UserStats)
+        .where(UserStats.user_id == received.c.user_id, UserStats.likes_received != received.c.likes)
+        .values(likes_received=received.c.likes)
+        .returning(UserStats.user_id)  # type: ignore
+    )
+    return len((await db_session.exec(statement)).all())
+
+
+async def repair_tags(db_session: AsyncSession) -> int:
+    """
+    Upsert the recomputed stats of every tag, returns how many rows changed
+    """
+    video_count = select(func.count()).select_from(VideoTagLink).where(VideoTagLink.tag_id == Tag.id).scalar_subquery()
+    statement = insert(TagStats).from_select(['tag_id', 'video_count'], select(Tag.id, video_count))
+    statement = statement.on_conflict_do_update(
+        index_elements=[TagStats.tag_id],
+        set_={'video_count': statement.excluded.video_count},
+        where=TagStats.video_count != statement.excluded.video_count,
+    ).returning(TagStats.tag_id)  # type: ignore
+    return len((await db_session.exec(statement)).all())
+
+
+async def repair(dry_run: bool, likes_only: bool) -> StatsRepairStats:
+    """
+    Recompute every stats row in one transaction, or only `likes_received`
+    """
+    stats = StatsRepairStats()
+    async with AsyncSession(ASYNC_ENGINE, expire_on_commit=False) as db_session:
+        if not likes_only:
+            # SHARE mode lets reads through, but holds back the writes that fire the triggers until we are done
+            await db_session.exec(text('LOCK TABLE "user", tag, video, videotaglink IN SHARE MODE'))  # type: ignore
+            stats.users = await repair_users(db_session)
+            stats.tags = await repair_tags(db_session)
+        stats.likes = await refresh_likes_received(db_session)
+        if dry_run:
+            await db_session.rollback()
+        else:
+            await db_session.commit()
+    stats.report(dry_run=dry_run)
+    return stats
+
+
+async def run(dry_run: bool, likes_only: bool, interval: int) -> None:
+    """
+    Repair once, or forever every `interval` seconds
+    """
+    while True:
+        try:
+            await repair(dry_run=dry_run, likes_only=likes_only)
+        except Exception as error:
+            if not interval:
+                raise
+            log.exception('Stats repair failed, retrying in %s seconds. Error: %s', interval, error)
+        if not interval:
+            return
+        await asyncio.sleep(interval)
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Recompute user and tag stats.')
+    parser.add_argument('--dry-run', action='store_true', help='Count the drifted rows without fixing them')
+    parser.add_argument('--likes', action='store_true', help='Only refresh the likes received, without locking')
+    parser.add_argument('--interval', type=int, default=0, help='Seconds between runs. 0 runs once and exits')
+    args = parser.parse_args()
+
+    setup_logging()
+    asyncio.run(run(dry_run=args.dry_run, likes_only=args.likes, interval=args.interval))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+Backfill WebP/JPEG thumbnail variants for videos and profile pictures stored before variants were generated.
+
+Video variants are generated from the first frame, read through the CDN with range requests. Profile picture
+variants are generated from the current profile picture. Existing `thumbnail_uri`s are kept as they are.
+
+    python -m app.jobs.thumbnails --only videos --concurrency 4
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiobotocore.client import AioBaseClient
+from sqlalchemy import update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.api.dependencies import s3_client
+from app.api.services import (
+    USER_THUMBNAIL_WIDTHS,
+    VIDEO_THUMBNAIL_WIDTHS,
+    create_thumbnails,
+    s3_key_from_uri,
+    video_asset_prefix,
+)
+from app.core.config import settings
+from app.core.db import ASYNC_ENGINE
+from app.core.logging_config import setup_logging
+from app.models.klepp import User, Video
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class ThumbnailStats:
+    videos: int = 0
+    users: int = 0
+    failed: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def report(self) -> None:
+        """
+        Log a summary of the run
+        """
+        log.info(
+            'Thumbnail backfill finished: videos=%s users=%s failed=%s duration=%.2fs',
+            self.videos,
+            self.users,
+            self.failed,
+            time.monotonic() - self.started,
+        )
+
+
+async def generate_variants(
+    boto_session: AioBaseClient,
+    source_uri: str,
+    prefix: str,
+    widths: tuple[int, ...],
+    square: bool,
+    semaphore: asyncio.Semaphore,
+    stats: ThumbnailStats,
+) -> list[dict[str, Any]] | None:
+    """
+    Generate and upload variants for one source. Returns None if it failed.
+    """
+    async with semaphore:
+        try:
+            thumbnails = await create_thumbnails(
+                boto_session=boto_session, path=source_uri, prefix=prefix, widths=widths, square=square
+            )
+        except Exception as error:
+            log.warning('Unable to generate thumbnails for %s. Error: %s', source_uri, error)
+            stats.failed += 1
+            return None
+    return thumbnails['thumbnail_variants']
+
+
+async def backfill_videos(
+    boto_session: AioBaseClient,
+    db_session: AsyncSession,
+    batch_size: int,
+    semaphore: asyncio.Semaphore,
+    stats: ThumbnailStats,
+) -> None:
+    """
+    Generate variants for videos without them. Videos sharing a blob share the variants.
+    """
+    after = ''
+    while True:
+        statement = (
+            select(Video)
+            .where(Video.thumbnail_variants == None, Video.path > after)  # noqa: E711
+            .order_by(Video.path)
+            .limit(batch_size)
+        )
+        videos = (await db_session.exec(statement)).all()
+        if not videos:
+            return
+        after = videos[-1].path
+
+        # Blob videos share one object, only generate its variants once
+        unique = {video.uri: video for video in videos}
+        results = await asyncio.gather(
+            *(
+                generate_variants(
+                    boto_session,
+                    source_uri=uri,
+                    prefix=f'{video_asset_prefix(video)}thumbnails/',
+                    widths=VIDEO_THUMBNAIL_WIDTHS,
+                    square=False,
+                    semaphore=semaphore,
+                    stats=stats,
+                )
+                for uri, video in unique.items()
+            )
+        )
+        for uri, variants in zip(unique, results, strict=True):
+            if variants is not None:
+                await db_session.exec(update(Video).where(Video.uri == uri).values(thumbnail_variants=variants))
+                stats.videos += 1
+        await db_session.commit()
+        log.info('Processed videos up to %s', after)
+
+
+async def backfill_users(
+    boto_session: AioBaseClient,
+    db_session: AsyncSession,
+    batch_size: int,
+    semaphore: asyncio.Semaphore,
+    stats: ThumbnailStats,
+) -> None:
+    """
+    Generate variants for profile pictures without them, stored next to the current profile picture
+    """
+    after = ''
+    while True:
+        statement = (
+            select(User)
+            .where(User.thumbnail_uri != None, User.thumbnail_variants == None, User.name > after)  # noqa: E711
+            .order_by(User.name)
+            .limit(batch_size)
+        )
+        users = (await db_session.exec(statement)).all()
+        if not users:
+            return
+        after = users[-1].name
+
+        results = await asyncio.gather(
+            *(
+                generate_variants(
+                    boto_session,
+                    source_uri=user.thumbnail_uri,
+                    prefix=f'{s3_key_from_uri(user.thumbnail_uri).rsplit(".", 1)[0]}/',
+                    widths=USER_THUMBNAIL_WIDTHS,
+                    square=True,
+                    semaphore=semaphore,
+                    stats=stats,
+                )
+                for user in users
+            )
+        )
+        for user, variants in zip(users, results, strict=True):
+            if variants is not None:
+                user.thumbnail_variants = variants
+                db_session.add(user)
+                stats.users += 1
+        await db_session.commit()
+        log.info('Processed users up to %s', after)
+
+
+async def backfill(only: str | None, batch_size: int, concurrency: int) -> ThumbnailStats:
+    """
+    Backfill variants for videos, users or both
+    """
+    stats = ThumbnailStats()
+    semaphore = asyncio.Semaphore(concurrency)
+    async with s3_client() as boto_session, AsyncSession(ASYNC_ENGINE, expire_on_commit=False) as db_session:
+        if only in (None, 'videos'):
+            await backfill_videos(boto_session, db_session, batch_size=batch_size, semaphore=semaphore, stats=stats)
+        if only in (None, 'users'):
+            await backfill_users(boto_session, db_session, batch_size=batch_size, semaphore=semaphore, stats=stats)
+    stats.report()
+    return stats
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Generate thumbnail variants for existing videos and users.')
+    parser.add_argument('--only', choices=['videos', 'users'], default=None)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=settings.MEDIA_WORKERS * 2)
+    args = parser.parse_args()
+
+    setup_logging()
+    asyncio.run(backfill(only=args.only, batch_size=args.batch_size, concurrency=args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
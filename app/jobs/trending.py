@@ -0,0 +1,171 @@
+"""
+Keeps `videotrending` up to date from recent likes, for `GET /files?sort=trending`.
+
+Every like is worth 1 when it happens, and half as much every `TRENDING_HALF_LIFE_HOURS`. Instead of decaying every
+row on every run, scores are stored relative to a fixed epoch, in log2 so they don't overflow: a like at time t adds
+2^((t - epoch) / half life). All videos decay at the same rate, so ranking on this is the same as ranking on the
+decayed sum, and a run only touches videos liked since the previous run.
+
+Unlikes are not subtracted incrementally, `--full` rebuilds the table from every like.
+
+    python -m app.jobs.trending --interval 300
+    python -m app.jobs.trending --full
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, func, literal
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.core.config import settings
+from app.core.db import ASYNC_ENGINE
+from app.core.logging_config import setup_logging
+from app.models.klepp import JobCheckpoint, VideoLikeLink, VideoTrending
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT = 'trending'
+TRENDING_EPOCH = datetime(2025, 1, 1, tzinfo=timezone.utc)
+# Likes are read up to this long ago, so transactions that started before a run and commit after it aren't missed
+COMMIT_LAG = timedelta(minutes=1)
+# Videos whose likes have decayed to less than 2^-PRUNE_HALF_LIVES of one fresh like drop off the feed
+PRUNE_HALF_LIVES = 30
+LN_2 = math.log(2)
+
+
+@dataclass
+class TrendingStats:
+    videos: int = 0
+    pruned: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def report(self, full: bool) -> None:
+        """
+        Log a summary of the run
+        """
+        log.info(
+            'Trending update finished%s: videos=%s pruned=%s duration=%.2fs',
+            ' (full rebuild)' if full else '',
+            self.videos,
+            self.pruned,
+            time.monotonic() - self.started,
+        )
+
+
+def half_lives_since_epoch(moment: datetime) -> float:
+    """
+    Score of a single like at `moment`
+    """
+    return (moment - TRENDING_EPOCH).total_seconds() / (settings.TRENDING_HALF_LIFE_HOURS * 3600)
+
+
+async def score_likes(db_session: AsyncSession, after: datetime, until: datetime) -> int:
+    """
+    Add the likes in (`after`, `until`] to the scores. Returns the number of videos updated.
+    """
+    # Sum relative to `until`, so the powers stay between 0 and 1, then shift back to the epoch
+    half_lives_before_until = func.extract('epoch', VideoLikeLink.liked_at - literal(until)) / (
+        settings.TRENDING_HALF_LIFE_HOURS * 3600
+    )
+    batch_score = half_lives_since_epoch(until) + func.ln(func.sum(func.power(2.0, half_lives_before_until))) / LN_2
+    likes = (
+        select(VideoLikeLink.video_path, batch_score, literal(until))
+        .where(VideoLikeLink.liked_at > after, VideoLikeLink.liked_at <= until)  # type: ignore
+        .group_by(VideoLikeLink.video_path)
+    )
+
+    statement = insert(VideoTrending).from_select(['video_path', 'score', 'updated_at'], likes)
+    # log2(2^a + 2^b), without leaving log space. Past 64 half-lives apart the smaller one doesn't matter.
+    old, new = VideoTrending.score, statement.excluded.score
+    difference = func.least(func.abs(old - new), 64)
+    statement = statement.on_conflict_do_update(
+        index_elements=[VideoTrending.video_path],
+        set_={
+            'score': func.greatest(old, new) + func.ln(1 + func.power(2.0, -difference)) / LN_2,
+            'updated_at': statement.excluded.updated_at,
+        },
+    ).returning(VideoTrending.video_path)  # type: ignore
+    return len((await db_session.exec(statement)).all())
+
+
+async def prune(db_session: AsyncSession, now: datetime) -> int:
+    """
+    Drop videos that haven't been liked for a long time. Returns the number of videos dropped.
+    """
+    statement = (
+        delete(VideoTrending)
+        .where(VideoTrending.score < half_lives_since_epoch(now) - PRUNE_HALF_LIVES)
+        .returning(VideoTrending.video_path)  # type: ignore
+    )
+    return len((await db_session.exec(statement)).all())
+
+
+async def update_trending(full: bool) -> TrendingStats:
+    """
+    Score the likes since the last run, or every like when `full`, in one transaction
+    """
+    stats = TrendingStats()
+    until = datetime.now(timezone.utc) - COMMIT_LAG
+    async with AsyncSession(ASYNC_ENGINE, expire_on_commit=False) as db_session:
+        checkpoint = await db_session.get(JobCheckpoint, CHECKPOINT, with_for_update=True)
+        after = None
+        if full:
+            await db_session.exec(delete(VideoTrending))
+        elif checkpoint:
+            after = datetime.fromisoformat(checkpoint.position)
+
+        # Older likes would be pruned anyway, and would underflow the powers
+        oldest = until - timedelta(hours=settings.TRENDING_HALF_LIFE_HOURS * PRUNE_HALF_LIVES)
+        stats.videos = await score_likes(db_session, after=max(after or oldest, oldest), until=until)
+        stats.pruned = await prune(db_session, now=until)
+
+        checkpoint = checkpoint or JobCheckpoint(name=CHECKPOINT, position='')
+        checkpoint.position = until.isoformat()
+        checkpoint.updated_at = datetime.now(timezone.utc)
+        db_session.add(checkpoint)
+        await db_session.commit()
+    stats.report(full=full)
+    return stats
+
+
+async def run(full: bool, interval: int) -> None:
+    """
+    Update once, or forever every `interval` seconds
+    """
+    while True:
+        try:
+            await update_trending(full=full)
+        except Exception as error:
+            if not interval:
+                raise
+            log.exception('Trending update failed, retrying in %s seconds. Error: %s', interval, error)
+        if not interval:
+            return
+        # Only the first run is a full rebuild
+        full = False
+        await asyncio.sleep(interval)
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Update the trending scores from recent likes.')
+    parser.add_argument('--full', action='store_true', help='Rebuild the scores from every like')
+    parser.add_argument('--interval', type=int, default=0, help='Seconds between runs. 0 runs once and exits')
+    args = parser.parse_args()
+
+    setup_logging()
+    asyncio.run(run(full=args.full, interval=args.interval))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,44 @@
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+from asgi_correlation_id import CorrelationIdMiddleware
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.api.access_log import AccessLogMiddleware
+from app.api.admission import shed_load
 from app.api.api_v1.api import api_router
 from app.api.api_v2.api import api_router as api_v2_router
-from app.api.security import cognito_scheme
+from app.api.dependencies import s3_client
+from app.api.events import ExceptEventStream, event_hub
+from app.api.loop_monitor import loop_monitor
+from app.api.metrics import router as metrics_router
+from app.api.profiler import ProfilerMiddleware
+from app.api.rate_limit import RateLimitMiddleware
+from app.api.replica import mark_writes
+from app.api.warmup import router as warmup_router, warmup
 from app.core.config import settings
 from app.core.logging_config import setup_logging
+from app.core.tracing import TracingMiddleware
 from app.render.urls import api_router as render_router
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """
+    Open the shared boto client and warm up the worker. Nothing here waits on the network, see `app/api/warmup.py`.
+    """
+    setup_logging()
+    async with s3_client() as boto_session:
+        app.state.boto_session = boto_session
+        loop_monitor.start()
+        warmup.start()
+        yield
+        await event_hub.stop()
+        await warmup.stop()
+        await loop_monitor.stop()
+
+
 app = FastAPI(
     title=settings.PROJECT_NAME,
     openapi_url=f'{settings.API_V2_STR}/openapi.json',
@@ -16,10 +47,20 @@ app = FastAPI(
         'usePkceWithAuthorizationCodeGrant': True,
         'clientId': settings.AWS_OPENAPI_CLIENT_ID,
     },
-    on_startup=[setup_logging, cognito_scheme.openid_config.load_config],
+    lifespan=lifespan,
 )
 
-# Set all CORS enabled origins
+# Profiles requests on demand, see `app/api/profiler.py`. Added first, so it runs in the same task as the routes.
+app.add_middleware(ProfilerMiddleware)
+# Rate limits media uploads before their body is read, see `app/api/rate_limit.py`
+app.add_middleware(RateLimitMiddleware)
+# Pins reads to the primary right after a write, see `app/api/replica.py`
+app.add_middleware(ExceptEventStream, dispatch=mark_writes)
+# Refuses low priority requests while overloaded, see `app/api/admission.py`. Not for the event stream, which would
+# count as a request in progress for hours.
+app.add_middleware(ExceptEventStream, dispatch=shed_load)
+
+# Set all CORS enabled origins. Added after the others, so it wraps them and their responses get CORS headers.
 if settings.BACKEND_CORS_ORIGINS:
     app.add_middleware(
         CORSMiddleware,
@@ -27,8 +68,18 @@ if settings.BACKEND_CORS_ORIGINS:
         allow_credentials=True,
         allow_methods=['*'],
         allow_headers=['*'],
+        expose_headers=['Retry-After', 'X-Request-ID', 'X-Export-Until', 'X-Wrote-At'],
     )
 
+# One line per request, see `app/api/access_log.py`. Its timings include the middleware added before it.
+app.add_middleware(AccessLogMiddleware)
+# Root span of the request's trace, see `app/core/tracing.py`
+app.add_middleware(TracingMiddleware)
+# Sets the correlation id used in logs, profiles and as the trace id. Outermost, so everything else can use it.
+app.add_middleware(CorrelationIdMiddleware)
+
+app.include_router(warmup_router)
+app.include_router(metrics_router)
 app.include_router(api_router, prefix=settings.API_V1_STR)
 app.include_router(api_v2_router, prefix=settings.API_V2_STR)
 app.include_router(render_router)
@@ -1,9 +1,10 @@
 import uuid
 from datetime import datetime, timedelta, timezone
-from typing import Generic, TypeVar
+from typing import Any, Generic, Literal, TypeVar
 
 from pydantic import BaseModel
-from sqlalchemy import Column, DateTime
+from sqlalchemy import BigInteger, Column, DateTime, Index, func, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlmodel import Field, Relationship, SQLModel
 
 ResponseModel = TypeVar('ResponseModel')
@@ -19,6 +20,13 @@ def generate_expire_at() -> datetime:
 class ListResponse(BaseModel, Generic[ResponseModel]):
     total_count: int
     response: list[ResponseModel]
+    next_cursor: str | None = None  # Only set by keyset paginated lists, pass it as `cursor` for the next page
+
+
+class ThumbnailVariant(BaseModel):
+    width: int
+    format: Literal['webp', 'jpeg']
+    uri: str
 
 
 class VideoTagLink(SQLModel, table=True):
@@ -29,6 +37,70 @@ class VideoTagLink(SQLModel, table=True):
 class VideoLikeLink(SQLModel, table=True):
     video_path: str = Field(foreign_key='video.path', primary_key=True, nullable=False)
     user_id: uuid.UUID = Field(foreign_key='user.id', primary_key=True, nullable=False)
+    liked_at: datetime | None = Field(
+        default=None,
+        description='Set by the database',
+        sa_column=Column(DateTime(timezone=True), nullable=False, server_default=func.now(), index=True),
+    )
+
+
+class VideoLikeCount(SQLModel, table=True):
+    """
+    Like counter of a video, split over shards so concurrent likes don't wait for each other's row lock.
+    A shard can go negative when a like and its unlike land on different shards, only the sum is meaningful.
+    """
+
+    video_path: str = Field(foreign_key='video.path', primary_key=True, nullable=False)
+    shard: int = Field(primary_key=True, nullable=False)
+    count: int = Field(default=0, nullable=False)
+    updated_at: datetime | None = Field(
+        default=None,
+        description='Set by the database, on every like and unlike counted in the shard',
+        sa_column=Column(DateTime(timezone=True), nullable=False, server_default=func.clock_timestamp(), index=True),
+    )
+
+
+class VideoTrending(SQLModel, table=True):
+    """
+    Precomputed trending rank of liked videos, see `app/jobs/trending.py`.
+    `score` is log2 of the sum of every like decayed by its age, counted from a fixed epoch instead of now.
+    Every video decays at the same rate, so the order is the same, and only videos with new likes need updating.
+    """
+
+    __table_args__ = (Index('ix_videotrending_score', 'score', 'video_path'),)
+
+    video_path: str = Field(foreign_key='video.path', primary_key=True, nullable=False)
+    score: float = Field(nullable=False)
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column=Column(DateTime(timezone=True), nullable=False),
+    )
+
+
+class JobCheckpoint(SQLModel, table=True):
+    """
+    Where an incremental job left off, so the next run continues from there
+    """
+
+    name: str = Field(primary_key=True, nullable=False)
+    position: str = Field(nullable=False)
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column=Column(DateTime(timezone=True), nullable=False),
+    )
+
+
+class RateLimitBucket(SQLModel, table=True):
+    """
+    Token bucket of one user and action, shared by every worker. See `app/api/rate_limit.py`.
+    Unlogged, losing the buckets in a crash only means everyone starts with a full bucket.
+    """
+
+    __table_args__ = {'prefixes': ['UNLOGGED']}
+
+    key: str = Field(primary_key=True, nullable=False, description='<action>:<user id>')
+    tokens: float = Field(nullable=False)
+    updated_at: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False, index=True))
 
 
 class UserBase(SQLModel):
@@ -44,12 +116,49 @@ class User(UserBase, table=True):
     """
 
     id: uuid.UUID | None = Field(default_factory=uuid.uuid4, primary_key=True, index=True, nullable=False)
+    thumbnail_variants: list[dict[str, Any]] | None = Field(default=None, sa_type=JSONB(none_as_null=True))
+    placeholder: str | None = Field(default=None, nullable=True)
     videos: list['Video'] = Relationship(back_populates='user')
     liked_videos: list['Video'] = Relationship(back_populates='likes', link_model=VideoLikeLink)
 
 
+class UserStats(SQLModel, table=True):
+    """
+    Counters per user. `video_count` is maintained by a database trigger on `video`, `likes_received` is summed from
+    `VideoLikeCount` every few minutes by `python -m app.jobs.stats --likes`, so likes don't lock the owner's row.
+    `python -m app.jobs.stats` recomputes them from scratch.
+    """
+
+    __table_args__ = (
+        Index('ix_userstats_video_count', 'video_count', 'user_id'),
+        Index('ix_userstats_likes_received', 'likes_received', 'user_id'),
+    )
+
+    user_id: uuid.UUID = Field(foreign_key='user.id', primary_key=True, nullable=False, ondelete='CASCADE')
+    video_count: int = Field(default=0, nullable=False)
+    likes_received: int = Field(default=0, nullable=False)
+
+
 class UserRead(UserBase):
-    pass
+    thumbnail_variants: list[ThumbnailVariant] | None = Field(default=None, description='For `srcset`')
+    placeholder: str | None = Field(
+        default=None,
+        description='Tiny inline WebP data URI to show while the thumbnail loads, only included for the owner of a '
+        'video and your own profile',
+    )
+    video_count: int | None = Field(default=None, description='Number of videos, only included in user lists')
+    likes_received: int | None = Field(
+        default=None, description='Likes on all of their videos, updated every few minutes, only included in user lists'
+    )
+
+
+class VideoLikerRead(SQLModel):
+    """
+    Someone who liked a video. Kept small, popular videos have thousands of them.
+    """
+
+    name: str
+    thumbnail_uri: str | None = Field(default=None, description='Profile picture, the JPEG fallback')
 
 
 class TagBase(SQLModel):
@@ -62,12 +171,71 @@ class Tag(TagBase, table=True):
     videos: list['Video'] = Relationship(back_populates='tags', link_model=VideoTagLink)
 
 
+class TagStats(SQLModel, table=True):
+    """
+    Counters per tag, maintained by database triggers on `videotaglink`.
+    `python -m app.jobs.stats` recomputes them from scratch.
+    """
+
+    __table_args__ = (Index('ix_tagstats_video_count', 'video_count', 'tag_id'),)
+
+    tag_id: uuid.UUID = Field(foreign_key='tag.id', primary_key=True, nullable=False, ondelete='CASCADE')
+    video_count: int = Field(default=0, nullable=False)
+
+
 class TagRead(TagBase):
-    pass
+    video_count: int | None = Field(
+        default=None, description='Number of videos using the tag, only included in tag lists'
+    )
+
+
+class Blob(SQLModel, table=True):
+    """
+    Content addressed video objects, keyed on the SHA-256 of the uploaded bytes.
+    Several videos can point to the same blob, and the objects are only deleted once `refcount` reaches 0.
+    """
+
+    sha256: str = Field(primary_key=True, nullable=False, max_length=64)
+    key: str = Field(nullable=False, description='s3 key of the video object')
+    size: int = Field(sa_column=Column(BigInteger, nullable=False))
+    refcount: int = Field(default=0, nullable=False)
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column=Column(DateTime(timezone=True), nullable=False),
+    )
+
+
+class Upload(SQLModel, table=True):
+    """
+    A resumable upload in progress. Every chunk is stored as an S3 multipart part, so any worker can continue it.
+    """
+
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True, nullable=False)
+    user_id: uuid.UUID = Field(foreign_key='user.id', nullable=False, index=True)
+    path: str = Field(nullable=False, description='<username>/<file name> of the video to create')
+    display_name: str = Field(nullable=False)
+    length: int = Field(sa_column=Column(BigInteger, nullable=False), description='Total size in bytes')
+    offset: int = Field(default=0, sa_column=Column(BigInteger, nullable=False), description='Bytes received')
+    s3_upload_id: str = Field(nullable=False, description='S3 multipart upload ID')
+    parts: list[dict[str, Any]] = Field(default_factory=list, sa_column=Column(JSONB, nullable=False))
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column=Column(DateTime(timezone=True), nullable=False, index=True),
+    )
+    completing_at: datetime | None = Field(
+        default=None,
+        sa_column=Column(DateTime(timezone=True), nullable=True),
+        description='When the video started being created from the upload, in the background',
+    )
+    error: str | None = Field(default=None, description='Why creating the video failed, complete again to retry')
 
 
 class VideoBase(SQLModel):
-    path: str = Field(primary_key=True, nullable=False, description='s3 path, primary key')
+    path: str = Field(
+        primary_key=True,
+        nullable=False,
+        description='<username>/<file name>, primary key. The s3 path of legacy videos',
+    )
     display_name: str = Field(index=True, description='Display name of the video')
     hidden: bool = Field(default=False, description='Whether the file can be seen by anyone on the frontpage')
     uploaded_at: datetime = Field(
@@ -79,21 +247,78 @@ class VideoBase(SQLModel):
     expire_at: datetime | None = Field(
         description='When the file is to be deleted',
         default_factory=generate_expire_at,
-        sa_column=Column(DateTime(timezone=True), nullable=True),
+        sa_column=Column(DateTime(timezone=True), nullable=True, index=True),
     )
 
 
-class Video(VideoBase, table=True):
+class VideoMetadata(SQLModel):
+    duration: float | None = Field(default=None, description='Length of the video in seconds')
+    width: int | None = Field(default=None, description='Width in pixels')
+    height: int | None = Field(default=None, index=True, description='Height in pixels')
+    codec: str | None = Field(default=None, description='Video codec, e.g. `h264`')
+    bitrate: int | None = Field(default=None, description='Bits per second')
+    file_size: int | None = Field(default=None, sa_type=BigInteger, description='Size of the video in bytes')
+
+
+class Video(VideoBase, VideoMetadata, table=True):
+    # `sort=shortest` and `sort=longest`, in their order. Newest first on ties, so one index can't serve both.
+    __table_args__ = (
+        Index('ix_video_duration', 'duration', text('uploaded_at DESC')),
+        Index('ix_video_duration_desc', text('duration DESC NULLS LAST'), text('uploaded_at DESC')),
+    )
+
     user_id: uuid.UUID = Field(foreign_key='user.id', nullable=False, description='User primary key')
     user: User = Relationship(back_populates='videos')
     thumbnail_uri: str | None = Field(default=None, nullable=True)
+    thumbnail_variants: list[dict[str, Any]] | None = Field(default=None, sa_type=JSONB(none_as_null=True))
+    placeholder: str | None = Field(default=None, nullable=True)
+    blob_sha256: str | None = Field(
+        default=None,
+        foreign_key='blob.sha256',
+        nullable=True,
+        index=True,
+        max_length=64,
+        description='Null for legacy videos',
+    )
+    hls_uri: str | None = Field(default=None, nullable=True)
+    sprite_vtt_uri: str | None = Field(default=None, nullable=True)
+    faststart: bool = Field(default=False, nullable=False, description='Whether `moov` comes before `mdat`')
+    updated_at: datetime | None = Field(
+        default=None,
+        description='Set by the database, on every change to the video or its tags',
+        sa_column=Column(DateTime(timezone=True), nullable=False, server_default=func.clock_timestamp(), index=True),
+    )
 
     tags: list[Tag] = Relationship(back_populates='videos', link_model=VideoTagLink)
     likes: list[User] = Relationship(back_populates='liked_videos', link_model=VideoLikeLink)
 
 
-class VideoRead(VideoBase):
+class VideoTombstone(SQLModel, table=True):
+    """
+    A video that was deleted, or hidden from everyone but its owner, written by database triggers on `video`.
+    Incremental exports report these, and `python -m app.jobs.reaper` drops them after
+    `EXPORT_TOMBSTONE_RETENTION_DAYS`.
+    """
+
+    path: str = Field(primary_key=True, nullable=False)
+    removed_at: datetime = Field(
+        sa_column=Column(DateTime(timezone=True), primary_key=True, nullable=False, index=True)
+    )
+    user_id: uuid.UUID = Field(nullable=False, description='Owner of the video, who may still see it when hidden')
+    hidden: bool = Field(nullable=False, description='Whether only the owner could see the video when it was removed')
+    deleted: bool = Field(nullable=False, description='Deleted, or else hidden, and still there for the owner')
+
+
+class VideoRead(VideoBase, VideoMetadata):
     user: 'UserRead'
     tags: list['TagRead']
     thumbnail_uri: str | None = Field(default=None, description='If it exist, we have a thumbnail for the video')
-    likes: list['UserRead']
+    thumbnail_variants: list[ThumbnailVariant] | None = Field(default=None, description='For `srcset`')
+    placeholder: str | None = Field(
+        default=None, description='Tiny inline WebP data URI to show while the thumbnail loads'
+    )
+    hls_uri: str | None = Field(default=None, description='HLS master playlist, if renditions have been generated')
+    sprite_vtt_uri: str | None = Field(
+        default=None, description='WebVTT thumbnail track for hover-scrub previews, pointing into a sprite image'
+    )
+    likes: list['VideoLikerRead']
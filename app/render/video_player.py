@@ -8,8 +8,8 @@ from sqlalchemy.orm import selectinload
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from app.api.dependencies import yield_db_session
-from app.models.klepp import Video
+from app.api.dependencies import yield_read_db_session
+from app.models.klepp import User, Video
 
 if typing.TYPE_CHECKING:
     from starlette.templating import _TemplateResponse
@@ -21,7 +21,7 @@ router = APIRouter()
 
 @router.get('/', response_class=HTMLResponse, include_in_schema=False)
 async def render_video_page(
-    request: Request, path: str, session: AsyncSession = Depends(yield_db_session)
+    request: Request, path: str, session: AsyncSession = Depends(yield_read_db_session)
 ) -> '_TemplateResponse':
     """
     Static site for share.klepp.me?path=<path>
@@ -30,7 +30,7 @@ async def render_video_page(
         select(Video)
         .options(selectinload(Video.user))  # type: ignore[arg-type]
         .options(selectinload(Video.tags))  # type: ignore[arg-type]
-        .options(selectinload(Video.likes))  # type: ignore[arg-type]
+        .options(selectinload(Video.likes).load_only(User.name, User.thumbnail_uri))
         .order_by(desc(Video.uploaded_at))  # type: ignore[arg-type]
     )
     if path:
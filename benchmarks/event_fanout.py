@@ -0,0 +1,150 @@
+"""
+Measure what the event hub costs per connected client: memory while idle, and the time to fan an event out.
+
+Clients are subscribed to a hub without a database, each with a task waiting for frames like the SSE endpoint does.
+Events are fed to the hub as Postgres notifications would be, for public videos and hidden ones that only their owner
+sees, followed by the flush that wakes the clients. Likes of one video are coalesced into a single event.
+With `--stack`, clients are anonymous requests to `GET /api/v2/events` through the app and all of its middleware
+instead, made the way a server makes them, so the memory per client is what a worker really pays.
+Needs the same environment as the app, since it imports the settings.
+
+    python -m benchmarks.event_fanout --clients 10000 --events 50
+    python -m benchmarks.event_fanout --clients 10000 --events 50 --stack
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+from typing import Any
+
+from starlette.types import ASGIApp, Message
+
+from app.api.events import EVENTS_PATH, EventHub, Subscriber, event_hub
+
+
+async def client(subscriber: Subscriber) -> int:
+    """
+    Read frames until the hub stops, like `event_stream`
+    """
+    received = 0
+    while frames := await subscriber.receive():
+        received += len(frames)
+    return received
+
+
+async def request(app: ASGIApp, disconnected: asyncio.Event) -> int:
+    """
+    Stream the events through the app, until the hub stops or the client disconnects
+    """
+    received = 0
+    scope: dict[str, Any] = {
+        'type': 'http',
+        'asgi': {'version': '3.0', 'spec_version': '2.4'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': EVENTS_PATH,
+        'raw_path': EVENTS_PATH.encode(),
+        'root_path': '',
+        'query_string': b'',
+        'headers': [(b'host', b'localhost'), (b'accept', b'text/event-stream')],
+        'client': ('127.0.0.1', 50000),
+        'server': ('localhost', 8000),
+        'state': {},
+    }
+
+    async def receive() -> Message:
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message: Message) -> None:
+        nonlocal received
+        if message['type'] == 'http.response.body':
+            received += message.get('body', b'').count(b'\n\n')
+
+    await app(scope, receive, send)
+    return received
+
+
+def notify(hub: EventHub, **payload: object) -> None:
+    """
+    Feed the hub a notification
+    """
+    hub.receive(None, 0, '', json.dumps(payload))
+
+
+async def benchmark(clients: int, events: int, stack: bool) -> None:
+    """
+    Time every step and print a summary
+    """
+    disconnected = asyncio.Event()
+    hub = event_hub if stack else EventHub()
+    # Keep the hub from connecting, there is no database
+    hub.task = asyncio.create_task(asyncio.sleep(3600))
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    if stack:
+        from app.main import app
+
+        tasks = [asyncio.create_task(request(app, disconnected)) for _ in range(clients)]
+        while len(hub.subscribers) < clients:
+            await asyncio.sleep(0.01)
+        # Let every stream reach its first wait for frames
+        await asyncio.sleep(0.1)
+    else:
+        subscribers = [hub.subscribe(f'user{index}' if index % 2 else None) for index in range(clients)]
+        tasks = [asyncio.create_task(client(subscriber)) for subscriber in subscribers]
+        await asyncio.sleep(0)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    per_client = sum(stat.size_diff for stat in after.compare_to(before, 'filename')) / clients
+    waiting = 'the request through every middleware' if stack else 'the waiting task'
+    print(f'{clients} idle clients: {per_client:.0f} bytes each, including {waiting}')
+
+    for label, payload in (
+        ('public', {'event': 'video.created', 'owner': 'user1', 'hidden': False}),
+        ('hidden', {'event': 'video.updated', 'owner': 'user1', 'hidden': True, 'was_hidden': True}),
+    ):
+        started = time.perf_counter()
+        for index in range(events):
+            notify(hub, path=f'user1/{index}.mp4', **payload)
+        dispatched = time.perf_counter() - started
+        # One flush, every client with frames reads them
+        hub.deliver()
+        await asyncio.sleep(0)
+        delivered = time.perf_counter() - started - dispatched
+        print(
+            f'{events} {label} events: {dispatched * 1000 / events:6.3f} ms to dispatch each, '
+            f'{delivered * 1000:7.1f} ms to wake and read, for {clients} clients'
+        )
+
+    started = time.perf_counter()
+    for index in range(events):
+        notify(hub, event='video.liked', path='user1/popular.mp4', owner='user1', hidden=False, like_count=index)
+    hub.flush_likes()
+    hub.deliver()
+    await asyncio.sleep(0)
+    print(f'{events} likes of one video: {(time.perf_counter() - started) * 1000:.3f} ms, sent once')
+
+    await hub.stop()
+    disconnected.set()
+    await asyncio.gather(*tasks)
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the event hub fan-out.')
+    parser.add_argument('--clients', type=int, default=10_000)
+    parser.add_argument('--events', type=int, default=50, help='Events per flush, resets clients past 64')
+    parser.add_argument('--stack', action='store_true', help='Connect through the app and its middleware')
+    args = parser.parse_args()
+    asyncio.run(benchmark(clients=args.clients, events=args.events, stack=args.stack))
+
+
+if __name__ == '__main__':
+    main()
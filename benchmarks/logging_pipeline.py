@@ -0,0 +1,167 @@
+"""
+Measure what logging costs the caller, with the previous synchronous handler and the queued JSON pipeline.
+
+Lines are written to a temporary file, both per log call and per request through a bare ASGI app, with and without
+the access log. The drain column is how long the listener thread took to write everything out afterwards.
+`--write-delay-ms` makes every write block, like stderr does when the log collector falls behind.
+Needs the same environment as the app, since it imports the settings.
+
+    python -m benchmarks.logging_pipeline --records 50000 --requests 5000
+    python -m benchmarks.logging_pipeline --records 2000 --requests 500 --write-delay-ms 0.2
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import tempfile
+import time
+from collections.abc import Callable
+from typing import TextIO
+
+from asgi_correlation_id import CorrelationIdFilter
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.api.access_log import AccessLogMiddleware
+from app.core import logging_config
+
+log = logging.getLogger('benchmark')
+
+
+class SlowStream:
+    """
+    A stream where every write blocks for a while
+    """
+
+    def __init__(self, stream: TextIO, delay: float) -> None:
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, text: str) -> int:
+        time.sleep(self.delay)
+        return self.stream.write(text)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+
+def use_synchronous(stream: TextIO) -> None:
+    """
+    The previous setup, a stream handler formatting and writing on the caller's thread
+    """
+    logging_config.stop_logging()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(stream)
+    handler.addFilter(CorrelationIdFilter())
+    handler.setFormatter(logging.Formatter(logging_config.LOGGING['formatters']['console']['format']))
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+
+
+def use_queued(stream: TextIO) -> None:
+    """
+    The app's setup, with the listener writing to `stream` instead of stderr
+    """
+    logging_config.setup_logging()
+    assert logging_config.listener is not None
+    for handler in logging_config.listener.handlers:
+        handler.setStream(stream)  # type: ignore
+    logging.getLogger().setLevel(logging.DEBUG)
+
+
+def drain() -> float:
+    """
+    Flush whatever the pipeline still holds, in milliseconds
+    """
+    started = time.perf_counter()
+    if logging_config.listener is not None:
+        logging_config.stop_logging()
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+    return (time.perf_counter() - started) * 1000
+
+
+def log_lines(records: int) -> None:
+    """
+    A mix of what the app logs, including a sampled logger
+    """
+    sampled = logging.getLogger('httpx')
+    for index in range(records):
+        log.info('Processed video %s for user %s in %.3fs', index, 'user', 0.123)
+        sampled.debug('HTTP Request: GET https://example.com/%s', index)
+
+
+async def app(_scope: Scope, _receive: Receive, send: Send) -> None:
+    """
+    Smallest possible endpoint, so the middleware and logging dominate
+    """
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': b'ok'})
+
+
+async def serve(asgi_app: ASGIApp, requests: int) -> None:
+    """
+    Call the app directly, without a server or network
+    """
+
+    async def receive() -> dict:
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message: dict) -> None:
+        pass
+
+    scope = {'type': 'http', 'method': 'GET', 'path': '/api/v2/files', 'query_string': b'', 'client': ('127.0.0.1', 1)}
+    for _ in range(requests):
+        await asgi_app(scope, receive, send)
+
+
+def measure(
+    setup: Callable[[TextIO], None], work: Callable[[], None], count: int, runs: int, write_delay: float
+) -> tuple[float, float]:
+    """
+    Median microseconds per item on the caller's thread, and the median drain time in milliseconds
+    """
+    per_item, drains = [], []
+    for _ in range(runs):
+        with tempfile.TemporaryFile('w+') as file:
+            setup(SlowStream(file, write_delay) if write_delay else file)
+            started = time.perf_counter()
+            work()
+            per_item.append((time.perf_counter() - started) * 1_000_000 / count)
+            drains.append(drain())
+    return statistics.median(per_item), statistics.median(drains)
+
+
+def benchmark(records: int, requests: int, runs: int, write_delay_ms: float) -> None:
+    """
+    Time every combination and print a summary
+    """
+    print(f'{records} log calls x2, {requests} requests, {write_delay_ms} ms per write, median of {runs} runs')
+    write_delay = write_delay_ms / 1000
+    for name, setup in (('synchronous', use_synchronous), ('queued json', use_queued)):
+        per_call, drained = measure(setup, lambda: log_lines(records), records * 2, runs, write_delay)
+        print(f'{name:>12} log calls:     {per_call:6.2f} us per call,    drain {drained:7.1f} ms')
+        for label, asgi_app in (('bare', app), ('access log', AccessLogMiddleware(app))):
+            per_request, drained = measure(
+                setup, lambda a=asgi_app: asyncio.run(serve(a, requests)), requests, runs, write_delay
+            )
+            print(f'{name:>12} {label:>10} requests: {per_request:6.2f} us per request, drain {drained:7.1f} ms')
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the logging pipeline.')
+    parser.add_argument('--records', type=int, default=50_000)
+    parser.add_argument('--requests', type=int, default=5_000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--write-delay-ms', type=float, default=0)
+    args = parser.parse_args()
+    benchmark(records=args.records, requests=args.requests, runs=args.runs, write_delay_ms=args.write_delay_ms)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Compare the ffmpeg profile picture pipeline with the in-process Pillow one, without S3.
+
+The ffmpeg path writes the upload to disk in 1 KB chunks, scales it in an ffmpeg process and reads the variants back.
+The Pillow path decodes, scales and encodes in memory on the image threads.
+Needs `ffmpeg` on the PATH and the same environment as the app, since it imports the settings.
+
+    python -m benchmarks.profile_picture --width 3000 --height 2000 --runs 20
+"""
+
+import argparse
+import asyncio
+import functools
+import shutil
+import statistics
+import time
+from collections.abc import Awaitable, Callable
+from io import BytesIO
+from pathlib import Path
+from uuid import uuid4
+
+import aiofiles
+from aiofiles import os
+from PIL import Image
+
+from app.api.services import (
+    USER_THUMBNAIL_WIDTHS,
+    await_ffmpeg,
+    generate_thumbnail_variants,
+    image_executor,
+    read_placeholder,
+    render_profile_picture,
+)
+
+
+def sample_jpeg(width: int, height: int) -> bytes:
+    """
+    A photo-like JPEG, gradients with noise so it doesn't compress unrealistically well
+    """
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 64)
+    image = Image.merge('RGB', (gradient, noise, gradient.rotate(90).resize((width, height))))
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+async def ffmpeg_pipeline(data: bytes) -> None:
+    """
+    The previous path: temp file, ffmpeg process, variants read back from disk
+    """
+    fallback_width = max(USER_THUMBNAIL_WIDTHS)
+    temp_name = uuid4().hex
+    directory = uuid4().hex
+    await os.makedirs(directory)
+    try:
+        async with aiofiles.open(temp_name, 'wb') as img:
+            for offset in range(0, len(data), 1024):
+                await img.write(data[offset : offset + 1024])
+        await await_ffmpeg(
+            functools.partial(
+                generate_thumbnail_variants,
+                temp_name,
+                directory,
+                USER_THUMBNAIL_WIDTHS,
+                fallback_width,
+                True,
+                f'{directory}.webp',
+            )
+        )
+        for file in Path(directory).iterdir():
+            async with aiofiles.open(file, 'rb') as variant:
+                await variant.read()
+        await read_placeholder(f'{directory}.webp')
+    finally:
+        await os.remove(temp_name)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+async def pillow_pipeline(data: bytes) -> None:
+    """
+    The in-process path, everything in memory
+    """
+    await asyncio.get_running_loop().run_in_executor(
+        image_executor, render_profile_picture, data, USER_THUMBNAIL_WIDTHS, max(USER_THUMBNAIL_WIDTHS)
+    )
+
+
+async def measure(pipeline: Callable[[bytes], Awaitable[None]], data: bytes, runs: int) -> list[float]:
+    """
+    Run a pipeline once to warm up, then time every run in milliseconds
+    """
+    await pipeline(data)
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        await pipeline(data)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+async def benchmark(width: int, height: int, runs: int) -> None:
+    """
+    Time both pipelines on the same image, and print a summary
+    """
+    data = sample_jpeg(width, height)
+    print(f'{width}x{height} JPEG, {len(data) // 1024} KB, {runs} runs')
+    for name, pipeline in (('ffmpeg', ffmpeg_pipeline), ('pillow', pillow_pipeline)):
+        timings = await measure(pipeline, data, runs)
+        print(
+            f'{name:>7}: median {statistics.median(timings):7.1f} ms, '
+            f'min {min(timings):7.1f} ms, max {max(timings):7.1f} ms'
+        )
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Benchmark profile picture processing.')
+    parser.add_argument('--width', type=int, default=3000)
+    parser.add_argument('--height', type=int, default=2000)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(benchmark(width=args.width, height=args.height, runs=args.runs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Measure how long importing `app.main` takes, which every gunicorn worker pays before it can serve anything.
+
+Every run imports the app in a fresh interpreter. Fails when the median is over the budget, or when a module that
+should only be imported on first use is imported by the app itself, so it can guard startup time in CI.
+Needs the same environment as the app, since it imports the settings.
+
+    python -m benchmarks.startup --runs 10 --budget-ms 1500
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Imported where they're used, by media endpoints, the warmup or scripts
+LAZY_MODULES = ('ffmpeg', 'asyncffmpeg', 'asynccpu', 'PIL', 'psycopg2', 'jose')
+
+MEASURE = """
+import json, sys, time
+started = time.perf_counter()
+import app.main
+print(json.dumps({'seconds': time.perf_counter() - started, 'modules': sorted(sys.modules)}))
+"""
+
+
+def import_once() -> tuple[float, set[str]]:
+    """
+    Import the app in a fresh interpreter. Returns the import time in milliseconds, and every imported module.
+    """
+    output = subprocess.run(
+        [sys.executable, '-W', 'ignore', '-c', MEASURE], check=True, capture_output=True, text=True
+    ).stdout
+    result = json.loads(output.splitlines()[-1])
+    return result['seconds'] * 1000, set(result['modules'])
+
+
+def slowest_imports(count: int) -> list[tuple[int, str]]:
+    """
+    Direct imports of `app.main` with the largest cumulative import time in microseconds, from `-X importtime`
+    """
+    stderr = subprocess.run(
+        [sys.executable, '-W', 'ignore', '-X', 'importtime', '-c', 'import app.main'],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+    timings = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # Only what `app.main` imports directly, nested imports are included in their parent's time
+        if name.startswith('   ') and not name.startswith('    '):
+            timings.append((int(cumulative), name.strip()))
+    return sorted(timings, reverse=True)[:count]
+
+
+def main() -> None:
+    """
+    Command line entrypoint
+    """
+    parser = argparse.ArgumentParser(description='Benchmark importing the app, and check the startup budget.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=1500)
+    parser.add_argument('--top', type=int, default=10, help='Show the slowest direct imports of app.main')
+    args = parser.parse_args()
+
+    timings = []
+    eager = set()
+    for _ in range(args.runs):
+        milliseconds, modules = import_once()
+        timings.append(milliseconds)
+        eager |= {module for module in LAZY_MODULES if module in modules}
+
+    median = statistics.median(timings)
+    print(f'import app.main, {args.runs} runs')
+    print(f'median {median:7.1f} ms, min {min(timings):7.1f} ms, max {max(timings):7.1f} ms')
+    print('slowest imports of app.main:')
+    for cumulative, name in slowest_imports(args.top):
+        print(f'{cumulative / 1000:9.1f} ms  {name}')
+
+    failed = False
+    if median > args.budget_ms:
+        print(f'Over the startup budget of {args.budget_ms:.0f} ms')
+        failed = True
+    if eager:
+        print(f'Imported on startup, but should be imported on first use: {", ".join(sorted(eager))}')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+#!/bin/sh
+# Run once when the primary database is created, lets `postgres_replica` stream from it
+echo 'host replication all all md5' >> "$PGDATA/pg_hba.conf"
@@ -20,7 +20,22 @@ fileConfig(config.config_file_name)
 # for 'autogenerate' support
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
-from app.models.klepp import Video, Tag, VideoTagLink, User, VideoLikeLink
+from app.models.klepp import (
+    Blob,
+    JobCheckpoint,
+    RateLimitBucket,
+    Tag,
+    TagStats,
+    Upload,
+    User,
+    UserStats,
+    Video,
+    VideoLikeCount,
+    VideoLikeLink,
+    VideoTagLink,
+    VideoTombstone,
+    VideoTrending,
+)
 
 target_metadata = SQLModel.metadata
 
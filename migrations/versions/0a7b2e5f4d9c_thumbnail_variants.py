@@ -0,0 +1,28 @@
+"""Thumbnail variants on videos and users
+
+Revision ID: 0a7b2e5f4d9c
+Revises: f6a1d4e9c3b8
+Create Date: 2026-10-19 13:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '0a7b2e5f4d9c'
+down_revision = 'f6a1d4e9c3b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('video', sa.Column('thumbnail_variants', postgresql.JSONB(astext_type=sa.Text()), nullable=True))
+    op.add_column('user', sa.Column('thumbnail_variants', postgresql.JSONB(astext_type=sa.Text()), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user', 'thumbnail_variants')
+    op.drop_column('video', 'thumbnail_variants')
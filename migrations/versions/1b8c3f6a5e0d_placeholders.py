@@ -0,0 +1,27 @@
+"""Inline thumbnail placeholders on videos and users
+
+Revision ID: 1b8c3f6a5e0d
+Revises: 0a7b2e5f4d9c
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '1b8c3f6a5e0d'
+down_revision = '0a7b2e5f4d9c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('video', sa.Column('placeholder', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+    op.add_column('user', sa.Column('placeholder', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user', 'placeholder')
+    op.drop_column('video', 'placeholder')
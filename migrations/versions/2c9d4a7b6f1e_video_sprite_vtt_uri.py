@@ -0,0 +1,25 @@
+"""Hover-scrub sprite track on videos
+
+Revision ID: 2c9d4a7b6f1e
+Revises: 1b8c3f6a5e0d
+Create Date: 2026-10-19 14:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '2c9d4a7b6f1e'
+down_revision = '1b8c3f6a5e0d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('video', sa.Column('sprite_vtt_uri', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('video', 'sprite_vtt_uri')
@@ -0,0 +1,44 @@
+"""Resumable uploads
+
+Revision ID: 3d0e5b8c7a2f
+Revises: 2c9d4a7b6f1e
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '3d0e5b8c7a2f'
+down_revision = '2c9d4a7b6f1e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('upload',
+    sa.Column('id', sa.Uuid(), nullable=False),
+    sa.Column('user_id', sa.Uuid(), nullable=False),
+    sa.Column('path', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('display_name', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('length', sa.BigInteger(), nullable=False),
+    sa.Column('offset', sa.BigInteger(), nullable=False),
+    sa.Column('s3_upload_id', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('parts', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('completing_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('error', sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_upload_user_id'), 'upload', ['user_id'], unique=False)
+    op.create_index(op.f('ix_upload_created_at'), 'upload', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_upload_created_at'), table_name='upload')
+    op.drop_index(op.f('ix_upload_user_id'), table_name='upload')
+    op.drop_table('upload')
@@ -0,0 +1,36 @@
+"""Sharded like counters
+
+Revision ID: 4e1f6c9d8b3a
+Revises: 3d0e5b8c7a2f
+Create Date: 2026-10-19 15:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '4e1f6c9d8b3a'
+down_revision = '3d0e5b8c7a2f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('videolikecount',
+    sa.Column('video_path', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('shard', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['video_path'], ['video.path'], ),
+    sa.PrimaryKeyConstraint('video_path', 'shard')
+    )
+    # Existing likes start out in shard 0
+    op.execute(
+        'INSERT INTO videolikecount (video_path, shard, count) '
+        'SELECT video_path, 0, count(*) FROM videolikelink GROUP BY video_path'
+    )
+
+
+def downgrade():
+    op.drop_table('videolikecount')
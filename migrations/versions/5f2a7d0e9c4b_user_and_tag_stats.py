@@ -0,0 +1,126 @@
+"""User and tag stats, maintained by triggers
+
+Revision ID: 5f2a7d0e9c4b
+Revises: 4e1f6c9d8b3a
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '5f2a7d0e9c4b'
+down_revision = '4e1f6c9d8b3a'
+branch_labels = None
+depends_on = None
+
+# likes_received has no trigger, it would make every like of a popular user's videos wait for one row lock.
+# `python -m app.jobs.stats --likes` refreshes it from the sharded `videolikecount` instead.
+TRIGGERS = [
+    # Every user and tag gets a stats row, so lists can join them without outer joins
+    (
+        'userstats_on_user',
+        '"user"',
+        'AFTER INSERT',
+        '''
+        INSERT INTO userstats (user_id, video_count, likes_received) VALUES (NEW.id, 0, 0) ON CONFLICT DO NOTHING;
+        ''',
+    ),
+    (
+        'tagstats_on_tag',
+        'tag',
+        'AFTER INSERT',
+        '''
+        INSERT INTO tagstats (tag_id, video_count) VALUES (NEW.id, 0) ON CONFLICT DO NOTHING;
+        ''',
+    ),
+    (
+        'userstats_on_video',
+        'video',
+        'AFTER INSERT OR DELETE',
+        '''
+        IF TG_OP = 'INSERT' THEN
+            UPDATE userstats SET video_count = video_count + 1 WHERE user_id = NEW.user_id;
+        ELSE
+            UPDATE userstats SET video_count = video_count - 1 WHERE user_id = OLD.user_id;
+        END IF;
+        ''',
+    ),
+    (
+        'tagstats_on_video_tag',
+        'videotaglink',
+        'AFTER INSERT OR DELETE',
+        '''
+        IF TG_OP = 'INSERT' THEN
+            UPDATE tagstats SET video_count = video_count + 1 WHERE tag_id = NEW.tag_id;
+        ELSE
+            UPDATE tagstats SET video_count = video_count - 1 WHERE tag_id = OLD.tag_id;
+        END IF;
+        ''',
+    ),
+]
+
+
+def upgrade():
+    op.create_table('userstats',
+    sa.Column('user_id', sa.Uuid(), nullable=False),
+    sa.Column('video_count', sa.Integer(), nullable=False),
+    sa.Column('likes_received', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_index('ix_userstats_video_count', 'userstats', ['video_count', 'user_id'], unique=False)
+    op.create_index('ix_userstats_likes_received', 'userstats', ['likes_received', 'user_id'], unique=False)
+    op.create_table('tagstats',
+    sa.Column('tag_id', sa.Uuid(), nullable=False),
+    sa.Column('video_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['tag_id'], ['tag.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('tag_id')
+    )
+    op.create_index('ix_tagstats_video_count', 'tagstats', ['video_count', 'tag_id'], unique=False)
+
+    op.execute(
+        '''
+        INSERT INTO userstats (user_id, video_count, likes_received)
+        SELECT
+            u.id,
+            (SELECT count(*) FROM video v WHERE v.user_id = u.id),
+            (
+                SELECT coalesce(sum(c.count), 0) FROM videolikecount c JOIN video v ON v.path = c.video_path
+                WHERE v.user_id = u.id
+            )
+        FROM "user" u
+        '''
+    )
+    op.execute(
+        '''
+        INSERT INTO tagstats (tag_id, video_count)
+        SELECT t.id, (SELECT count(*) FROM videotaglink l WHERE l.tag_id = t.id) FROM tag t
+        '''
+    )
+
+    for name, table, event, body in TRIGGERS:
+        op.execute(
+            f'''
+            CREATE FUNCTION {name}() RETURNS trigger AS $$
+            BEGIN
+                {body}
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            '''
+        )
+        op.execute(f'CREATE TRIGGER {name} {event} ON {table} FOR EACH ROW EXECUTE FUNCTION {name}()')
+
+
+def downgrade():
+    for name, table, _, _ in reversed(TRIGGERS):
+        op.execute(f'DROP TRIGGER {name} ON {table}')
+        op.execute(f'DROP FUNCTION {name}()')
+    op.drop_index('ix_tagstats_video_count', table_name='tagstats')
+    op.drop_table('tagstats')
+    op.drop_index('ix_userstats_likes_received', table_name='userstats')
+    op.drop_index('ix_userstats_video_count', table_name='userstats')
+    op.drop_table('userstats')
@@ -0,0 +1,52 @@
+"""Like timestamps and the precomputed trending feed
+
+Revision ID: 6a3b8e1f0d5c
+Revises: 5f2a7d0e9c4b
+Create Date: 2026-10-19 16:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '6a3b8e1f0d5c'
+down_revision = '5f2a7d0e9c4b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'videolikelink',
+        sa.Column('liked_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    )
+    # We don't know when existing likes happened, the upload time is the closest we have
+    op.execute('UPDATE videolikelink SET liked_at = video.uploaded_at FROM video WHERE video.path = videolikelink.video_path')
+    op.execute('UPDATE videolikelink SET liked_at = now() WHERE liked_at IS NULL')
+    op.alter_column('videolikelink', 'liked_at', nullable=False)
+    op.create_index(op.f('ix_videolikelink_liked_at'), 'videolikelink', ['liked_at'], unique=False)
+
+    op.create_table('videotrending',
+    sa.Column('video_path', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['video_path'], ['video.path'], ),
+    sa.PrimaryKeyConstraint('video_path')
+    )
+    op.create_index('ix_videotrending_score', 'videotrending', ['score', 'video_path'], unique=False)
+    op.create_table('jobcheckpoint',
+    sa.Column('name', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('position', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('jobcheckpoint')
+    op.drop_index('ix_videotrending_score', table_name='videotrending')
+    op.drop_table('videotrending')
+    op.drop_index(op.f('ix_videolikelink_liked_at'), table_name='videolikelink')
+    op.drop_column('videolikelink', 'liked_at')
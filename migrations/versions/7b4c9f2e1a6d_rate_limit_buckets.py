@@ -0,0 +1,34 @@
+"""Per-user rate limit buckets
+
+Revision ID: 7b4c9f2e1a6d
+Revises: 6a3b8e1f0d5c
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '7b4c9f2e1a6d'
+down_revision = '6a3b8e1f0d5c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Unlogged: written on every rate limited request, and worthless after a crash anyway
+    op.create_table('ratelimitbucket',
+    sa.Column('key', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('tokens', sa.Float(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('key'),
+    prefixes=['UNLOGGED'],
+    )
+    op.create_index(op.f('ix_ratelimitbucket_updated_at'), 'ratelimitbucket', ['updated_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_ratelimitbucket_updated_at'), table_name='ratelimitbucket')
+    op.drop_table('ratelimitbucket')
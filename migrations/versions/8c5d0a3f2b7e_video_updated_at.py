@@ -0,0 +1,114 @@
+"""Video updated_at and tombstones for exports, maintained by triggers
+
+Revision ID: 8c5d0a3f2b7e
+Revises: 7b4c9f2e1a6d
+Create Date: 2026-10-19 18:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '8c5d0a3f2b7e'
+down_revision = '7b4c9f2e1a6d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'video',
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('clock_timestamp()'), nullable=False),
+    )
+    # Existing videos last changed when they were uploaded, as far as we know
+    op.execute('UPDATE video SET updated_at = uploaded_at WHERE uploaded_at IS NOT NULL')
+    op.create_index(op.f('ix_video_updated_at'), 'video', ['updated_at'], unique=False)
+    # Unlikes only change the like counter, so its shards are stamped on every like and unlike
+    op.add_column(
+        'videolikecount',
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('clock_timestamp()'), nullable=False),
+    )
+    op.create_index(op.f('ix_videolikecount_updated_at'), 'videolikecount', ['updated_at'], unique=False)
+    op.create_table('videotombstone',
+    sa.Column('path', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('removed_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('user_id', sa.Uuid(), nullable=False),
+    sa.Column('hidden', sa.Boolean(), nullable=False),
+    sa.Column('deleted', sa.Boolean(), nullable=False),
+    sa.PrimaryKeyConstraint('path', 'removed_at'),
+    )
+    op.create_index(op.f('ix_videotombstone_removed_at'), 'videotombstone', ['removed_at'], unique=False)
+
+    # Stamped when written, not when the transaction started, see `export_until` for transactions still open
+
+    op.execute(
+        '''
+        CREATE FUNCTION video_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := clock_timestamp();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        '''
+    )
+    op.execute(
+        'CREATE TRIGGER video_updated_at BEFORE UPDATE ON video '
+        'FOR EACH ROW WHEN (OLD IS DISTINCT FROM NEW) EXECUTE FUNCTION video_updated_at()'
+    )
+    # Tags are part of the video for exports. Likes are not, they are counted in shards to avoid updating the video.
+    op.execute(
+        '''
+        CREATE FUNCTION video_updated_at_on_video_tag() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE video SET updated_at = clock_timestamp() WHERE path = NEW.video_path;
+            ELSE
+                UPDATE video SET updated_at = clock_timestamp() WHERE path = OLD.video_path;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        '''
+    )
+    op.execute(
+        'CREATE TRIGGER video_updated_at_on_video_tag AFTER INSERT OR DELETE ON videotaglink '
+        'FOR EACH ROW EXECUTE FUNCTION video_updated_at_on_video_tag()'
+    )
+    # Videos gone from the export: deleted ones, and ones only their owner may see from now on
+    op.execute(
+        '''
+        CREATE FUNCTION video_tombstone() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO videotombstone (path, removed_at, user_id, hidden, deleted)
+                VALUES (OLD.path, clock_timestamp(), OLD.user_id, OLD.hidden, true);
+            ELSIF NEW.hidden AND NOT OLD.hidden THEN
+                INSERT INTO videotombstone (path, removed_at, user_id, hidden, deleted)
+                VALUES (OLD.path, clock_timestamp(), OLD.user_id, false, false);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        '''
+    )
+    op.execute(
+        'CREATE TRIGGER video_tombstone AFTER DELETE OR UPDATE OF hidden ON video '
+        'FOR EACH ROW EXECUTE FUNCTION video_tombstone()'
+    )
+
+
+def downgrade():
+    op.execute('DROP TRIGGER video_tombstone ON video')
+    op.execute('DROP FUNCTION video_tombstone()')
+    op.execute('DROP TRIGGER video_updated_at_on_video_tag ON videotaglink')
+    op.execute('DROP FUNCTION video_updated_at_on_video_tag()')
+    op.execute('DROP TRIGGER video_updated_at ON video')
+    op.execute('DROP FUNCTION video_updated_at()')
+    op.drop_index(op.f('ix_videotombstone_removed_at'), table_name='videotombstone')
+    op.drop_table('videotombstone')
+    op.drop_index(op.f('ix_videolikecount_updated_at'), table_name='videolikecount')
+    op.drop_column('videolikecount', 'updated_at')
+    op.drop_index(op.f('ix_video_updated_at'), table_name='video')
+    op.drop_column('video', 'updated_at')
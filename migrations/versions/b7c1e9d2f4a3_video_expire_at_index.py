@@ -0,0 +1,25 @@
+"""Index video expire_at for the expiry reaper
+
+Revision ID: b7c1e9d2f4a3
+Revises: a1b2c3d4e5f6
+Create Date: 2026-10-19 09:12:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7c1e9d2f4a3'
+down_revision = 'a1b2c3d4e5f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_video_expire_at'), 'video', ['expire_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_video_expire_at'), table_name='video')
@@ -0,0 +1,38 @@
+"""Content addressed, refcounted video blobs
+
+Revision ID: c3d8a1f0e2b5
+Revises: b7c1e9d2f4a3
+Create Date: 2026-10-19 10:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d8a1f0e2b5'
+down_revision = 'b7c1e9d2f4a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('blob',
+    sa.Column('sha256', sqlmodel.sql.sqltypes.AutoString(length=64), nullable=False),
+    sa.Column('key', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.Column('refcount', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('sha256')
+    )
+    op.add_column('video', sa.Column('blob_sha256', sqlmodel.sql.sqltypes.AutoString(length=64), nullable=True))
+    op.create_index(op.f('ix_video_blob_sha256'), 'video', ['blob_sha256'], unique=False)
+    op.create_foreign_key('video_blob_sha256_fkey', 'video', 'blob', ['blob_sha256'], ['sha256'])
+
+
+def downgrade():
+    op.drop_constraint('video_blob_sha256_fkey', 'video', type_='foreignkey')
+    op.drop_index(op.f('ix_video_blob_sha256'), table_name='video')
+    op.drop_column('video', 'blob_sha256')
+    op.drop_table('blob')
@@ -0,0 +1,25 @@
+"""HLS renditions on videos
+
+Revision ID: d4e9b2c7a1f6
+Revises: c3d8a1f0e2b5
+Create Date: 2026-10-19 11:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4e9b2c7a1f6'
+down_revision = 'c3d8a1f0e2b5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('video', sa.Column('hls_uri', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('video', 'hls_uri')
@@ -0,0 +1,25 @@
+"""Track faststart objects on videos
+
+Revision ID: e5f0c3d8b2a7
+Revises: d4e9b2c7a1f6
+Create Date: 2026-10-19 12:02:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5f0c3d8b2a7'
+down_revision = 'd4e9b2c7a1f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('video', sa.Column('faststart', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+
+def downgrade():
+    op.drop_column('video', 'faststart')
@@ -0,0 +1,44 @@
+"""Media metadata on videos
+
+Revision ID: f6a1d4e9c3b8
+Revises: e5f0c3d8b2a7
+Create Date: 2026-10-19 12:48:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6a1d4e9c3b8'
+down_revision = 'e5f0c3d8b2a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('video', sa.Column('duration', sa.Float(), nullable=True))
+    op.add_column('video', sa.Column('width', sa.Integer(), nullable=True))
+    op.add_column('video', sa.Column('height', sa.Integer(), nullable=True))
+    op.add_column('video', sa.Column('codec', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+    op.add_column('video', sa.Column('bitrate', sa.Integer(), nullable=True))
+    op.add_column('video', sa.Column('file_size', sa.BigInteger(), nullable=True))
+    # `sort=shortest` and `sort=longest`, in their order. Newest first on ties, so one index can't serve both.
+    op.create_index('ix_video_duration', 'video', ['duration', sa.text('uploaded_at DESC')], unique=False)
+    op.create_index(
+        'ix_video_duration_desc', 'video', [sa.text('duration DESC NULLS LAST'), sa.text('uploaded_at DESC')], unique=False
+    )
+    op.create_index(op.f('ix_video_height'), 'video', ['height'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_video_height'), table_name='video')
+    op.drop_index('ix_video_duration_desc', table_name='video')
+    op.drop_index('ix_video_duration', table_name='video')
+    op.drop_column('video', 'file_size')
+    op.drop_column('video', 'bitrate')
+    op.drop_column('video', 'codec')
+    op.drop_column('video', 'height')
+    op.drop_column('video', 'width')
+    op.drop_column('video', 'duration')